@@ -0,0 +1,53 @@
+"""post last activity
+
+Revision ID: 3b7e9d1f5a2c
+Revises: 8d2e4f6a1c3b
+Create Date: 2026-10-19 18:40:12.127304
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b7e9d1f5a2c'
+down_revision = '8d2e4f6a1c3b'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+from assembl.lib import config
+
+
+def schema_prefix():
+    return config.get('db_schema')
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.add_column('post', sa.Column('last_activity', sa.DateTime))
+        # Each post's creation date counts for itself and its ancestors
+        op.execute("""
+            WITH contributions AS (
+                SELECT post.id AS post_id, content.creation_date
+                FROM post JOIN content ON content.id = post.id
+              UNION ALL
+                SELECT CAST(ancestor_id AS INTEGER), content.creation_date
+                FROM post JOIN content ON content.id = post.id,
+                    unnest(string_to_array(
+                        rtrim(post.ancestry, ','), ',')) AS ancestor_id
+                WHERE post.ancestry != ''
+            )
+            UPDATE post SET last_activity = activity.last_activity
+            FROM (SELECT post_id, max(creation_date) AS last_activity
+                  FROM contributions GROUP BY post_id) AS activity
+            WHERE post.id = activity.post_id""")
+        op.create_index(
+            "ix_%s_post_thread_last_activity" % (schema_prefix(),),
+            'post', ['last_activity'], unique=False,
+            postgresql_where=sa.text('parent_id IS NULL'))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index(
+            "ix_%s_post_thread_last_activity" % (schema_prefix(),), 'post')
+        op.drop_column('post', 'last_activity')
@@ -0,0 +1,48 @@
+"""idea closure
+
+Revision ID: 3b8e6a1d9f2c
+Revises: f7d61062eccf
+Create Date: 2026-10-19 15:40:12.318804
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b8e6a1d9f2c'
+down_revision = 'f7d61062eccf'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+from assembl.lib.sqla import mark_changed
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_closure',
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('ancestor_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('descendant_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True, index=True),
+            sa.Column('depth', sa.Integer, nullable=False))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        for (discussion_id,) in db.query(m.Discussion.id):
+            m.IdeaClosure.rebuild(db, discussion_id)
+        mark_changed()
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_closure')
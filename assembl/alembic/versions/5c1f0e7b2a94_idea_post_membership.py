@@ -0,0 +1,47 @@
+"""idea post membership
+
+Revision ID: 5c1f0e7b2a94
+Revises: 3b8e6a1d9f2c
+Create Date: 2026-10-19 15:58:41.204517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c1f0e7b2a94'
+down_revision = '3b8e6a1d9f2c'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+from assembl.lib.sqla import mark_changed
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_post_membership',
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('idea_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('post_id', sa.Integer, sa.ForeignKey(
+                'post.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True, index=True))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        for (discussion_id,) in db.query(m.Discussion.id):
+            m.IdeaPostMembership.refresh(db, discussion_id)
+        mark_changed()
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_post_membership')
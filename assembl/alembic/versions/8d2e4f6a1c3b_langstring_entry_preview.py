@@ -0,0 +1,35 @@
+"""langstring entry preview
+
+Revision ID: 8d2e4f6a1c3b
+Revises: 5c1f0e7b2a94
+Create Date: 2026-10-19 17:12:05.408361
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4f6a1c3b'
+down_revision = '5c1f0e7b2a94'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.add_column('langstring_entry', sa.Column('preview', sa.UnicodeText))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    from assembl.scripts.rebuild_post_previews import rebuild_post_previews
+    db = m.get_session_maker()()
+    with transaction.manager:
+        rebuild_post_previews(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_column('langstring_entry', 'preview')
@@ -0,0 +1,227 @@
+"""Process-level caches of the discussions' permission matrices,
+and of the users' roles.
+
+The role/permission matrices of a discussion (from
+:py:class:`assembl.models.permissions.DiscussionPermission` and
+:py:class:`assembl.models.publication_states.StateDiscussionPermission`)
+change rarely, and are read many times per request. The users' role sets
+are cached for a few seconds only.
+
+Entries are invalidated by ORM events, as soon as the change is flushed
+and again after commit or rollback. Changes made by other processes are only
+seen when the entries expire.
+"""
+from time import time
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from pyramid.security import Everyone, Authenticated
+
+from ..lib.sqla import get_session_maker
+from ..models.permissions import (
+    Role, UserRole, LocalUserRole, Permission, DiscussionPermission)
+from ..models.publication_states import (
+    StateDiscussionPermission, PublicationState)
+
+MATRIX_TTL = 60
+
+ROLES_TTL = 10
+
+
+class ExpiringCache(object):
+    """A dictionary whose values expire after ``ttl`` seconds.
+
+    Values computed while their key was invalidated are not stored."""
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._values = {}
+        self._generation = 0
+
+    def get_or_create(self, key, creator):
+        now = time()
+        entry = self._values.get(key, None)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        generation = self._generation
+        value = creator()
+        if generation == self._generation:
+            if len(self._values) >= self.max_size:
+                self.purge(now)
+            self._values[key] = (now + self.ttl, value)
+        return value
+
+    def purge(self, now=None):
+        now = now or time()
+        for key, (expiry, _) in list(self._values.items()):
+            if expiry <= now:
+                self._values.pop(key, None)
+
+    def invalidate(self, predicate=None):
+        """Invalidate all entries, or those whose key matches the predicate"""
+        self._generation += 1
+        if predicate is None:
+            self._values.clear()
+            return
+        for key in list(self._values.keys()):
+            if predicate(key):
+                self._values.pop(key, None)
+
+
+class DiscussionPermissionMatrix(object):
+    """The role/permission and (publication state, role)/permission
+    matrices of a discussion"""
+    def __init__(self, discussion_id, db=None):
+        db = db or get_session_maker()()
+        self.discussion_id = discussion_id
+        role_permissions = defaultdict(set)
+        self.role_ids = {}
+        for (role_name, role_id, permission_name) in db.query(
+                Role.name, Role.id, Permission.name).join(
+                DiscussionPermission, DiscussionPermission.role_id == Role.id
+                ).join(Permission, DiscussionPermission.permission_id == Permission.id
+                ).filter(DiscussionPermission.discussion_id == discussion_id):
+            role_permissions[role_name].add(permission_name)
+            self.role_ids[role_name] = role_id
+        self.role_permissions = {
+            role: frozenset(perms) for (role, perms) in role_permissions.items()}
+        state_permissions = defaultdict(lambda: defaultdict(set))
+        self.state_labels = {}
+        for (state_id, state_label, role_name, permission_name) in db.query(
+                PublicationState.id, PublicationState.label,
+                Role.name, Permission.name).join(
+                StateDiscussionPermission,
+                StateDiscussionPermission.pub_state_id == PublicationState.id
+                ).join(Role, StateDiscussionPermission.role_id == Role.id
+                ).join(Permission, StateDiscussionPermission.permission_id == Permission.id
+                ).filter(StateDiscussionPermission.discussion_id == discussion_id):
+            state_permissions[state_id][role_name].add(permission_name)
+            self.state_labels[state_id] = state_label
+        self.state_permissions = {
+            state_id: {role: frozenset(perms) for (role, perms) in by_role.items()}
+            for (state_id, by_role) in state_permissions.items()}
+
+    def permissions_for_roles(self, roles):
+        permissions = set()
+        for role in roles:
+            permissions.update(self.role_permissions.get(role, ()))
+        return permissions
+
+    def state_permissions_for_roles(self, state_id, roles):
+        permissions = set()
+        by_role = self.state_permissions.get(state_id, {})
+        for role in roles:
+            permissions.update(by_role.get(role, ()))
+        return permissions
+
+    def roles_with_permissions(self, *permissions):
+        permissions = set(permissions)
+        return [role for (role, perms) in self.role_permissions.items()
+                if perms & permissions]
+
+
+_matrices = ExpiringCache(MATRIX_TTL)
+
+_user_roles = ExpiringCache(ROLES_TTL)
+
+
+def discussion_permission_matrix(discussion_id):
+    "The (cached) :py:class:`DiscussionPermissionMatrix` of a discussion"
+    return _matrices.get_or_create(
+        discussion_id, lambda: DiscussionPermissionMatrix(discussion_id))
+
+
+def _load_user_roles(user_id, discussion_id):
+    db = get_session_maker()()
+    global_roles = frozenset(x for (x,) in db.query(Role.name).join(
+        UserRole, UserRole.role_id == Role.id).filter(
+        UserRole.profile_id == user_id))
+    discussion_roles = set(global_roles)
+    discussion_roles.update((Authenticated, Everyone))
+    if discussion_id:
+        discussion_roles.update(x for (x,) in db.query(Role.name).join(
+            LocalUserRole, LocalUserRole.role_id == Role.id).filter(
+            LocalUserRole.profile_id == user_id,
+            LocalUserRole.requested == False,
+            LocalUserRole.discussion_id == discussion_id))
+    return (global_roles, frozenset(discussion_roles))
+
+
+def user_roles(user_id, discussion_id=None):
+    """The (cached) global roles of a user, and the user's roles in the
+    discussion, including global roles but not object-local roles or
+    ownership, as in :py:func:`assembl.auth.util.get_role_query`."""
+    user_id = user_id or Everyone
+    if user_id == Everyone:
+        return (frozenset(), frozenset((Everyone,)))
+    elif user_id == Authenticated:
+        return (frozenset(), frozenset((Authenticated, Everyone)))
+    return _user_roles.get_or_create(
+        (user_id, discussion_id),
+        lambda: _load_user_roles(user_id, discussion_id))
+
+
+def invalidate_discussion_permissions(discussion_id=None):
+    if discussion_id is None:
+        _matrices.invalidate()
+    else:
+        _matrices.invalidate(lambda key: key == discussion_id)
+
+
+def invalidate_user_roles(user_id=None, discussion_id=None):
+    if user_id is None:
+        _user_roles.invalidate()
+    elif discussion_id is None:
+        _user_roles.invalidate(lambda key: key[0] == user_id)
+    else:
+        _user_roles.invalidate(lambda key: key == (user_id, discussion_id))
+
+
+def _invalidate_after_commit(target, invalidation):
+    invalidation()
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(
+            'permission_cache_invalidations', []).append(invalidation)
+
+
+@event.listens_for(DiscussionPermission, 'after_insert', propagate=True)
+@event.listens_for(DiscussionPermission, 'after_update', propagate=True)
+@event.listens_for(DiscussionPermission, 'after_delete', propagate=True)
+@event.listens_for(StateDiscussionPermission, 'after_insert', propagate=True)
+@event.listens_for(StateDiscussionPermission, 'after_update', propagate=True)
+@event.listens_for(StateDiscussionPermission, 'after_delete', propagate=True)
+def invalidate_for_discussion_permission(mapper, connection, target):
+    discussion_id = target.discussion_id
+    _invalidate_after_commit(
+        target, lambda: invalidate_discussion_permissions(discussion_id))
+
+
+@event.listens_for(UserRole, 'after_insert', propagate=True)
+@event.listens_for(UserRole, 'after_update', propagate=True)
+@event.listens_for(UserRole, 'after_delete', propagate=True)
+def invalidate_for_user_role(mapper, connection, target):
+    user_id = target.profile_id
+    _invalidate_after_commit(target, lambda: invalidate_user_roles(user_id))
+
+
+@event.listens_for(LocalUserRole, 'after_insert', propagate=True)
+@event.listens_for(LocalUserRole, 'after_update', propagate=True)
+@event.listens_for(LocalUserRole, 'after_delete', propagate=True)
+def invalidate_for_local_user_role(mapper, connection, target):
+    user_id, discussion_id = target.profile_id, target.discussion_id
+    _invalidate_after_commit(
+        target, lambda: invalidate_user_roles(user_id, discussion_id))
+
+
+@event.listens_for(get_session_maker(), "after_commit")
+def invalidate_permissions_after_commit(session):
+    for invalidation in session.info.pop('permission_cache_invalidations', ()):
+        invalidation()
+
+
+@event.listens_for(get_session_maker(), "after_soft_rollback")
+def invalidate_permissions_after_rollback(session, previous_transaction):
+    # The cache may have been filled with uncommitted values.
+    invalidate_permissions_after_commit(session)
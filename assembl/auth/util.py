@@ -21,11 +21,10 @@ from ..lib.raven_client import sentry_context
 from . import (
     R_SYSADMIN, P_READ, R_OWNER, P_SYSADMIN, SYSTEM_ROLES, ASSEMBL_PERMISSIONS)
 from .password import verify_data_token, Validity
+from .permission_cache import user_roles, discussion_permission_matrix
 from ..models.auth import User, AgentProfile, EmailAccount
 from ..models.permissions import (
     Role, UserRole, LocalUserRole, Permission, DiscussionPermission)
-from ..models.publication_states import (
-    StateDiscussionPermission, PublicationState)
 
 
 _ = TranslationStringFactory('assembl')
@@ -104,32 +103,22 @@ def roles_from_request_reified(request):
 
 def get_permissions(user_id, discussion_id, target_instance=None):
     user_id = user_id or Everyone
-    session = get_session_maker()()
-    is_sysadmin = user_id != Everyone and session.query(UserRole).filter_by(profile_id=user_id
-                                                                            ).join(Role).filter_by(name=R_SYSADMIN).count()
-    if is_sysadmin:
+    (global_roles, roles) = user_roles(user_id, discussion_id)
+    if R_SYSADMIN in global_roles:
         return list(ASSEMBL_PERMISSIONS)
     if not discussion_id:
         return []
-    roles = get_role_query(user_id, discussion_id,
-                           target_instance).with_entities(Role.id)
-
-    rp_query = session.query(
-        DiscussionPermission.role_id.label('role_id'),
-        DiscussionPermission.permission_id.label('permission_id')).filter(
-        DiscussionPermission.discussion_id == discussion_id)
-    if target_instance and hasattr(target_instance, 'pub_state_id'):
-        rp_query = rp_query.union(
-            session.query(
-                StateDiscussionPermission.role_id.label('role_id'),
-                StateDiscussionPermission.permission_id.label('permission_id')).join(
-                PublicationState, PublicationState.id == StateDiscussionPermission.pub_state_id).filter(
-                PublicationState.id == target_instance.pub_state_id))
-    rp_query = rp_query.subquery()
-    permissions = session.query(Permission.name).join(
-        rp_query, rp_query.c.permission_id == Permission.id).join(
-        Role, (rp_query.c.role_id == Role.id) & Role.id.in_(roles))
-    return [x[0] for x in permissions.distinct()]
+    matrix = discussion_permission_matrix(discussion_id)
+    pub_state_id = None
+    if target_instance is not None:
+        pub_state_id = getattr(target_instance, 'pub_state_id', None)
+        if user_id not in (Everyone, Authenticated):
+            roles = roles.union(target_instance.local_roles(user_id))
+    permissions = matrix.permissions_for_roles(roles)
+    if pub_state_id:
+        permissions.update(matrix.state_permissions_for_roles(
+            pub_state_id, roles))
+    return list(permissions)
 
 
 def base_permissions_from_request(request):
@@ -143,40 +132,140 @@ def permissions_from_request(request):
 
 
 def permissions_for_states(discussion_id, user_id):
-    from ..models import Idea, StateDiscussionPermission
-    db = get_session_maker()()
-
-    roles = get_role_query(user_id, discussion_id).with_entities(Role.id)
-    states = db.query(Idea.pub_state_id).filter_by(
-        discussion_id=discussion_id).distinct()
-    states = [x[0] for x in states if x[0]]
-    sdps = db.query(StateDiscussionPermission).filter(
-        StateDiscussionPermission.discussion_id == discussion_id,
-        StateDiscussionPermission.pub_state_id.in_(states),
-        StateDiscussionPermission.role_id.in_(roles),)
+    (_, roles) = user_roles(user_id, discussion_id)
+    matrix = discussion_permission_matrix(discussion_id)
     result = defaultdict(list)
-    for sdp in sdps:
-        result[sdp.publication_state_label].append(sdp.permission_name)
+    for state_id, label in matrix.state_labels.items():
+        result[label].extend(
+            matrix.state_permissions_for_roles(state_id, roles))
     return result
 
 
 def permissions_for_state(
         discussion_id, state_id, user_id, with_ownership=False):
-    from ..models import StateDiscussionPermission
-    db = get_session_maker()()
-    roles = get_role_query(
-        user_id, discussion_id, None, with_ownership).with_entities(Role.id)
-    perms = db.query(Permission.name).join(StateDiscussionPermission).filter(
-        StateDiscussionPermission.discussion_id == discussion_id,
-        StateDiscussionPermission.pub_state_id == state_id,
-        StateDiscussionPermission.role_id.in_(roles))
-    return [p[0] for p in perms]
+    (_, roles) = user_roles(user_id, discussion_id)
+    if with_ownership:
+        roles = roles.union((R_OWNER,))
+    return list(discussion_permission_matrix(
+        discussion_id).state_permissions_for_roles(state_id, roles))
 
 
 def permissions_for_states_from_req(request):
     return permissions_for_states(request.discussion_id, request.authenticated_userid)
 
 
+class PermissionResolver(object):
+    """Answers permission questions about the instances of a discussion,
+    for a given user, in memory.
+
+    The user's roles and the discussion's role/permission matrices come from
+    :py:mod:`assembl.auth.permission_cache`, and the user's object-local
+    roles are loaded once per class, instead of a role/permission query per
+    instance. It lasts as long as the pyramid request
+    (cf. :py:func:`permission_resolver_for`), so object-local role changes
+    made during the request are not seen."""
+    def __init__(self, discussion_id, user_id, db=None):
+        self.discussion_id = discussion_id
+        self.user_id = user_id or Everyone
+        self.db = db or get_session_maker()()
+        self._object_roles = {}
+
+    @property
+    def matrix(self):
+        return discussion_permission_matrix(self.discussion_id)
+
+    @property
+    def user_roles(self):
+        """The user's roles in the discussion, without ownership or
+        object-local roles, as in :py:func:`get_role_query`"""
+        return user_roles(self.user_id, self.discussion_id)[1]
+
+    @property
+    def is_sysadmin(self):
+        return R_SYSADMIN in user_roles(self.user_id, self.discussion_id)[0]
+
+    def object_roles(self, instance):
+        """The user's object-local roles on this instance.
+
+        All the user's local roles of that class are loaded at once."""
+        (local_role_class, fkey) = instance.local_role_class_and_fkey()
+        if local_role_class is None or instance.id is None:
+            return ()
+        roles = self._object_roles.get(local_role_class, None)
+        if roles is None:
+            roles = defaultdict(set)
+            for (object_id, role_name) in self.db.query(
+                    getattr(local_role_class, fkey), Role.name).join(
+                    Role, local_role_class.role_id == Role.id
+                    ).filter(local_role_class.profile_id == self.user_id):
+                roles[object_id].add(role_name)
+            self._object_roles[local_role_class] = roles
+        return roles.get(instance.id, ())
+
+    def roles_for(self, instance):
+        """The user's roles on this instance, including ownership and
+        object-local roles, as in :py:meth:`BaseOps.get_role_query`"""
+        roles = self.user_roles
+        if self.user_id in (Everyone, Authenticated):
+            return roles
+        roles = set(roles)
+        if instance.is_owner(self.user_id):
+            roles.add(R_OWNER)
+        roles.update(self.object_roles(instance))
+        return roles
+
+    def local_permissions(self, instance, include_global=False):
+        "Same as :py:meth:`BaseOps.local_permissions`"
+        if not self.discussion_id:
+            return []
+        matrix = self.matrix
+        roles = self.roles_for(instance)
+        if include_global:
+            permissions = matrix.permissions_for_roles(roles)
+        elif instance.is_owner(self.user_id):
+            permissions = matrix.permissions_for_roles((R_OWNER,))
+        else:
+            permissions = set()
+        pub_state_id = getattr(instance, 'pub_state_id', None)
+        if pub_state_id:
+            permissions.update(matrix.state_permissions_for_roles(
+                pub_state_id, roles))
+        return list(permissions)
+
+    def permissions_for(self, instance=None):
+        "Same as :py:func:`get_permissions`, with the instance as target"
+        if self.is_sysadmin:
+            return list(ASSEMBL_PERMISSIONS)
+        if not self.discussion_id:
+            return []
+        matrix = self.matrix
+        if instance is None:
+            return list(matrix.permissions_for_roles(self.user_roles))
+        roles = self.roles_for(instance)
+        permissions = matrix.permissions_for_roles(roles)
+        pub_state_id = getattr(instance, 'pub_state_id', None)
+        if pub_state_id:
+            permissions.update(matrix.state_permissions_for_roles(
+                pub_state_id, roles))
+        return list(permissions)
+
+
+def permission_resolver_for(discussion_id, user_id):
+    """The :py:class:`PermissionResolver` of the current request,
+    if it concerns that discussion and user."""
+    from pyramid.threadlocal import get_current_request
+    request = get_current_request()
+    if request is None or not discussion_id:
+        return None
+    if (user_id or Everyone) != (request.authenticated_userid or Everyone):
+        return None
+    resolver = getattr(request, '_permission_resolver', None)
+    if resolver is None or resolver.discussion_id != discussion_id:
+        resolver = request._permission_resolver = PermissionResolver(
+            discussion_id, user_id)
+    return resolver
+
+
 def discussion_id_from_request(request):
     """Obtain the discussion_id from the request,
     possibly without fetching the discussion"""
@@ -314,7 +403,6 @@ class TokenSessionAuthenticationPolicy(SessionAuthenticationPolicy):
         if len(p) == 1:
             user_id = self.user_from_token(request)
             if user_id:
-                discussion = None
                 # No use case for this yet.
                 # try:
                 #     discussion = discussion_from_request(request)
@@ -397,72 +485,28 @@ def discussions_with_access(userid, permission=P_READ):
 
 
 def roles_with_permission(discussion, permission=P_READ):
-    return [x for (x,) in discussion.db.query(Role.name).join(
-        DiscussionPermission).join(Permission).filter(and_(
-            Permission.name == permission,
-            DiscussionPermission.discussion == discussion))]
+    return roles_with_permissions(discussion, permission)
 
 
 def roles_ids_with_permission(discussion, permission=P_READ):
-    return [x for (x,) in discussion.db.query(Role.id).join(
-        DiscussionPermission).join(Permission).filter(and_(
-            Permission.name == permission,
-            DiscussionPermission.discussion == discussion))]
+    matrix = discussion_permission_matrix(discussion.id)
+    return [matrix.role_ids[role]
+            for role in matrix.roles_with_permissions(permission)]
 
 
 def roles_with_permissions(discussion, *permissions):
-    return [x for (x,) in discussion.db.query(Role.name).join(
-        DiscussionPermission).join(Permission).filter(and_(
-            Permission.name.in_(permissions),
-            DiscussionPermission.discussion == discussion))]
+    return discussion_permission_matrix(
+        discussion.id).roles_with_permissions(*permissions)
 
 
 def user_has_permission(discussion_id, user_id, permission):
-    from ..models import Discussion
     # assume all ids valid
     user_id = user_id or Everyone
-    db = Discussion.default_db
-    if user_id == Everyone:
-        permission = db.query(DiscussionPermission).join(
-            Permission).join(Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name == user_id).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    elif user_id == Authenticated:
-        permission = db.query(DiscussionPermission).join(
-            Permission).join(Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    sysadmin = db.query(UserRole).filter_by(
-        profile_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-    if sysadmin:
+    (global_roles, roles) = user_roles(user_id, discussion_id)
+    if R_SYSADMIN in global_roles:
         return True
-    permission = db.query(DiscussionPermission).join(
-        Permission).join(Role).join(UserRole).filter(
-            DiscussionPermission.discussion_id == discussion_id).filter(
-                UserRole.profile_id == user_id).filter(
-                    Permission.name == permission
-    ).union(
-                    db.query(DiscussionPermission
-                             ).join(Permission).join(Role).join(LocalUserRole).filter(and_(
-                                 # Virtuoso disregards this explicit condition
-                                 DiscussionPermission.discussion_id == discussion_id,
-                                 # So I have to add this one as well.
-                                 LocalUserRole.discussion_id == discussion_id,
-                                 LocalUserRole.profile_id == user_id,
-                                 LocalUserRole.requested == False,
-                                 Permission.name == permission))
-    ).union(
-                    db.query(DiscussionPermission).join(
-                        Permission).join(Role).filter(
-                        DiscussionPermission.discussion_id == discussion_id).filter(
-                        Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission)
-    ).first()
-    return permission is not None
+    return permission in discussion_permission_matrix(
+        discussion_id).permissions_for_roles(roles)
 
 
 def users_with_permission(discussion_id, permission, id_only=True):
@@ -0,0 +1,201 @@
+"""A per-object cache of the JSON-LD fragments used by the discussion export,
+and of other values derived from a single object.
+
+Each fragment is keyed by the object's URI, the view_def, the permissions
+used for serialization and a *version token* for that URI.
+The version token is replaced after commit for every object that went through
+:py:meth:`assembl.lib.sqla.BaseOps.send_to_changes`, i.e. the same
+ORM listeners that feed the :py:mod:`assembl.tasks.changes_router`.
+Stale fragments are thus never read again, and simply expire.
+
+Each discussion also has an export version token, replaced whenever an object
+of that discussion changes; the full export is cached under that token, and
+re-assembled from the (mostly still valid) fragments when it changes.
+
+The regions are configured from the ``dogpile_cache.`` settings in every
+process (web, celery, source reader, scripts), so that all of them renew
+the version tokens. The dbm backend never evicts values: run
+:py:mod:`assembl.scripts.purge_dogpile_cache` periodically.
+"""
+from os import urandom
+from os.path import join, dirname
+from binascii import hexlify
+
+from .config import get_config
+from .logging import getLogger
+
+
+log = getLogger()
+
+_regions = {}
+
+FRAGMENT_REGION = 'jsonld_fragment'
+
+# Used for objects that are not bound to a discussion (e.g. AgentProfile),
+# whose changes may affect every discussion export.
+GLOBAL_EXPORT_KEY = '*'
+
+
+# Short backend names used in the ini files
+BACKEND_ALIASES = {
+    'file': 'dogpile.cache.dbm',
+    'dbm': 'dogpile.cache.dbm',
+    'memory': 'dogpile.cache.memory',
+    'memcached': 'dogpile.cache.memcached',
+    'redis': 'dogpile.cache.redis',
+}
+
+
+def region_settings(settings, name):
+    """The ``dogpile_cache.`` settings of a region, with region-specific
+    overrides (``dogpile_cache.<name>.*``) applied."""
+    prefix = 'dogpile_cache.'
+    region_prefix = prefix + name + '.'
+    config = {key: value for (key, value) in settings.items()
+              if key.startswith(prefix)}
+    for key, value in settings.items():
+        if key.startswith(region_prefix):
+            config[prefix + key[len(region_prefix):]] = value
+    backend = config.get(prefix + 'backend', None)
+    if backend:
+        config[prefix + 'backend'] = BACKEND_ALIASES.get(backend, backend)
+    filename = config.get(prefix + 'arguments.filename', None)
+    if filename:
+        config[prefix + 'arguments.filename'] = join(
+            dirname(dirname(dirname(__file__))), filename)
+    return config
+
+
+def get_dogpile_region(name, settings=None):
+    """Get a dogpile region, as configured in the ini file.
+
+    The region is configured on first use after the settings are known,
+    in any process, so it may be created (e.g. for decorators) before that.
+    It stays unconfigured if there is no ``dogpile_cache.backend`` setting."""
+    region = _regions.get(name, None)
+    if region is None:
+        from dogpile.cache import make_region
+        region = _regions[name] = make_region(name=name)
+    if not region.is_configured:
+        if settings is None:
+            settings = get_config() or {}
+        config = region_settings(settings, name)
+        if config.get('dogpile_cache.backend', None):
+            region.configure_from_config(config, 'dogpile_cache.')
+    return region
+
+
+def purge_expired(region, max_age=None):
+    """Delete old values from a dbm-backed region, which never evicts them.
+
+    This includes version tokens, whose objects will simply be
+    re-serialized once.
+
+    :param max_age: in seconds, default: the region's expiration time
+    :returns: the number of deleted keys, or None if not a dbm region"""
+    backend = region.backend
+    if not hasattr(backend, '_dbm_file'):
+        return None
+    max_age = max_age or region.expiration_time
+    if not max_age:
+        return 0
+    from dogpile.cache.api import NO_VALUE
+    with backend._dbm_file(False) as dbm:
+        keys = [key.decode('utf-8') if isinstance(key, bytes) else key
+                for key in dbm.keys()]
+    # values older than max_age are NO_VALUE
+    expired = [key for key in keys if region.get(
+        key, expiration_time=max_age) is NO_VALUE]
+    if expired:
+        region.delete_multi(expired)
+    return len(expired)
+
+
+def _new_token():
+    return hexlify(urandom(8)).decode('ascii')
+
+
+def _version_key(uri):
+    return "version:" + uri
+
+
+def _export_key(discussion_id):
+    return "export_version:%s" % (discussion_id,)
+
+
+def _get_token(region, key):
+    from dogpile.cache.api import NO_VALUE
+    token = region.get(key, ignore_expiration=True)
+    if token is NO_VALUE:
+        token = _new_token()
+        region.set(key, token)
+    return token
+
+
+def export_version(discussion_id):
+    """The current version token of a discussion's JSON-LD export.
+
+    Combines the discussion-specific and global tokens."""
+    region = get_dogpile_region(FRAGMENT_REGION)
+    return "%s.%s" % (
+        _get_token(region, _export_key(discussion_id)),
+        _get_token(region, _export_key(GLOBAL_EXPORT_KEY)))
+
+
+def version_token(ob):
+    """The current version token of an object, e.g. for use in ETags.
+
+    None if the cache is not configured."""
+    region = get_dogpile_region(FRAGMENT_REGION)
+    if not region.is_configured:
+        return None
+    return _get_token(region, _version_key(ob.uri()))
+
+
+def cached_for_version(ob, name, creator):
+    """Get a value derived from ``ob`` from the fragment cache.
+
+    It is computed with ``creator`` if absent, or if ``ob`` changed since.
+
+    :param name: identifies the derived value. Must include anything
+        the value depends on, other than ``ob`` itself."""
+    region = get_dogpile_region(FRAGMENT_REGION)
+    if not region.is_configured:
+        return creator()
+    uri = ob.uri()
+    key = "%s:%s:%s" % (name, uri, _get_token(region, _version_key(uri)))
+    return region.get_or_create(key, creator)
+
+
+def cached_json(ob, view_def_name, permissions=None):
+    """Serialize ``ob`` with :py:meth:`BaseOps.generic_json`,
+    going through the fragment cache."""
+    if permissions is None:
+        creator = lambda: ob.generic_json(view_def_name=view_def_name)
+    else:
+        creator = lambda: ob.generic_json(
+            view_def_name=view_def_name, permissions=permissions)
+    return cached_for_version(ob, "fragment:%s:%s" % (
+        view_def_name, ",".join(sorted(permissions or ()))), creator)
+
+
+def invalidate_fragments(changed_uris):
+    """Replace the version tokens of changed objects and of their
+    discussion exports.
+
+    :param changed_uris: a dictionary of object URIs to discussion ids
+        (or None if the object is not bound to a discussion).
+    """
+    region = get_dogpile_region(FRAGMENT_REGION)
+    if not region.is_configured:
+        # e.g. in celery workers
+        return
+    tokens = {_version_key(uri): _new_token() for uri in changed_uris}
+    for discussion_id in set(changed_uris.values()):
+        if discussion_id in (None, "*"):
+            discussion_id = GLOBAL_EXPORT_KEY
+        tokens[_export_key(discussion_id)] = _new_token()
+    try:
+        region.set_multi(tokens)
+    except Exception as e:
+        log.error("Could not invalidate JSON-LD fragments: %s", e)
@@ -10,18 +10,25 @@ log = getLogger()
 class ReadWriteSession(orm.Session):
     """A session that can divert read queries to a different engine
     Inspired by https://gist.github.com/adhorn/b84dc47175259992d406
-    """
+
+    Once the session has flushed, reads go to the write engine until
+    :py:meth:`set_readonly` is called again, so that uncommitted writes
+    are visible."""
 
     def __init__(self, bind=None, autoflush=False,
                  read_bind=None, readonly=False, **options):
         self.read_bind = read_bind
+        self.readonly = readonly
+        self.wrote = False
         if read_bind:
             read_bind.is_readonly = True
         orm.Session.__init__(
             self, bind=bind, autoflush=autoflush, **options)
 
     def get_bind(self, mapper=None, clause=None):
-        use_read = self.read_bind and not self._flushing and self.readonly
+        if self._flushing:
+            self.wrote = True
+        use_read = self.read_bind and self.readonly and not self.wrote
         log.debug("using %s session%s" % (
             "read" if use_read else "write",
             " while flushing" if self._flushing else ""))
@@ -32,6 +39,7 @@ class ReadWriteSession(orm.Session):
             log.error("cannot set readonly: already flushing")
         else:
             self.readonly = readonly
+            self.wrote = False
 
 
 @contextmanager
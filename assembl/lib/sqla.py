@@ -27,7 +27,7 @@ from functools import partial
 from future.utils import string_types, as_native_str
 from past.builtins import str as past_str, unicode as past_unicode, long
 from enum import Enum
-from simplejson import dumps, loads
+from simplejson import dumps
 from sqlalchemy import (
     DateTime, MetaData, engine_from_config, event, Column, Integer,
     inspect, or_, and_)
@@ -36,7 +36,7 @@ from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.associationproxy import (
     AssociationProxy, ObjectAssociationProxyInstance)
 from sqlalchemy.orm import scoped_session, sessionmaker, aliased
-from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY, MANYTOMANY
+from sqlalchemy.orm.interfaces import ONETOMANY, MANYTOMANY
 from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.orm.util import has_identity
 from sqlalchemy.orm.session import object_session, Session
@@ -51,6 +51,7 @@ import transaction
 
 from .parsedatetime import parse_datetime
 from ..view_def import get_view_def
+from ..view_def.compiler import compile_view
 from .zmqlib import get_pub_socket, send_changes
 from ..semantic.namespaces import QUADNAMES
 from .config import CascadingSettings
@@ -474,6 +475,13 @@ class BaseOps(object):
         connection.info['cdict'][(self.uri(), view_def)] = (
             discussion_id, self)
 
+    def cache_dependencies(self):
+        """URIs of other objects whose cached derived values depend on this one.
+
+        Their version tokens will be renewed along with this object's,
+        cf. :py:mod:`assembl.lib.jsonld_cache`"""
+        return ()
+
     @classmethod
     def external_typename(cls):
         """What is the class name that will be sent on the API, as @type.
@@ -797,116 +805,60 @@ class BaseOps(object):
             self, view_def_name='default', user_id=None,
             permissions=(P_READ, P_READ_IDEA), base_uri='local:'):
         """Return a representation of this object as a JSON object,
-        according to the given view_def and access control."""
+        according to the given view_def and access control.
+
+        The view_def is compiled and checked once per class, cf.
+        :py:mod:`assembl.view_def.compiler`."""
         user_id = user_id or Everyone
         if not self.user_can(user_id, CrudPermissions.READ, permissions):
             return None
-        view_def = get_view_def(view_def_name or 'default')
-        my_typename = self.external_typename()
-        result = {}
-        local_view = self.expand_view_def(view_def)
-        if not local_view:
+        view_def_name = view_def_name or 'default'
+        compiled = compile_view(self.__class__, view_def_name)
+        if compiled is None:
             return None
-        mapper = self.__class__.__mapper__
-        relns = {r.key: r for r in mapper.relationships}
-        cols = {c.key: c for c in mapper.columns}
-        fkeys = {c for c in mapper.columns if c.foreign_keys}
-        reln_of_fkeys = {
-            frozenset(r._calculated_foreign_keys): r
-            for r in mapper.relationships
-        }
-        fkey_of_reln = {r.key: r._calculated_foreign_keys
-                        for r in mapper.relationships}
-        methods = self.__class__.get_single_arg_methods()
-        properties = self.__class__.get_props_of()
-        known = set()
-        for name, spec in local_view.items():
-            vals = None
-            if name == "_default":
-                continue
-            if name == "@update":
-                update_dict = getattr(self, spec)
+        result = {}
+
+        def translate_to_json(v, view_name):
+            if isinstance(v, Base):
+                p = getattr(v, 'user_can', None)
+                if p and not v.user_can(
+                        user_id, CrudPermissions.READ, permissions):
+                    return None
+                if view_name:
+                    return v.generic_json(
+                        view_name, user_id, permissions, base_uri)
+                else:
+                    return v.uri(base_uri)
+            elif isinstance(v, (
+                    string_types, int, long, float, bool, type(None))):
+                return v
+            elif isinstance(v, EnumSymbol):
+                return v.name
+            elif isinstance(v, datetime):
+                return v.isoformat() + "Z"
+            elif isinstance(v, dict):
+                v = {translate_to_json(k, view_name):
+                     translate_to_json(val, view_name)
+                     for k, val in v.items()}
+                return {k: val for (k, val) in v.items()
+                        if val is not None}
+            elif isinstance(v, Iterable):
+                v = [translate_to_json(i, view_name) for i in v]
+                return [x for x in v if x is not None]
+            else:
+                raise NotImplementedError("Cannot translate", v)
+
+        for entry in compiled.entries:
+            (name, kind, prop_name, view_name, container, value) = entry
+            if kind == 'update':
+                update_dict = getattr(self, prop_name)
                 if pyinspect.ismethod(update_dict):
                     update_dict = update_dict()
                 assert isinstance(update_dict, dict)
                 result.update(update_dict)
-                continue
-            elif spec is False:
-                known.add(name)
-                continue
-            elif type(spec) is list:
-                if not spec:
-                    spec = [True]
-                assert len(spec) == 1,\
-                    "in viewdef %s, class %s, name %s, len(list) > 1" % (
-                        view_def_name, my_typename, name)
-                subspec = spec[0]
-            elif type(spec) is dict:
-                assert len(spec) == 1,\
-                    "in viewdef %s, class %s, name %s, len(dict) > 1" % (
-                        view_def_name, my_typename, name)
-                assert "@id" in spec,\
-                    "in viewdef %s, class %s, name %s, key should be '@id'" % (
-                        view_def_name, my_typename, name)
-                subspec = spec["@id"]
-            else:
-                subspec = spec
-            if subspec is True:
-                prop_name = name
-                view_name = None
-            else:
-                assert isinstance(subspec, string_types),\
-                    "in viewdef %s, class %s, name %s, spec not a string" % (
-                        view_def_name, my_typename, name)
-                if subspec[0] == "'":
-                    # literals.
-                    result[name] = loads(subspec[1:])
-                    continue
-                if ':' in subspec:
-                    prop_name, view_name = subspec.split(':', 1)
-                    if not view_name:
-                        view_name = view_def_name
-                    if not prop_name:
-                        prop_name = name
-                else:
-                    prop_name = subspec
-                    view_name = None
-            if view_name:
-                assert get_view_def(view_name),\
-                    "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
-                        view_def_name, my_typename, name, view_name)
-            # print prop_name, name, view_name
-
-            def translate_to_json(v):
-                if isinstance(v, Base):
-                    p = getattr(v, 'user_can', None)
-                    if p and not v.user_can(
-                            user_id, CrudPermissions.READ, permissions):
-                        return None
-                    if view_name:
-                        return v.generic_json(
-                            view_name, user_id, permissions, base_uri)
-                    else:
-                        return v.uri(base_uri)
-                elif isinstance(v, (
-                        string_types, int, long, float, bool, type(None))):
-                    return v
-                elif isinstance(v, EnumSymbol):
-                    return v.name
-                elif isinstance(v, datetime):
-                    return v.isoformat() + "Z"
-                elif isinstance(v, dict):
-                    v = {translate_to_json(k): translate_to_json(val)
-                         for k, val in v.items()}
-                    return {k: val for (k, val) in v.items()
-                            if val is not None}
-                elif isinstance(v, Iterable):
-                    v = [translate_to_json(i) for i in v]
-                    return [x for x in v if x is not None]
-                else:
-                    raise NotImplementedError("Cannot translate", v)
-
-            if prop_name == 'self':
+            elif kind == 'literal':
+                result[name] = compiled.literal(entry)
+            elif kind == 'self':
                 if view_name:
                     r = self.generic_json(
                         view_name, user_id, permissions, base_uri)
@@ -914,70 +866,28 @@ class BaseOps(object):
                         result[name] = r
                 else:
                     result[name] = self.uri()
-                continue
-            elif prop_name == '@view':
+            elif kind == 'view':
                 result[name] = view_def_name
-                continue
-            elif prop_name[0] == '&':
-                prop_name = prop_name[1:]
-                assert prop_name in methods,\
-                    "in viewdef %s, class %s, name %s, unknown method %s" % (
-                        view_def_name, my_typename, name, prop_name)
+            elif kind == 'method':
                 # Function call. PLEASE RETURN JSON, Base objects,
                 # or list or dicts thereof
                 val = getattr(self, prop_name)()
-                result[name] = translate_to_json(val)
-                continue
-            elif prop_name in cols:
-                assert not view_name,\
-                    "in viewdef %s, class %s, viewdef for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                assert not isinstance(spec, list),\
-                    "in viewdef %s, class %s, list for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                assert not isinstance(spec, dict),\
-                    "in viewdef %s, class %s, dict for literal property %s" % (
-                        view_def_name, my_typename, prop_name)
-                known.add(prop_name)
+                result[name] = translate_to_json(val, view_name)
+            elif kind in ('column', 'property'):
                 val = getattr(self, prop_name)
                 if val is not None:
-                    val = translate_to_json(val)
+                    val = translate_to_json(val, view_name)
                 if val is not None:
                     result[name] = val
-                continue
-            elif prop_name in properties:
-                known.add(prop_name)
-                if view_name or (prop_name not in fkey_of_reln) or (
-                        relns[prop_name].direction != MANYTOONE):
-                    val = getattr(self, prop_name)
-                    if val is not None:
-                        val = translate_to_json(val)
-                    if val is not None:
-                        result[name] = val
-                else:
-                    fkeys = list(fkey_of_reln[prop_name])
-                    assert(len(fkeys) == 1)
-                    fkey = fkeys[0]
-                    result[name] = relns[prop_name].mapper.class_.uri_generic(
-                        getattr(self, fkey.key))
-
-                continue
-            elif isinstance(getattr(self.__class__, prop_name, None),
-                            (AssociationProxy, ObjectAssociationProxyInstance)):
+            elif kind == 'fkey_uri':
+                (fkey, target_cls) = value
+                result[name] = target_cls.uri_generic(getattr(self, fkey))
+            elif kind == 'collection':
                 vals = getattr(self, prop_name)
-            else:
-                assert prop_name in relns,\
-                    "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
-                        view_def_name, my_typename, prop_name)
-                known.add(prop_name)
-                # Add derived prop?
-                reln = relns[prop_name]
-                if reln.uselist:
-                    vals = getattr(self, prop_name)
-            if vals is not None:
-                known.add(prop_name)
+                if vals is None:
+                    continue
                 if view_name:
-                    if isinstance(spec, dict):
+                    if container == 'dict':
                         result[name] = {
                             ob.uri(base_uri):
                             ob.generic_json(
@@ -993,82 +903,55 @@ class BaseOps(object):
                             if ob.user_can(
                                 user_id, CrudPermissions.READ, permissions)]
                 else:
-                    assert not isinstance(spec, dict),\
-                        "in viewdef %s, class %s, dict without viewname for %s" % (
-                            view_def_name, my_typename, name)
                     result[name] = [
                         ob.uri(base_uri) for ob in vals
                         if ob.user_can(
                             user_id, CrudPermissions.READ, permissions)]
-                continue
-            assert not isinstance(spec, dict),\
-                "in viewdef %s, class %s, dict for non-list relation %s" % (
-                    view_def_name, my_typename, prop_name)
-            if view_name:
+            elif kind == 'scalar_json':
                 ob = getattr(self, prop_name)
+                val = None
                 if ob and ob.user_can(
                         user_id, CrudPermissions.READ, permissions):
                     val = ob.generic_json(
                         view_name, user_id, permissions, base_uri)
-                    if val is not None:
-                        if isinstance(spec, list):
-                            result[name] = [val]
-                        else:
-                            result[name] = val
+                    if val is None:
+                        continue
+                if container == 'list':
+                    result[name] = [val] if val is not None else []
                 else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
-            else:
+                    result[name] = val
+            elif kind == 'scalar_uri':
                 uri = None
-                if len(reln._calculated_foreign_keys) == 1 \
-                        and reln._calculated_foreign_keys < fkeys:
+                if value is not None:
                     # shortcut, avoid fetch
-                    fkey = list(reln._calculated_foreign_keys)[0]
-                    ob_id = getattr(self, fkey.name)
+                    (fkey, target_cls) = value
+                    ob_id = getattr(self, fkey)
                     if ob_id:
-                        uri = reln.mapper.class_.uri_generic(
-                            ob_id, base_uri)
+                        uri = target_cls.uri_generic(ob_id, base_uri)
                 else:
                     ob = getattr(self, prop_name)
                     if ob:
                         uri = ob.uri(base_uri)
-                if uri:
-                    if isinstance(spec, list):
-                        result[name] = [uri]
-                    else:
-                        result[name] = uri
+                if container == 'list':
+                    result[name] = [uri] if uri else []
                 else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
-
-        if local_view.get('_default') is not False:
-            for name, col in cols.items():
-                if name in known:
-                    continue  # already done
-                as_rel = reln_of_fkeys.get(frozenset((col, )))
-                if as_rel:
-                    name = as_rel.key
-                    if name in known:
-                        continue
-                    else:
-                        ob_id = getattr(self, col.key)
-                        if ob_id:
-                            result[name] = as_rel.mapper.class_.uri_generic(
-                                ob_id, base_uri)
-                        else:
-                            result[name] = None
+                    result[name] = uri or None
+
+        for (name, column, target_cls) in compiled.defaults:
+            if target_cls is not None:
+                ob_id = getattr(self, column)
+                if ob_id:
+                    result[name] = target_cls.uri_generic(ob_id, base_uri)
                 else:
-                    ob = getattr(self, name)
-                    if ob:
-                        if type(ob) == datetime:
-                            ob = ob.isoformat() + "Z"
-                        result[name] = ob
-                    else:
-                        result[name] = None
+                    result[name] = None
+            else:
+                ob = getattr(self, column)
+                if ob:
+                    if type(ob) == datetime:
+                        ob = ob.isoformat() + "Z"
+                    result[name] = ob
+                else:
+                    result[name] = None
         return result
 
     def locked_object_creation(
@@ -2251,13 +2134,15 @@ class BaseOps(object):
                 session.query(Permission.name).join(
                     DiscussionPermission
                 ).join(Role
-                       ).filter(Role.id.in_(roles)))
+                       ).filter(Role.id.in_(roles),
+                                DiscussionPermission.discussion_id == discussion.id))
         elif self.is_owner(user_id):
             queries.append(
                 session.query(Permission.name).join(
                     DiscussionPermission
                 ).join(Role
-                       ).filter(Role.name == R_OWNER))
+                       ).filter(Role.name == R_OWNER,
+                                DiscussionPermission.discussion_id == discussion.id))
         pub_state_id = getattr(self, 'pub_state_id', None)
         if pub_state_id:
             queries.append(
@@ -2391,6 +2276,7 @@ class Tombstone(object):
         self.typename = ob.external_typename()
         self.uri = ob.uri()
         self.extra_args = kwargs
+        self.dependencies = ob.cache_dependencies()
         privacy_info = ob.principals_with_read_permission()
         if privacy_info:
             self.extra_args['@private'] = privacy_info
@@ -2402,6 +2288,9 @@ class Tombstone(object):
         args.update(self.extra_args)
         return args
 
+    def cache_dependencies(self):
+        return self.dependencies
+
     def send_to_changes(self, connection, operation=CrudOperation.DELETE,
                         discussion_id=None, view_def="changes"):
         assert connection
@@ -2411,6 +2300,39 @@ class Tombstone(object):
             discussion_id, self)
 
 
+class PartialChange(object):
+    """Some changed properties of an object, sent on the changes websocket
+    instead of its full serialization, e.g. after a bulk update.
+
+    Clients only merge it into objects they already have."""
+    def __init__(self, typename, uri, properties, private=None):
+        self.typename = typename
+        self.uri = uri
+        self.properties = properties
+        self.private = private
+
+    def generic_json(self, *vargs, **kwargs):
+        args = {"@type": self.typename,
+                "@id": self.uri,
+                "@partial": True}
+        args.update(self.properties)
+        if self.private:
+            args['@private'] = self.private
+        return args
+
+    def cache_dependencies(self):
+        return ()
+
+    def send_to_changes(self, connection, operation=CrudOperation.UPDATE,
+                        discussion_id=None, view_def="changes"):
+        assert connection
+        if 'cdict' not in connection.info:
+            connection.info['cdict'] = {}
+        # a full serialization of the same object takes precedence
+        connection.info['cdict'].setdefault(
+            (self.uri, view_def), (discussion_id, self))
+
+
 def orm_update_listener(mapper, connection, target):
     if getattr(target, '__history_table__', None):
         return
@@ -2451,14 +2373,20 @@ def before_commit_listener(session):
     info = session.connection().info
     if 'cdict' in info:
         changes = defaultdict(list)
+        # may already hold uris of objects changed with set-based SQL
+        changed_uris = getattr(session, 'changed_uris', None) or {}
         for ((uri, view_def), (discussion, target)) in \
                 info['cdict'].items():
             discussion = discussion or "*"
+            changed_uris[uri] = discussion
+            for dependency_uri in target.cache_dependencies():
+                changed_uris[dependency_uri] = discussion
             json = target.generic_json(view_def)
             if json:
                 changes[discussion].append(json)
         del info['cdict']
         session.cdict2 = changes
+        session.changed_uris = changed_uris
     else:
         log.debug("EMPTY CDICT!")
 
@@ -2472,12 +2400,18 @@ def after_commit_listener(session):
         for discussion, changes in session.cdict2.items():
             send_changes(session.zsocket, discussion, changes)
         del session.cdict2
+    if getattr(session, 'changed_uris', None):
+        from .jsonld_cache import invalidate_fragments
+        invalidate_fragments(session.changed_uris)
+        del session.changed_uris
 
 
 def session_rollback_listener(session):
     """In case of rollback, forget about object changes."""
     if getattr(session, 'cdict2', None):
         del session.cdict2
+    if getattr(session, 'changed_uris', None):
+        del session.changed_uris
 
 
 def engine_rollback_listener(connection):
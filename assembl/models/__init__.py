@@ -63,6 +63,11 @@ class DiscussionBoundBase(AbstractBase):
         return Discussion.get(self.get_discussion_id())
 
     def local_permissions(self, user_id, discussion=None, include_global=False):
+        from ..auth.util import permission_resolver_for
+        resolver = permission_resolver_for(
+            discussion.id if discussion else self.get_discussion_id(), user_id)
+        if resolver is not None:
+            return resolver.local_permissions(self, include_global)
         return super(DiscussionBoundBase, self).local_permissions(
             user_id, discussion or self.get_discussion(), include_global)
 
@@ -274,6 +279,7 @@ from .mail import (
 from .idea import (
     Idea,
     IdeaLink,
+    IdeaClosure,
     RootIdea,
     IdeaLocalUserRole,
 )
@@ -326,6 +332,9 @@ from .votes import (
 from .annotation import (
     Webpage,
 )
+from .path_utils import (
+    IdeaPostMembership,
+)
 from .timeline import (
     DiscussionMilestone,
     DiscussionPhase,
@@ -9,13 +9,13 @@ from .permissions import (
 from ..auth.util import get_permissions, permissions_for_state
 from .auth import User
 from ..auth import (
-    P_READ, R_SYSADMIN, P_ADMIN_DISC, R_PARTICIPANT, P_SYSADMIN,
+    P_READ, R_SYSADMIN, P_ADMIN_DISC, R_PARTICIPANT, P_SYSADMIN, P_READ_IDEA,
     CrudPermissions, Authenticated, Everyone)
 from ..semantic.virtuoso_mapping import QuadMapPatternS
 from . import DiscussionBoundBase, NamedClassMixin, OriginMixin
 from ..lib.discussion_creation import IDiscussionCreationCallback
 from ..lib.locale import strip_country
-from ..lib.sqla import CrudOperation
+from ..lib.sqla import CrudOperation, PartialChange, mark_changed
 from ..lib.sqla_types import URLString, CoerceUnicode
 from assembl.lib.utils import slugify, get_global_base_url, full_class_name
 from assembl.lib import config
@@ -23,6 +23,7 @@ from sqlalchemy.sql.expression import literal, distinct
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import (
     relationship, join, subqueryload, joinedload, backref, with_polymorphic, aliased)
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy import (
     Column,
     Integer,
@@ -251,32 +252,194 @@ class Discussion(NamedClassMixin, OriginMixin, DiscussionBoundBase):
         assert pub_flow, "Cannot find PublicationFlow " + name
         self.idea_publication_flow = pub_flow
 
-    def bulk_apply_idea_transition(self, transition_name, user_id, permissions=None):
-        flow = self.idea_publication_flow
-        transition = flow.transition_by_label(transition_name)
-        assert transition, "Cannot find transition " + transition_name
+    def _idea_permissions(self, user_id, permissions=None):
         if not permissions:
             from pyramid.threadlocal import get_current_request
             request = get_current_request()
             if request:
                 permissions = request.base_permissions
             else:
-                permissions = get_permissions(user_id, self.discussion_id)
+                permissions = get_permissions(user_id, self.id)
+        return permissions
+
+    def bulk_apply_idea_transition(self, transition_name, user_id, permissions=None):
+        from .idea import Idea
+        flow = self.idea_publication_flow
+        transition = flow.transition_by_label(transition_name)
+        assert transition, "Cannot find transition " + transition_name
+        permissions = self._idea_permissions(user_id, permissions)
         if transition.req_permission_name not in permissions:
             raise HTTPUnauthorized("You need permission %s to apply transition %s" % (
                 transition.req_permission_name, transition.label))
-        for idea in self.ideas:
-            if idea.pub_state_id == transition.source_id:
-                idea.pub_state_id = transition.target_id
+        idea_ids = [id for (id,) in self.db.query(Idea.id).filter_by(
+            discussion_id=self.id, tombstone_date=None,
+            pub_state_id=transition.source_id)]
+        self.bulk_set_idea_pub_states({transition.target: idea_ids})
+
+    def _reachable_pub_state(self, state, label, user_id, permissions):
+        """The state with that label, if the user can reach it from the given
+        state, with the permissions they have on ideas in the given state.
+
+        Same logic as :py:meth:`Idea.safe_set_pub_state`, without
+        object-local roles or ownership."""
+        if state.label == label:
+            return state
+        if P_SYSADMIN in permissions or P_ADMIN_DISC in permissions:
+            target = self.idea_publication_flow.state_by_label(label)
+            assert target, "No such state"
+            return target
+        permissions = set(permissions).union(
+            permissions_for_state(self.id, state.id, user_id))
+        new_states = {state}
+        known_states = set()
+        while new_states:
+            state = new_states.pop()
+            for transition in state.transitions_to:
+                if transition.req_permission_name in permissions:
+                    if transition.target.label == label:
+                        return transition.target
+                    new_states.add(transition.target)
+            known_states.add(state)
+            new_states -= known_states
 
     def bulk_change_publication_states(self, changes, user_id, permissions=None):
-        from .idea import RootIdea
-        for idea in self.ideas:
-            dest = changes.get(idea.pub_state_name, None)
-            if isinstance(idea, RootIdea):
+        """Change the publication states of the discussion's ideas.
+
+        Permissions are checked once per pair of states; only the ideas where
+        the user may have more permissions, as owner or through local roles,
+        are checked one by one if that fails.
+
+        :param changes: a dictionary of target state labels, by source
+            state label (or ``@root`` for the root idea)"""
+        from .idea import Idea, RootIdea, IdeaLocalUserRole
+        states = {state.id: state
+                  for state in self.idea_publication_flow.states}
+        permissions = self._idea_permissions(user_id, permissions)
+        root_type = RootIdea.__mapper_args__['polymorphic_identity']
+        reachable = {}
+        ideas_by_state = defaultdict(list)
+        unchecked = {}
+        for (idea_id, state_id, sqla_type, creator_id) in self.db.query(
+                Idea.id, Idea.pub_state_id, Idea.sqla_type, Idea.creator_id
+                ).filter_by(discussion_id=self.id, tombstone_date=None):
+            state = states.get(state_id, None)
+            dest = changes.get(state.label if state else None, None)
+            if sqla_type == root_type:
                 dest = changes.get('@root', dest)
-            if dest:
-                assert idea.safe_set_pub_state(dest, user_id)
+            if not dest:
+                continue
+            if state is None:
+                # as in Idea.safe_set_pub_state
+                state = self.idea_publication_flow.state_by_label(
+                    self.preferences['default_idea_pub_state'])
+                assert state, "No default idea publication state"
+                state_id = state.id
+            if (state_id, dest) not in reachable:
+                reachable[(state_id, dest)] = self._reachable_pub_state(
+                    state, dest, user_id, permissions)
+            target = reachable[(state_id, dest)]
+            if target is None:
+                unchecked[idea_id] = (dest, creator_id)
+            elif target is not state:
+                ideas_by_state[target].append(idea_id)
+        if unchecked:
+            with_local_roles = {id for (id,) in self.db.query(
+                IdeaLocalUserRole.idea_id).filter(
+                IdeaLocalUserRole.profile_id == user_id,
+                IdeaLocalUserRole.idea_id.in_(list(unchecked.keys())))}
+            denied = [id for (id, (_, creator_id)) in unchecked.items()
+                      if creator_id != user_id and id not in with_local_roles]
+            assert not denied, \
+                "Cannot change the publication state of ideas %s" % (denied,)
+            for idea in self.db.query(Idea).filter(
+                    Idea.id.in_(list(unchecked.keys()))):
+                assert idea.safe_set_pub_state(unchecked[idea.id][0], user_id)
+        self.bulk_set_idea_pub_states(ideas_by_state)
+
+    def bulk_set_idea_pub_states(self, ideas_by_state):
+        """Set the publication state of ideas, with one statement per state,
+        without permission checks.
+
+        A :py:class:`assembl.lib.sqla.PartialChange` with the new state is
+        sent on the changes websocket for each idea, instead of its
+        full serialization; unless the idea becomes readable by new roles,
+        whose clients do not have it yet.
+
+        :param ideas_by_state: lists of idea ids, by target PublicationState"""
+        from .idea import Idea, IdeaLocalUserRole
+        from ..auth.util import roles_with_permission
+        from ..auth.permission_cache import discussion_permission_matrix
+        ideas_by_state = {state: ids for (state, ids)
+                          in ideas_by_state.items() if ids}
+        if not ideas_by_state:
+            return
+        db = self.db
+        db.flush()
+        idea_ids = list(chain(*ideas_by_state.values()))
+        idea_info = {id: (sqla_type, creator_id, state_id) for (
+            id, sqla_type, creator_id, state_id) in db.query(
+            Idea.id, Idea.sqla_type, Idea.creator_id, Idea.pub_state_id
+            ).filter(Idea.id.in_(idea_ids))}
+        idea_table = Idea.__table__
+        now = datetime.now()
+        for state, ids in ideas_by_state.items():
+            db.execute(idea_table.update().where(
+                idea_table.c.id.in_(ids)).values(
+                pub_state_id=state.id, last_modified=now))
+        mark_changed(db)
+        for idea_id in idea_ids:
+            ob = db.identity_map.get(identity_key(Idea, idea_id))
+            if ob is not None:
+                db.expire(ob, ['pub_state_id', 'pub_state', 'last_modified'])
+
+        # Same readers as Idea.principals_with_read_permission
+        matrix = discussion_permission_matrix(self.id)
+        base_readers = set(roles_with_permission(self, P_READ_IDEA))
+        default_state = self.idea_publication_flow.state_by_label(
+            self.preferences['default_idea_pub_state'])
+
+        def readers_in(state_id):
+            if state_id is None and default_state is not None:
+                state_id = default_state.id
+            return base_readers.union(
+                role for (role, perms)
+                in matrix.state_permissions.get(state_id, {}).items()
+                if P_READ_IDEA in perms)
+
+        local_roles = defaultdict(list)
+        for (idea_id, role_name, profile_id) in db.query(
+                IdeaLocalUserRole.idea_id, Role.name,
+                IdeaLocalUserRole.profile_id
+                ).join(Role, Role.id == IdeaLocalUserRole.role_id
+                ).filter(IdeaLocalUserRole.idea_id.in_(idea_ids)):
+            local_roles[idea_id].append((role_name, profile_id))
+        polymorphic_map = Idea.__mapper__.polymorphic_map
+        connection = db.connection()
+        newly_readable = []
+        for state, ids in ideas_by_state.items():
+            readers = readers_in(state.id)
+            for idea_id in ids:
+                sqla_type, creator_id, old_state_id = idea_info[idea_id]
+                if not readers <= readers_in(old_state_id):
+                    # partial changes are ignored by clients without the idea
+                    newly_readable.append(idea_id)
+                    continue
+                private = set(readers)
+                private.update(
+                    User.uri_generic(profile_id)
+                    for (role_name, profile_id) in local_roles[idea_id]
+                    if role_name in readers)
+                if creator_id:
+                    private.add(User.uri_generic(creator_id))
+                PartialChange(
+                    polymorphic_map[sqla_type].class_.external_typename(),
+                    Idea.uri_generic(idea_id),
+                    {"pub_state_name": state.label}, list(private)
+                ).send_to_changes(connection, discussion_id=self.id)
+        if newly_readable:
+            for idea in db.query(Idea).filter(Idea.id.in_(newly_readable)):
+                idea.send_to_changes(
+                    connection, CrudOperation.UPDATE, self.id)
 
     def reset_idea_publication_flow(self, new_flow_name, default_state_name, correspondances=None):
         # this should only be done by sysadmin or discussion_admin
@@ -869,45 +1032,45 @@ class Discussion(NamedClassMixin, OriginMixin, DiscussionBoundBase):
             Extract.discussion == self)
 
     def get_extract_graphs_cif(self):
-        from .idea import Idea
         for e in self.get_bound_extracts():
             yield from e.extract_graph_json()
 
     def get_discussion_graph_cif(self):
+        """The objects of the discussion's public JSON-LD export.
+
+        Each object goes through the
+        :py:mod:`JSON-LD fragment cache <assembl.lib.jsonld_cache>`."""
         from .post import Post
         from .action import ActionOnPost
         from .votes import AbstractIdeaVote, LickertIdeaVote, TokenIdeaVote
-        yield self.generic_json(view_def_name="cif")
+        from ..lib.jsonld_cache import cached_json
+        yield cached_json(self, "cif")
         for i in chain(
                 self.views, self.ideas, self.idea_links,
                 self.posts, self.local_user_roles):
-            yield i.generic_json(view_def_name="cif")
+            yield cached_json(i, "cif")
         for s in self.sources:
-            yield i.generic_json(
-                view_def_name="cif", permissions=[P_ADMIN_DISC])
+            yield cached_json(s, "cif", [P_ADMIN_DISC])
         for action in self.db.query(ActionOnPost).join(Post).filter_by(
                 discussion_id=self.id, tombstone_date=None):
-            yield action.generic_json(
-                view_def_name="cif", permissions=[P_SYSADMIN])
+            yield cached_json(action, "cif", [P_SYSADMIN])
         for vote in self.db.query(AbstractIdeaVote).join(
                 AbstractIdeaVote.idea).filter_by(
                 discussion_id=self.id, tombstone_date=None):
-            yield vote.generic_json(
-                view_def_name="cif", permissions=[P_ADMIN_DISC])
+            yield cached_json(vote, "cif", [P_ADMIN_DISC])
             if isinstance(vote, LickertIdeaVote):
-                yield vote.vote_spec.generic_json(view_def_name="cif")
+                yield cached_json(vote.vote_spec, "cif")
             elif isinstance(vote, TokenIdeaVote):
-                yield vote.token_category.generic_json(view_def_name="cif")
+                yield cached_json(vote.token_category, "cif")
         for p in self.get_participants():
-            yield p.generic_json(view_def_name="cif")
+            yield cached_json(p, "cif")
             for acc in p.accounts:
-                yield acc.generic_json(
-                    view_def_name="cif", permissions=[P_SYSADMIN])
+                yield cached_json(acc, "cif", [P_SYSADMIN])
         for e in self.get_bound_extracts():
-            yield e.generic_json(view_def_name="cif")
-            yield e.generic_json(view_def_name="cif2")
+            yield cached_json(e, "cif")
+            yield cached_json(e, "cif2")
             for t in e.selectors:
-                yield t.generic_json(view_def_name="cif")
+                yield cached_json(t, "cif")
 
     def get_public_graphs_cif(self):
         graphs = [x for x in self.get_extract_graphs_cif() if x]
@@ -923,11 +1086,11 @@ class Discussion(NamedClassMixin, OriginMixin, DiscussionBoundBase):
         }
 
     def get_user_graph_cif(self):
+        from ..lib.jsonld_cache import cached_json
         for p in self.get_participants():
-            yield p.generic_json(view_def_name="cif2")
+            yield cached_json(p, "cif2")
             for acc in p.accounts:
-                yield acc.generic_json(
-                    view_def_name="cif2", permissions=[P_SYSADMIN])
+                yield cached_json(acc, "cif2", [P_SYSADMIN])
 
     def get_private_graphs_cif(self):
         graphs = [x for x in self.get_user_graph_cif() if x]
@@ -127,8 +127,13 @@ class ContentSource(DiscussionBoundBase, OriginMixin):
         return sanitized
 
     def import_content(self, only_new=True):
+        self.dispatch_import(self.id, only_new)
+
+    @classmethod
+    def dispatch_import(cls, source_id, only_new=True):
+        """Ask the appropriate process to import content from a source."""
         from assembl.tasks.source_reader import wake
-        wake(self.id, reimport=not only_new)
+        wake(source_id, reimport=not only_new)
 
     def make_reader(self):
         raise NotImplementedError()
@@ -492,6 +497,26 @@ class Content(TombstonableOriginMixin, DiscussionBoundBase):
             log.error("What is this mimetype?" + mimetype)
             return body
 
+    def term_vectors(self, langs):
+        """Stemmed term vectors of the body and subject, as used by
+        :py:class:`assembl.models.idea.WordCountVisitor`. Cached.
+
+        :returns: (body term vector, cleaned subject, subject term vector)"""
+        from ..nlp.wordcounter import WordCounter
+        from ..lib.jsonld_cache import cached_for_version
+        body = self.body.safe_best_entry_in_request()
+        subject = self.subject.safe_best_entry_in_request()
+
+        def compute():
+            body_counter = WordCounter(langs)
+            body_counter.add_text(sanitize_text(body.value), 0.5)
+            title = sanitize_text(subject.value)
+            title_counter = WordCounter(langs)
+            title_counter.add_text(title)
+            return (body_counter.as_vector(), title, title_counter.as_vector())
+        return cached_for_version(self, "terms:%s:%s.%s" % (
+            ",".join(langs), body.id, subject.id), compute)
+
     def maybe_translate(self, pref_collection):
         from assembl.tasks.translate import (
             translate_content, PrefCollectionTranslationTable)
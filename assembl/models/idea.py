@@ -13,7 +13,8 @@ from future.utils import as_native_str
 from rdflib import URIRef
 from sqlalchemy.orm import (
     relationship, backref, aliased, contains_eager, joinedload, deferred,
-    column_property, with_polymorphic, remote, foreign)
+    column_property, with_polymorphic, remote, foreign, object_session)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm.attributes import NO_VALUE
 from sqlalchemy.sql import text, column
 from sqlalchemy.ext.declarative import declared_attr
@@ -43,9 +44,9 @@ from sqlalchemy.types import TIMESTAMP as Timestamp
 
 from ..lib.clean_input import sanitize_text
 from ..lib.utils import get_global_base_url
-from ..nlp.wordcounter import WordCounter
+from ..nlp.wordcounter import WordCounter, merge_term_vectors
 from . import (
-    DiscussionBoundBase, HistoryMixinWithOrigin, TimestampedMixin)
+    Base, DiscussionBoundBase, HistoryMixinWithOrigin, TimestampedMixin)
 from .discussion import Discussion
 from .uriref import URIRefDb
 from ..semantic.virtuoso_mapping import QuadMapPatternS
@@ -57,7 +58,7 @@ from .permissions import (
 from .langstrings import LangString, LangStringEntry
 from ..semantic.namespaces import (
     SIOC, IDEA, ASSEMBL, QUADNAMES, FOAF, RDF, VirtRDF)
-from ..lib.sqla import CrudOperation
+from ..lib.sqla import CrudOperation, get_session_maker
 from ..lib.model_watcher import get_model_watcher
 from .auth import AgentProfile
 from .publication_states import PublicationState, PublicationTransition
@@ -118,45 +119,48 @@ class AppendingVisitor(IdeaVisitor):
 
 
 class WordCountVisitor(IdeaVisitor):
-    """A Visitor that counts words related to an idea"""
+    """A Visitor that counts words related to an idea
+
+    Uses the cached term vectors of ideas and posts,
+    cf. :py:meth:`Idea.term_vector` and :py:meth:`Content.term_vectors`"""
 
     def __init__(self, langs, count_posts=True):
+        self.langs = tuple(langs)
         self.counter = WordCounter(langs)
-        self.count_posts = True
-
-    def cleantext(self, text):
-        return sanitize_text(text)
+        self.count_posts = count_posts
 
     def visit_idea(self, idea, level, prev_result, ctx=None):
-        if idea.short_title:
-            self.counter.add_text(self.cleantext(idea.short_title), 2)
-        if idea.long_title:
-            self.counter.add_text(self.cleantext(idea.long_title))
-        if idea.definition:
-            self.counter.add_text(self.cleantext(idea.definition))
+        self.counter.add_vector(idea.term_vector(self.langs))
         if self.count_posts and level == 0:
-            from .generic import Content
-            query = idea.db.query(Content)
-            related = idea.get_related_posts_query(True)
-            query = query.join(related, Content.id == related.c.post_id
-                               ).filter(Content.hidden == False,
-                                        Content.tombstone_condition()).options(
-                Content.subqueryload_options())
-            titles = set()
-            # TODO maparent: Group langstrings by language.
-            for content in query:
-                body = content.body.safe_best_entry_in_request().value
-                self.counter.add_text(self.cleantext(body), 0.5)
-                title = content.subject.safe_best_entry_in_request().value
-                title = self.cleantext(title)
-                if title not in titles:
-                    self.counter.add_text(title)
-                    titles.add(title)
+            self.counter.add_vector(
+                idea.related_posts_term_vector(self.langs))
 
     def best(self, num=8):
         return self.counter.best(num)
 
 
+class SubtreeTermVectorVisitor(IdeaVisitor):
+    """A Visitor on idea ids that merges the term vectors of the ideas
+    of each subtree, bottom-up, in a single pass over the tree."""
+
+    def __init__(self, ideas_by_id, langs):
+        self.ideas_by_id = ideas_by_id
+        self.langs = tuple(langs)
+        self.vectors = {}
+
+    def visit_idea(self, idea_id, level, prev_result, ctx=None):
+        return True
+
+    def end_visit(self, idea_id, level, prev_result, child_results, ctx=None):
+        idea = self.ideas_by_id.get(idea_id, None)
+        vectors = [r for (c, r) in child_results]
+        if idea is not None:
+            vectors.append(idea.term_vector(self.langs))
+        vector = merge_term_vectors(*vectors)
+        self.vectors[idea_id] = vector
+        return vector
+
+
 class HtmlizationVisitor(IdeaVisitor):
     def __init__(self, jinja_env, lang_prefs,
                  idea_template="idea_nakakoji.jinja2",
@@ -504,6 +508,25 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
     def get_ancestors_query_cls(
             cls, target_id=bindparam('root_id', type_=Integer),
             inclusive=True, tombstone_date=None):
+        if tombstone_date is not None:
+            return cls._get_ancestors_query_cte(
+                target_id, inclusive, tombstone_date)
+        closure = IdeaClosure.__table__
+        select_exp = select([closure.c.ancestor_id.label('id')])
+        if isinstance(target_id, list):
+            select_exp = select_exp.where(
+                closure.c.descendant_id.in_(target_id)).distinct()
+        else:
+            select_exp = select_exp.where(closure.c.descendant_id == target_id)
+        if not inclusive:
+            select_exp = select_exp.where(closure.c.depth > 0)
+        return select_exp.alias('ancestors')
+
+    @classmethod
+    def _get_ancestors_query_cte(
+            cls, target_id, inclusive=True, tombstone_date=None):
+        """Ancestors through the idea links of a given snapshot,
+        which are not in the :py:class:`IdeaClosure`."""
         if isinstance(target_id, list):
             root_condition = IdeaLink.target_id.in_(target_id)
         else:
@@ -557,42 +580,22 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
         from .announcement import IdeaAnnouncement
         if self.announcement:
             return self.announcement
-        aq = self.get_ancestors_query()
-        announcements = self.db.query(IdeaAnnouncement
-                                      ).filter(IdeaAnnouncement.idea_id.in_(aq),
-                                               IdeaAnnouncement.should_propagate_down == True
-                                               ).all()
-        # assume order is preserved from aq...
-        if announcements:
-            return announcements[-1]
+        closure = IdeaClosure.__table__
+        return self.db.query(IdeaAnnouncement).join(
+            closure, closure.c.ancestor_id == IdeaAnnouncement.idea_id
+        ).filter(closure.c.descendant_id == self.id,
+                 IdeaAnnouncement.should_propagate_down == True
+                 ).order_by(closure.c.depth).first()
 
     @classmethod
     def get_descendants_query_cls(
             cls, root_idea_id=bindparam('root_idea_id', type_=Integer),
             inclusive=True):
-        link = select(
-            [IdeaLink.source_id, IdeaLink.target_id]
-        ).select_from(
-            IdeaLink
-        ).where(
-            (IdeaLink.tombstone_date == None) &
-            (IdeaLink.source_id == root_idea_id)
-        ).cte(recursive=True)
-        source_alias = aliased(link)
-        targets_alias = aliased(IdeaLink)
-        parent_link = targets_alias.source_id == source_alias.c.target_id
-        children = select(
-            [targets_alias.source_id, targets_alias.target_id]
-        ).select_from(targets_alias).where(parent_link
-                                           & (targets_alias.tombstone_date == None))
-        with_children = link.union(children)
-        select_exp = select([with_children.c.target_id.label('id')]
-                            ).select_from(with_children)
-        if inclusive:
-            if isinstance(root_idea_id, int):
-                root_idea_id = literal_column(str(root_idea_id), Integer)
-            select_exp = select_exp.union(
-                select([root_idea_id.label('id')]))
+        closure = IdeaClosure.__table__
+        select_exp = select([closure.c.descendant_id.label('id')]).where(
+            closure.c.ancestor_id == root_idea_id)
+        if not inclusive:
+            select_exp = select_exp.where(closure.c.depth > 0)
         return select_exp.alias('descendants')
 
     def get_descendants_query(
@@ -636,12 +639,11 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
         from .generic import Content
         counters = cls.prepare_counters(discussion_id)
         if partial:
-            return counters.paths[root_idea_id].as_clause_base(
-                cls.default_db(), discussion_id, include_deleted=include_deleted)
+            return counters.clause_base(
+                root_idea_id, include_deleted=include_deleted)
         else:
-            return counters.paths[root_idea_id].as_clause(
-                cls.default_db(), discussion_id, counters.user_id, Content,
-                include_deleted=include_deleted)
+            return counters.clause(
+                root_idea_id, Content, include_deleted=include_deleted)
 
     @classmethod
     def get_discussion_data(cls, discussion_id, create=True):
@@ -818,10 +820,55 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
                 idea_visitor, visited, level+1, result)
         return idea_visitor.end_visit(self, level, prev_result, child_results)
 
+    def term_vector(self, langs):
+        """Stemmed term vector of this idea's own texts. Cached."""
+        from ..lib.jsonld_cache import cached_for_version
+        entry_ids = ".".join((
+            str(ls.safe_best_entry_in_request().id) if ls else "" for ls in
+            (self.title, self.synthesis_title, self.description)))
+
+        def compute():
+            counter = WordCounter(langs)
+            if self.short_title:
+                counter.add_text(sanitize_text(self.short_title), 2)
+            if self.long_title:
+                counter.add_text(sanitize_text(self.long_title))
+            if self.definition:
+                counter.add_text(sanitize_text(self.definition))
+            return counter.as_vector()
+        return cached_for_version(self, "terms:%s:%s" % (
+            ",".join(langs), entry_ids), compute)
+
+    def related_posts_term_vector(self, langs):
+        """Merged term vector of the posts related to this idea's subtree.
+
+        Post titles are only counted once."""
+        from .generic import Content
+        query = self.db.query(Content)
+        related = self.get_related_posts_query(True)
+        query = query.join(related, Content.id == related.c.post_id
+                           ).filter(Content.hidden == False,
+                                    Content.tombstone_condition()).options(
+            Content.subqueryload_options())
+        vectors = []
+        titles = set()
+        # TODO maparent: Group langstrings by language.
+        for content in query:
+            (body_vector, title, title_vector) = content.term_vectors(langs)
+            vectors.append(body_vector)
+            if title not in titles:
+                vectors.append(title_vector)
+                titles.add(title)
+        return merge_term_vectors(*vectors)
+
     def most_common_words(self, lang=None, num=8):
-        langs = (lang, ) if lang else self.discussion.discussion_locales
-        word_counter = WordCountVisitor(langs)
-        self.visit_ideas_depth_first(word_counter)
+        langs = tuple((lang, ) if lang else self.discussion.discussion_locales)
+        discussion_data = self.get_discussion_data(self.discussion_id)
+        ideas_vector = discussion_data.subtree_term_vectors(langs).get(
+            self.id, None)
+        word_counter = WordCounter(langs)
+        word_counter.add_vector(ideas_vector or self.term_vector(langs))
+        word_counter.add_vector(self.related_posts_term_vector(langs))
         return word_counter.best(num)
 
     @property
@@ -1059,36 +1106,10 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
     @classmethod
     def get_idea_ids_showing_post(cls, post_id):
         "Given a post, give the ID of the ideas that show this message"
-        from sqlalchemy.sql.functions import func
-        from .idea_content_link import IdeaContentPositiveLink
-        from .post import Post
-        (ancestry, discussion_id, idea_link_ids) = cls.default_db.query(
-            Post.ancestry, Post.discussion_id,
-            func.idea_content_links_above_post(Post.id)
-        ).filter(Post.id == post_id).first()
-        post_path = "%s%d," % (ancestry, post_id)
-        if not idea_link_ids:
-            return []
-        idea_link_ids = [int(id) for id in idea_link_ids.split(',') if id]
-        # This could be combined with previous in postgres.
-        root_ideas = cls.default_db.query(
-            IdeaContentPositiveLink.idea_id.distinct()
-        ).filter(
-            IdeaContentPositiveLink.idea_id != None,
-            IdeaContentPositiveLink.id.in_(idea_link_ids)).all()
-        if not root_ideas:
-            return []
-        root_ideas = [x for (x,) in root_ideas]
-        discussion_data = cls.get_discussion_data(discussion_id)
-        counter = cls.prepare_counters(discussion_id)
-        idea_contains = {}
-        for root_idea_id in root_ideas:
-            for idea_id in discussion_data.idea_ancestry(root_idea_id):
-                if idea_id in idea_contains:
-                    break
-                idea_contains[idea_id] = counter.paths[idea_id].includes_post(
-                    post_path)
-        return [id for (id, incl) in idea_contains.items() if incl]
+        from .path_utils import IdeaPostMembership
+        membership = IdeaPostMembership.__table__
+        return [id for (id,) in cls.default_db.query(
+            membership.c.idea_id).filter(membership.c.post_id == post_id)]
 
     @classmethod
     def idea_read_counts(cls, discussion_id, post_id, user_id):
@@ -1187,15 +1208,20 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
             return get_permissions(user_id, self.discussion_id, self)
 
     def extra_permissions_for(self, user_id):
-        from assembl.auth.util import get_permissions, permissions_for_state
+        from assembl.auth.util import (
+            get_permissions, permissions_for_state, permission_resolver_for)
         from pyramid.threadlocal import get_current_request
         request = get_current_request()
         if request.unauthenticated_userid != user_id:
             request = None
         base_permissions = request.base_permissions if request else get_permissions(
             user_id, self.discussion_id)
+        resolver = permission_resolver_for(
+            self.discussion_id, user_id) if request else None
         if request and request.main_target is self:
             permissions = request.permissions
+        elif resolver is not None:
+            permissions = resolver.permissions_for(self)
         elif not self.local_user_roles:
             if not self.pub_state_id:
                 return []
@@ -1779,6 +1805,160 @@ Idea.num_children = column_property(
     deferred=True)
 
 
+class IdeaClosure(Base):
+    """The transitive closure of the live idea hierarchy.
+
+    There is a row for each live idea and each of its live ancestors,
+    including itself at depth 0, with the length of the shortest path
+    between them. It is maintained by flush listeners on
+    :py:class:`Idea` and :py:class:`IdeaLink`, and can be rebuilt with
+    :py:mod:`assembl.scripts.rebuild_idea_closure`."""
+    __tablename__ = 'idea_closure'
+
+    # Guards against cycles in the hierarchy
+    MAX_DEPTH = 1000
+
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    ancestor_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True, index=True)
+    depth = Column(Integer, nullable=False)
+
+    _rebuild_statement = text("""
+        INSERT INTO idea_closure (
+            discussion_id, ancestor_id, descendant_id, depth)
+        WITH RECURSIVE live_link(source_id, target_id) AS (
+            SELECT idea_idea_link.source_id, idea_idea_link.target_id
+            FROM idea_idea_link
+            JOIN idea AS source ON source.id = idea_idea_link.source_id
+            JOIN idea AS target ON target.id = idea_idea_link.target_id
+            WHERE idea_idea_link.tombstone_date IS NULL
+            AND source.tombstone_date IS NULL
+            AND target.tombstone_date IS NULL
+            AND source.discussion_id = :discussion_id
+            AND target.discussion_id = :discussion_id
+        ), closure(ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM idea
+            WHERE discussion_id = :discussion_id AND tombstone_date IS NULL
+            UNION
+            SELECT closure.ancestor_id, live_link.target_id, closure.depth + 1
+            FROM closure
+            JOIN live_link ON live_link.source_id = closure.descendant_id
+            WHERE closure.depth < :max_depth
+        )
+        SELECT :discussion_id, ancestor_id, descendant_id, min(depth)
+        FROM closure GROUP BY ancestor_id, descendant_id""")
+
+    # First key of the advisory lock on a discussion's hierarchy
+    LOCK_CLASS = 0x1dea
+
+    @classmethod
+    def lock(cls, connection, discussion_id):
+        """Serialize the changes to the tables derived from the idea
+        hierarchy of a discussion, until the end of the transaction.
+
+        Without it, a concurrent rebuild could insert rows that this
+        transaction's rebuild did not delete."""
+        connection.execute(select([func.pg_advisory_xact_lock(
+            cls.LOCK_CLASS, discussion_id)]))
+
+    @classmethod
+    def rebuild(cls, connection, discussion_id):
+        "Recompute the closure of a discussion's idea hierarchy"
+        cls.lock(connection, discussion_id)
+        connection.execute(cls.__table__.delete().where(
+            cls.__table__.c.discussion_id == discussion_id))
+        connection.execute(cls._rebuild_statement, {
+            "discussion_id": discussion_id, "max_depth": cls.MAX_DEPTH})
+
+    @classmethod
+    def add_idea(cls, connection, idea_id, discussion_id):
+        cls.lock(connection, discussion_id)
+        connection.execute(pg_insert(cls.__table__).values(
+            discussion_id=discussion_id, ancestor_id=idea_id,
+            descendant_id=idea_id, depth=0).on_conflict_do_nothing())
+
+    @classmethod
+    def add_link(cls, connection, source_id, target_id):
+        "Connect the ancestors of the source to the descendants of the target"
+        table = cls.__table__
+        discussion_id = connection.execute(select([_it.c.discussion_id]).where(
+            _it.c.id == source_id)).scalar()
+        if discussion_id is not None:
+            cls.lock(connection, discussion_id)
+        above = table.alias('above')
+        below = table.alias('below')
+        statement = pg_insert(table).from_select(
+            ['discussion_id', 'ancestor_id', 'descendant_id', 'depth'],
+            select([above.c.discussion_id, above.c.ancestor_id,
+                    below.c.descendant_id,
+                    above.c.depth + below.c.depth + 1]).where(
+                (above.c.descendant_id == source_id)
+                & (below.c.ancestor_id == target_id)
+                & (below.c.discussion_id == above.c.discussion_id)))
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.ancestor_id, table.c.descendant_id],
+            set_={"depth": func.least(table.c.depth, statement.excluded.depth)}))
+
+
+def _rebuild_closure_after_flush(connection, target, discussion_id=None):
+    session = object_session(target)
+    if discussion_id is None:
+        discussion_id = connection.execute(select([_it.c.discussion_id]).where(
+            _it.c.id == target.source_id)).scalar()
+    if session is not None and discussion_id is not None:
+        session.info.setdefault('idea_closure_rebuilds', set()).add(
+            discussion_id)
+
+
+@event.listens_for(Idea, 'after_insert', propagate=True)
+def idea_closure_add_idea(mapper, connection, target):
+    if target.tombstone_date is None:
+        IdeaClosure.add_idea(connection, target.id, target.discussion_id)
+
+
+@event.listens_for(Idea, 'after_update', propagate=True)
+def idea_closure_update_idea(mapper, connection, target):
+    if inspect(target).attrs.tombstone_date.history.has_changes():
+        _rebuild_closure_after_flush(
+            connection, target, target.discussion_id)
+
+
+@event.listens_for(Idea, 'after_delete', propagate=True)
+def idea_closure_delete_idea(mapper, connection, target):
+    _rebuild_closure_after_flush(connection, target, target.discussion_id)
+
+
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+def idea_closure_add_link(mapper, connection, target):
+    if target.tombstone_date is None:
+        IdeaClosure.add_link(connection, target.source_id, target.target_id)
+
+
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+def idea_closure_update_link(mapper, connection, target):
+    attrs = inspect(target).attrs
+    if (attrs.tombstone_date.history.has_changes()
+            or attrs.source_id.history.has_changes()
+            or attrs.target_id.history.has_changes()):
+        _rebuild_closure_after_flush(connection, target)
+
+
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def idea_closure_delete_link(mapper, connection, target):
+    _rebuild_closure_after_flush(connection, target)
+
+
+@event.listens_for(get_session_maker(), "after_flush")
+def idea_closure_rebuild(session, flush_context):
+    for discussion_id in session.info.pop('idea_closure_rebuilds', ()):
+        IdeaClosure.rebuild(session, discussion_id)
+
+
 class IdeaLocalUserRole(AbstractLocalUserRole):
     """The role that a user has in the context of a discussion"""
     __tablename__ = 'idea_user_role'
@@ -718,6 +718,10 @@ class LangStringEntry(TombstonableMixin, Base):
         doc="Type of error from the translation server")
     # tombstone_date = Column(DateTime) implicit from Tombstonable mixin
     value = Column(UnicodeText)
+    preview = Column(
+        UnicodeText,
+        doc="Short text version of the value, for post bodies. "
+            "Cf. :py:meth:`assembl.models.post.Post.get_body_preview`")
 
     def __bool__(self):
         return bool(self.value)
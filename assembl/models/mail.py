@@ -40,7 +40,7 @@ from ..lib.sqla_types import (CoerceUnicode, EmailString)
 
 from .langstrings import LangString
 from .generic import PostSource
-from .post import ImportedPost
+from .post import Post, ImportedPost
 from .auth import EmailAccount
 from .attachment import File, PostAttachment, AttachmentPurpose
 from ..tasks.imap import import_mails
@@ -596,6 +596,8 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
         for container in threaded_emails:
             jwzthreading.print_container(container, 0, True)
 
+        new_parents = {}
+
         def update_threading(threaded_emails, debug=False):
             log.debug("\n\nEntering update_threading() for %ld mails:" % len(threaded_emails))
             for container in threaded_emails:
@@ -635,7 +637,7 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
                             log.debug("UPDATING PARENT for :" + repr(message.message.message_id))
                             new_parent = parent_message.message if algorithm_parent_message_id else None
                             log.debug(repr(new_parent))
-                            message.message.set_parent(new_parent)
+                            new_parents[message.message] = new_parent
                         else:
                             log.debug("Skipped reparenting:  the current parent "
                                       "isn't an email, the threading algorithm only "
@@ -645,6 +647,9 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
                     log.debug("Current message ID: None, was a dummy container")
                     update_threading(container.children, debug=debug)
         update_threading(threaded_emails, debug=False)
+        if new_parents:
+            # reparent all at once, with set-based ancestry updates
+            Post.set_parents(emails[0].db, new_parents)
 
     def reprocess_content(self):
         """ Allows re-parsing all content as if it were imported for the first time
@@ -665,14 +670,18 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
             self.thread_mails(emails)
 
     def import_content(self, only_new=True):
+        assert self.id
+        self.dispatch_import(self.id, only_new)
+
+    @classmethod
+    def dispatch_import(cls, source_id, only_new=True):
         from assembl.lib.config import get_config
         from pyramid.settings import asbool
-        assert self.id
         config = get_config()
         if asbool(config.get('use_source_reader_for_mail', False)):
-            super(AbstractMailbox, self).import_content(only_new)
+            super(AbstractMailbox, cls).dispatch_import(source_id, only_new)
         else:
-            import_mails.delay(self.id, only_new)
+            import_mails.delay(source_id, only_new)
 
     _address_match_re = re.compile(
         r'[\w\-][\w\-\.]+@[\w\-][\w\-\.]+[a-zA-Z]{1,4}'
@@ -5,13 +5,16 @@ from builtins import range
 from builtins import object
 from functools import total_ordering
 from collections import defaultdict
+from itertools import chain
 from bisect import bisect_right
 
 from future.utils import as_native_str
-from sqlalchemy import String
-from sqlalchemy.orm import (with_polymorphic, aliased)
-from sqlalchemy.sql.expression import or_, union, except_
+from sqlalchemy import String, Column, Integer, ForeignKey, event, inspect
+from sqlalchemy.orm import (with_polymorphic, aliased, object_session)
+from sqlalchemy.sql.expression import (
+    or_, union, except_, select, literal, exists)
 from sqlalchemy.sql.functions import count
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from .idea_content_link import (
     IdeaContentLink, IdeaContentPositiveLink, IdeaContentNegativeLink)
@@ -19,9 +22,13 @@ from .post import (
     Post, Content, SynthesisPost,
     countable_publication_states, deleted_publication_states)
 from .annotation import Webpage
-from .idea import IdeaVisitor, Idea, IdeaLink, RootIdea
+from .idea import (
+    IdeaVisitor, Idea, IdeaLink, IdeaClosure, RootIdea,
+    SubtreeTermVectorVisitor)
 from .discussion import Discussion
 from .action import ViewPost
+from . import Base
+from ..lib.sqla import get_session_maker
 
 # TODO: Write a discussion structure cache manager.
 # This will have caches of parent, children, counts, etc. at need
@@ -325,34 +332,81 @@ class PostPathLocalCollection(object):
     def as_clause(self, db, discussion_id, user_id=None, content=None,
                   include_deleted=False):
         subq = self.as_clause_base(db, discussion_id, include_deleted=include_deleted)
-        content = content or with_polymorphic(
-            Content, [], Content.__table__,
-            aliased=False)
-
-        q = db.query(content).filter(
-                (content.discussion_id == discussion_id)
-                & (content.hidden == False)
-                ).join(subq, content.id == subq.c.post_id)
-        if include_deleted is not None:
-            if include_deleted:
-                post = with_polymorphic(
-                    Post, [], Post.__table__.alias("post_del"),
-                    aliased=False)
-                q = q.join(
-                    post, (post.id == content.id) &
-                    post.publication_state.in_(deleted_publication_states))
-            else:
-                q = q.filter(content.tombstone_date == None)
+        return related_content_query(
+            db, discussion_id, subq, user_id, content, include_deleted)
+
+
+def related_content_query(
+        db, discussion_id, subq, user_id=None, content=None,
+        include_deleted=False):
+    """The visible content whose id is in the post_id column of subq,
+    with the user's ViewPost ids if a user_id is given."""
+    content = content or with_polymorphic(
+        Content, [], Content.__table__,
+        aliased=False)
+
+    q = db.query(content).filter(
+            (content.discussion_id == discussion_id)
+            & (content.hidden == False)
+            ).join(subq, content.id == subq.c.post_id)
+    if include_deleted is not None:
+        if include_deleted:
+            post = with_polymorphic(
+                Post, [], Post.__table__.alias("post_del"),
+                aliased=False)
+            q = q.join(
+                post, (post.id == content.id) &
+                post.publication_state.in_(deleted_publication_states))
+        else:
+            q = q.filter(content.tombstone_date == None)
+
+    if user_id:
+        # subquery?
+        q = q.outerjoin(
+            ViewPost,
+            (ViewPost.post_id == content.id)
+            & (ViewPost.tombstone_date == None)
+            & (ViewPost.actor_id == user_id)
+            ).add_columns(ViewPost.id)
+    return q
+
+
+def orphan_content_query(
+        db, discussion_id, subq, user_id=None, content=None,
+        include_deleted=False):
+    """The visible content whose id is not in the post_id column of subq,
+    excluding syntheses and webpages."""
+    content = content or with_polymorphic(
+        Content, [], Content.__table__,
+        aliased=False)
+
+    synth_post_type = SynthesisPost.__mapper_args__['polymorphic_identity']
+    webpage_post_type = Webpage.__mapper_args__['polymorphic_identity']
+    q = db.query(content.id.label("post_id")).filter(
+            (content.discussion_id == discussion_id)
+            & (content.hidden == False)
+            & (content.type.notin_((synth_post_type, webpage_post_type)))
+            & content.id.notin_(subq))
+    if include_deleted is not None:
+        if include_deleted:
+            post = with_polymorphic(
+                Post, [], Post.__table__,
+                aliased=False)
+            q = q.join(
+                post, (post.id == content.id) &
+                post.publication_state.in_(deleted_publication_states))
+        else:
+            q = q.filter(content.tombstone_date == None)
 
-        if user_id:
-            # subquery?
-            q = q.outerjoin(
-                ViewPost,
-                (ViewPost.post_id == content.id)
-                & (ViewPost.tombstone_date == None)
-                & (ViewPost.actor_id == user_id)
-                ).add_columns(ViewPost.id)
-        return q
+    if user_id:
+        # subquery?
+        q = q.outerjoin(
+            ViewPost,
+            (ViewPost.post_id == content.id)
+            & (ViewPost.tombstone_date == None)
+            & (ViewPost.actor_id == user_id)
+            ).add_columns(ViewPost.id)
+    return q
 
 
 class PostPathGlobalCollection(object):
@@ -438,60 +492,308 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         root_path = self.paths[self.root_idea_id]
         db = self.discussion.default_db
         subq = root_path.as_clause_base(db, self.discussion.id, include_deleted=include_deleted)
-        content = content or with_polymorphic(
+        return orphan_content_query(
+            db, self.discussion.id, subq, user_id, content, include_deleted)
+
+
+class IdeaPostMembership(Base):
+    """The posts shown by each idea, i.e. the result of combining the
+    post paths of the idea's subtree with :py:class:`PostPathCombiner`.
+
+    Negative paths are resolved when the rows are computed, so only the
+    included posts are stored, whatever their publication state.
+    Rows are inherited by new posts from their parent, and recomputed
+    when content links, the idea hierarchy or post ancestries change."""
+    __tablename__ = 'idea_post_membership'
+
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    post_id = Column(Integer, ForeignKey(
+        Post.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True, index=True)
+
+    @classmethod
+    def refresh(cls, db, discussion_id, idea_ids=None):
+        """Recompute the rows of a discussion, or those of the given ideas
+        and their ancestors.
+
+        Only the ideas with content links in their subtree are traversed,
+        as the others show no posts."""
+        table = cls.__table__
+        closure = IdeaClosure.__table__
+        icl = IdeaContentLink.__table__
+        condition = table.c.discussion_id == discussion_id
+        if idea_ids is not None:
+            idea_ids = set(idea_ids)
+            if not idea_ids:
+                return
+            idea_ids.update(id for (id,) in db.execute(
+                select([closure.c.ancestor_id]).where(
+                    closure.c.descendant_id.in_(list(idea_ids)))))
+            condition = condition & table.c.idea_id.in_(list(idea_ids))
+        IdeaClosure.lock(db, discussion_id)
+        db.execute(table.delete().where(condition))
+        discussion = db.query(Discussion).get(discussion_id)
+        root_id = db.query(RootIdea.id).filter_by(
+            discussion_id=discussion_id, tombstone_date=None).scalar()
+        if discussion is None or root_id is None:
+            return
+        # Unlike Idea.children_dict, tolerate a hierarchy that is
+        # being modified: detached subtrees are not visited.
+        children = defaultdict(list)
+        source = aliased(Idea, name="source")
+        target = aliased(Idea, name="target")
+        linked_subtrees = select([closure.c.ancestor_id]).select_from(
+            closure.join(icl, icl.c.idea_id == closure.c.descendant_id)
+        ).where(closure.c.discussion_id == discussion_id)
+        for (child, parent) in db.query(
+                IdeaLink.target_id, IdeaLink.source_id
+                ).join(source, source.id == IdeaLink.source_id
+                ).join(target, target.id == IdeaLink.target_id
+                ).filter(
+                    source.discussion_id == discussion_id,
+                    target.discussion_id == discussion_id,
+                    IdeaLink.tombstone_date == None,
+                    source.tombstone_date == None,
+                    target.tombstone_date == None,
+                    target.id.in_(linked_subtrees)):
+            children[parent].append(child)
+        children[None] = [root_id]
+        combiner = PostPathCombiner(discussion)
+        Idea.visit_idea_ids_depth_first(combiner, discussion_id, children)
+        visited = set()
+        to_visit = [root_id]
+        while to_visit:
+            idea_id = to_visit.pop()
+            if idea_id not in visited:
+                visited.add(idea_id)
+                to_visit.extend(children[idea_id])
+        if idea_ids is not None:
+            visited &= idea_ids
+        for idea_id in visited:
+            paths = combiner.paths.get(idea_id, None)
+            if not paths:
+                continue
+            posts = paths.as_clause_base(
+                db, discussion_id, include_deleted=None)
+            db.execute(table.insert().from_select(
+                ['discussion_id', 'idea_id', 'post_id'],
+                select([literal(discussion_id), literal(idea_id),
+                        posts.c.post_id])))
+
+    @classmethod
+    def inherit(cls, connection, post_id, parent_id):
+        """A new post without content links is shown by the same ideas
+        as its parent"""
+        table = cls.__table__
+        connection.execute(pg_insert(table).from_select(
+            ['discussion_id', 'idea_id', 'post_id'],
+            select([table.c.discussion_id, table.c.idea_id,
+                    literal(post_id)]).where(table.c.post_id == parent_id)
+        ).on_conflict_do_nothing())
+
+
+def _refresh_membership_after_flush(
+        connection, target, discussion_id, idea_ids):
+    """Schedule a refresh of some ideas of a discussion, and of their
+    current ancestors; the ancestors after the flush are added then."""
+    session = object_session(target)
+    idea_ids = {id for id in idea_ids if id is not None}
+    if session is None or discussion_id is None or not idea_ids:
+        return
+    closure = IdeaClosure.__table__
+    idea_ids.update(id for (id,) in connection.execute(
+        select([closure.c.ancestor_id]).where(
+            closure.c.descendant_id.in_(list(idea_ids)))))
+    refreshes = session.info.setdefault('idea_post_membership_refresh', {})
+    refreshes.setdefault(discussion_id, set()).update(idea_ids)
+
+
+def _idea_discussion_id(connection, idea_id):
+    _it = Idea.__table__
+    return connection.execute(select([_it.c.discussion_id]).where(
+        _it.c.id == idea_id)).scalar()
+
+
+def _shows_posts(connection, idea_ids):
+    "Whether any of these ideas, or their descendants, has content links"
+    closure = IdeaClosure.__table__
+    icl = IdeaContentLink.__table__
+    idea_ids = [id for id in idea_ids if id is not None]
+    if not idea_ids:
+        return False
+    return connection.execute(select([exists().where(
+        icl.c.idea_id.in_(idea_ids) | icl.c.idea_id.in_(
+            select([closure.c.descendant_id]).where(
+                closure.c.ancestor_id.in_(idea_ids))))])).scalar()
+
+
+@event.listens_for(Post, 'after_insert', propagate=True)
+def membership_add_post(mapper, connection, target):
+    if target.parent_id is not None:
+        IdeaPostMembership.inherit(connection, target.id, target.parent_id)
+
+
+# Post.set_parents refreshes the ideas showing reparented posts.
+@event.listens_for(Content, 'after_update', propagate=True)
+def membership_update_content(mapper, connection, target):
+    # The rows do not depend on whether posts are hidden,
+    # but content links from hidden posts are ignored.
+    if not inspect(target).attrs.hidden.history.has_changes():
+        return
+    icl = IdeaContentLink.__table__
+    idea_ids = [id for (id,) in connection.execute(
+        select([icl.c.idea_id]).where(
+            (icl.c.content_id == target.id) & (icl.c.idea_id != None)))]
+    _refresh_membership_after_flush(
+        connection, target, target.discussion_id, idea_ids)
+
+
+@event.listens_for(IdeaContentLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaContentLink, 'after_delete', propagate=True)
+def membership_add_or_delete_link(mapper, connection, target):
+    if target.idea_id is not None:
+        _refresh_membership_after_flush(
+            connection, target,
+            _idea_discussion_id(connection, target.idea_id),
+            (target.idea_id,))
+
+
+@event.listens_for(IdeaContentLink, 'after_update', propagate=True)
+def membership_update_link(mapper, connection, target):
+    attrs = inspect(target).attrs
+    idea_history = attrs.idea_id.history
+    if not (idea_history.has_changes()
+            or attrs.content_id.history.has_changes()
+            or attrs.type.history.has_changes()):
+        return
+    idea_ids = {id for id in chain(
+        idea_history.deleted or (), (target.idea_id,)) if id is not None}
+    if idea_ids:
+        _refresh_membership_after_flush(
+            connection, target,
+            _idea_discussion_id(connection, next(iter(idea_ids))),
+            idea_ids)
+
+
+# Moving or removing a subtree without content links changes no rows;
+# otherwise, the ancestors of its old and new parent are refreshed.
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def membership_add_or_delete_idea_link(mapper, connection, target):
+    if _shows_posts(connection, (target.target_id,)):
+        _refresh_membership_after_flush(
+            connection, target,
+            _idea_discussion_id(connection, target.source_id),
+            (target.source_id,))
+
+
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+def membership_update_idea_link(mapper, connection, target):
+    attrs = inspect(target).attrs
+    source_history = attrs.source_id.history
+    target_history = attrs.target_id.history
+    if not (attrs.tombstone_date.history.has_changes()
+            or source_history.has_changes()
+            or target_history.has_changes()):
+        return
+    if _shows_posts(connection, chain(
+            target_history.deleted or (), (target.target_id,))):
+        _refresh_membership_after_flush(
+            connection, target,
+            _idea_discussion_id(connection, target.source_id),
+            chain(source_history.deleted or (), (target.source_id,)))
+
+
+@event.listens_for(Idea, 'after_update', propagate=True)
+def membership_update_idea(mapper, connection, target):
+    # A restored idea is not in the closure yet
+    if inspect(target).attrs.tombstone_date.history.has_changes() and (
+            target.tombstone_date is None
+            or _shows_posts(connection, (target.id,))):
+        _refresh_membership_after_flush(
+            connection, target, target.discussion_id, (target.id,))
+
+
+# before the closure rows of the idea are deleted
+@event.listens_for(Idea, 'before_delete', propagate=True)
+def membership_delete_idea(mapper, connection, target):
+    if _shows_posts(connection, (target.id,)):
+        _refresh_membership_after_flush(
+            connection, target, target.discussion_id, (target.id,))
+
+
+@event.listens_for(get_session_maker(), "after_flush")
+def membership_refresh(session, flush_context):
+    refreshes = session.info.pop('idea_post_membership_refresh', {})
+    for discussion_id, idea_ids in refreshes.items():
+        IdeaPostMembership.refresh(session, discussion_id, idea_ids)
+
+
+class PostMembershipCounter(object):
+    """Which posts each idea shows, and how many, from the
+    :py:class:`IdeaPostMembership` table."""
+    def __init__(self, discussion, user_id=None, calc_all=False):
+        self.discussion = discussion
+        self.user_id = user_id
+        self.counts = {}
+        self.all_counted = False
+        self._paths = None
+        if calc_all:
+            self.get_all_counts()
+
+    @property
+    def root_idea_id(self):
+        return self.discussion.root_idea.id
+
+    @property
+    def paths(self):
+        """The combined post paths of each idea,
+        from which the membership was computed"""
+        if self._paths is None:
+            combiner = PostPathCombiner(self.discussion)
+            Idea.visit_idea_ids_depth_first(combiner, self.discussion.id)
+            self._paths = combiner.paths
+        return self._paths
+
+    def clause_base(self, idea_id, include_deleted=False):
+        """The ids of the posts shown by an idea, as a subquery
+        (cf. :py:meth:`PostPathLocalCollection.as_clause_base`)"""
+        db = self.discussion.db
+        membership = IdeaPostMembership.__table__
+        post = with_polymorphic(
+            Post, [], Post.__table__,
+            aliased=False)
+        content = with_polymorphic(
             Content, [], Content.__table__,
             aliased=False)
-
-        synth_post_type = SynthesisPost.__mapper_args__['polymorphic_identity']
-        webpage_post_type = Webpage.__mapper_args__['polymorphic_identity']
-        q = db.query(content.id.label("post_id")).filter(
-                (content.discussion_id == self.discussion.id)
-                & (content.hidden == False)
-                & (content.type.notin_((synth_post_type, webpage_post_type)))
-                & content.id.notin_(subq))
+        query = db.query(post.id.label("post_id")).join(
+            content, (content.id == post.id) &
+            (content.discussion_id == self.discussion.id)
+        ).join(membership, membership.c.post_id == post.id
+        ).filter(membership.c.idea_id == idea_id)
         if include_deleted is not None:
             if include_deleted:
-                post = with_polymorphic(
-                    Post, [], Post.__table__,
-                    aliased=False)
-                q = q.join(
-                    post, (post.id == content.id) &
+                query = query.filter(
                     post.publication_state.in_(deleted_publication_states))
             else:
-                q = q.filter(content.tombstone_date == None)
+                query = query.filter(content.tombstone_date == None)
+        return query.subquery("relposts")
 
-        if user_id:
-            # subquery?
-            q = q.outerjoin(
-                ViewPost,
-                (ViewPost.post_id == content.id)
-                & (ViewPost.tombstone_date == None)
-                & (ViewPost.actor_id == user_id)
-                ).add_columns(ViewPost.id)
-        return q
-
-
-class PostPathCounter(PostPathCombiner):
-    "Adds the ability to do post counts to PostPathCombiner."
-    def __init__(self, discussion, user_id=None, calc_subset=None):
-        super(PostPathCounter, self).__init__(discussion)
-        self.counts = {}
-        self.viewed_counts = {}
-        self.read_counts = {}
-        self.contributor_counts = {}
-        self.user_id = user_id
-        self.calc_subset = calc_subset
+    def clause(self, idea_id, content=None, include_deleted=False):
+        return related_content_query(
+            self.discussion.db, self.discussion.id,
+            self.clause_base(idea_id, include_deleted),
+            self.user_id, content, include_deleted)
 
-    def copy_result(self, idea_id, parent_result, child_result):
-        # When the parent has no information, and can get it from a single child
-        super(PostPathCounter, self).copy_result(
-            idea_id, parent_result, child_result)
-        if getattr(parent_result, "count", None) is None:
-            return
-        parent_result.count = child_result.count
-        parent_result.viewed_count = child_result.viewed_count
-        self.counts[idea_id] = parent_result.count
-        self.viewed_counts[idea_id] = parent_result.viewed_count
+    def orphan_clause(self, user_id=None, content=None, include_deleted=False):
+        return orphan_content_query(
+            self.discussion.db, self.discussion.id,
+            self.clause_base(self.root_idea_id, include_deleted),
+            user_id, content, include_deleted)
 
     def get_counts_for_query(self, q):
         # HACKITY HACK
@@ -519,53 +821,54 @@ class PostPathCounter(PostPathCombiner):
             return (post_count, contributor_count, 0)
 
     def get_counts(self, idea_id):
-        if self.counts.get(idea_id, None) is not None:
-            return (
-                self.counts[idea_id],
-                self.contributor_counts[idea_id],
-                self.viewed_counts[idea_id])
-        path_collection = self.paths[idea_id]
-        if not path_collection:
-            (
-                path_collection.count,
-                path_collection.contributor_count,
-                path_collection.viewed_count
-            ) = (0, 0, 0)
-            self.counts[idea_id] = 0
-            self.contributor_counts[idea_id] = 0
-            self.viewed_counts[idea_id] = 0
-            return (0, 0, 0)
-        q = path_collection.as_clause(
-            self.discussion.db, self.discussion.id, user_id=self.user_id,
-            include_deleted=None)
-        (
-            post_count, contributor_count, viewed_count
-        ) = self.get_counts_for_query(q)
-        (
-            path_collection.count,
-            path_collection.contributor_count,
-            path_collection.viewed_count
-        ) = (
-            post_count, contributor_count, viewed_count
-        )
-        self.counts[idea_id] = post_count
-        self.viewed_counts[idea_id] = viewed_count
-        self.contributor_counts[idea_id] = contributor_count
-        return (post_count, contributor_count, viewed_count)
+        "The post, contributor and viewed post counts of an idea"
+        if idea_id not in self.counts:
+            if self.all_counted:
+                return (0, 0, 0)
+            self.counts[idea_id] = tuple(self.get_counts_for_query(
+                self.clause(idea_id, include_deleted=None)))
+        return self.counts[idea_id]
+
+    def get_all_counts(self):
+        "Count the posts of all the ideas of the discussion at once"
+        db = self.discussion.db
+        discussion_id = self.discussion.id
+        membership = IdeaPostMembership.__table__
+        content = with_polymorphic(
+            Content, [], Content.__table__,
+            aliased=False)
+        post = with_polymorphic(
+            Post, [], Post.__table__,
+            aliased=False)
+        columns = [membership.c.idea_id, count(content.id),
+                   count(post.creator_id.distinct())]
+        if self.user_id:
+            columns.append(count(ViewPost.id))
+        q = db.query(*columns).join(
+            content, content.id == membership.c.post_id
+        ).join(post, post.id == content.id
+        ).filter(
+            membership.c.discussion_id == discussion_id,
+            content.discussion_id == discussion_id,
+            content.hidden == False,
+            post.publication_state.in_(countable_publication_states))
+        if self.user_id:
+            q = q.outerjoin(
+                ViewPost,
+                (ViewPost.post_id == content.id)
+                & (ViewPost.tombstone_date == None)
+                & (ViewPost.actor_id == self.user_id))
+        for row in q.group_by(membership.c.idea_id):
+            counts = tuple(row[1:])
+            if not self.user_id:
+                counts += (0,)
+            self.counts[row[0]] = counts
+        self.all_counted = True
 
     def get_orphan_counts(self, include_deleted=False):
         return self.get_counts_for_query(
             self.orphan_clause(self.user_id, include_deleted=include_deleted))
 
-    def end_visit(self, idea_id, level, result, child_results):
-        if isinstance(idea_id, Idea):
-            idea_id = idea_id.id
-        result = super(PostPathCounter, self).end_visit(
-            idea_id, level, result, child_results)
-        if self.calc_subset is None or (idea_id in self.calc_subset):
-            self.get_counts(idea_id)
-        return result
-
 
 class DiscussionGlobalData(object):
     "Cache for global discussion data, lasts as long as the pyramid request object."
@@ -576,8 +879,8 @@ class DiscussionGlobalData(object):
         self._discussion = discussion
         self._parent_dict = None
         self._children_dict = None
-        self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._subtree_term_vectors = {}
 
     @property
     def discussion(self):
@@ -629,29 +932,33 @@ class DiscussionGlobalData(object):
             self._children_dict = children
         return self._children_dict
 
-    @property
-    def post_path_collection_raw(self):
-        if self._post_path_collection_raw is None:
-            self._post_path_collection_raw = PostPathGlobalCollection(self.discussion)
-        return self._post_path_collection_raw
-
     def post_path_counter(self, user_id, calc_all):
-        if (self._post_path_counter is None
-                or not isinstance(self._post_path_counter, PostPathCounter)):
-            collection = self.post_path_collection_raw
-            counter = PostPathCounter(
-                self.discussion, user_id, None if calc_all else ())
-            counter.init_from(self.post_path_collection_raw)
-            Idea.visit_idea_ids_depth_first(
-                counter, self.discussion_id, self.children_dict)
-            self._post_path_counter = counter
+        if self._post_path_counter is None:
+            self._post_path_counter = PostMembershipCounter(
+                self.discussion, user_id, calc_all)
+        elif calc_all and not self._post_path_counter.all_counted:
+            self._post_path_counter.get_all_counts()
         return self._post_path_counter
 
+    def subtree_term_vectors(self, langs):
+        """dictionary idea.id -> merged term vector of the ideas
+        in its subtree (posts excluded)"""
+        langs = tuple(langs)
+        if langs not in self._subtree_term_vectors:
+            ideas = self.db.query(Idea).filter_by(
+                discussion_id=self.discussion_id, tombstone_date=None)
+            visitor = SubtreeTermVectorVisitor(
+                {idea.id: idea for idea in ideas}, langs)
+            Idea.visit_idea_ids_depth_first(
+                visitor, self.discussion_id, self.children_dict)
+            self._subtree_term_vectors[langs] = visitor.vectors
+        return self._subtree_term_vectors[langs]
+
     def reset_hierarchy(self):
         self._parent_dict = None
         self._children_dict = None
         self._post_path_counter = None
+        self._subtree_term_vectors = {}
 
     def reset_content_links(self):
-        self._post_path_collection_raw = None
         self._post_path_counter = None
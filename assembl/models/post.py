@@ -3,6 +3,8 @@ from builtins import str
 from builtins import object
 from datetime import datetime
 from abc import ABCMeta, abstractmethod
+from collections import defaultdict, Counter
+from itertools import chain
 import uuid
 import logging
 
@@ -20,13 +22,20 @@ from sqlalchemy import (
     Index,
     or_,
     event,
-    func
+    func,
+    inspect,
+    select,
+    literal,
+    text,
 )
 from sqlalchemy.dialects.postgresql import BYTEA as Binary
 from sqlalchemy.orm import (
-    relationship, backref, deferred, column_property, with_polymorphic)
+    relationship, backref, deferred, column_property, with_polymorphic,
+    object_session)
 
-from ..lib.sqla import CrudOperation, DuplicateHandling
+from ..lib.sqla import (
+    CrudOperation, DuplicateHandling, get_session_maker,
+    mark_changed)
 from ..lib.decl_enums import DeclEnum
 from ..semantic.virtuoso_mapping import QuadMapPatternS
 from ..lib.sqla_types import CoerceUnicode
@@ -110,11 +119,19 @@ class Post(Content):
 
     ancestry = Column(String, default="")
 
+    # The latest creation or edition date of this post and its descendants
+    last_activity = Column(DateTime)
+
     __table_args__ = (
          Index(
             'ix_%s_post_ancestry' % (Content.full_schema,),
             'ancestry', unique=False,
-            postgresql_ops={'ancestry': 'varchar_pattern_ops'}),)
+            postgresql_ops={'ancestry': 'varchar_pattern_ops'}),
+         # threads ordered by last activity
+         Index(
+            'ix_%s_post_thread_last_activity' % (Content.full_schema,),
+            'last_activity', unique=False,
+            postgresql_where=text('parent_id IS NULL')),)
 
     parent_id = Column(Integer, ForeignKey(
         'post.id',
@@ -213,12 +230,41 @@ class Post(Content):
                 shortened = html_len < len(text)
                 text = pure_text
                 break
-            html_len += target_len
+            # double the prefix, so long HTML is sanitized O(log n) times
+            html_len *= 2
         text = Post.shorten_text(text)
         if shortened and text[-1] != ' ':
             text += ' '
         return text
 
+    # The length of body previews. Run scripts/rebuild_post_previews.py
+    # after changing it.
+    PREVIEW_LENGTH = 120
+
+    def make_preview(self, value, is_html=None):
+        if not value:
+            return value
+        if is_html is None:
+            is_html = self.get_body_mime_type() == 'text/html'
+        if is_html:
+            return self.shorten_html_text(value, self.PREVIEW_LENGTH)
+        return self.shorten_text(value, self.PREVIEW_LENGTH)
+
+    def entry_preview(self, entry, is_html=None):
+        """The stored preview of a body entry, or a new one if absent."""
+        if entry.preview is not None:
+            return entry.preview
+        return self.make_preview(entry.value, is_html)
+
+    def update_body_previews(self, entries=None):
+        """Store the previews of the given body entries (default: all)."""
+        body = self.get_body()
+        if body is None:
+            return
+        is_html = self.get_body_mime_type() == 'text/html'
+        for entry in (body.entries if entries is None else entries):
+            entry.preview = self.make_preview(entry.value, is_html)
+
     def get_body_preview(self):
         if self.publication_state in moderated_publication_states:
             # TODO: Handle multilingual moderation
@@ -231,12 +277,7 @@ class Post(Content):
         ls = LangString()
         shortened = False
         for entry in body.entries:
-            if not entry.value:
-                short = entry.value
-            elif is_html:
-                short = self.shorten_html_text(entry.value)
-            else:
-                short = self.shorten_text(entry.value)
+            short = self.entry_preview(entry, is_html)
             if short != entry.value:
                 shortened = True
             _ = LangStringEntry(
@@ -255,15 +296,11 @@ class Post(Content):
         body = self.get_body()
         if not body:
             return None
-        body = body.first_original().value
+        entry = body.first_original()
+        body = entry.value
         is_html = self.get_body_mime_type() == 'text/html'
         shortened = False
-        if not body:
-            short = body
-        elif is_html:
-            short = self.shorten_html_text(body)
-        else:
-            short = self.shorten_text(body)
+        short = self.entry_preview(entry, is_html)
         if short != body:
             shortened = True
         if shortened or is_html:
@@ -271,29 +308,136 @@ class Post(Content):
         else:
             return body
 
-    def _set_ancestry(self, new_ancestry):
-        self.ancestry = new_ancestry
+    @classmethod
+    def _move_subtree(cls, connection, post_id, new_ancestry=None):
+        """Set the ancestry of a post, and rewrite the ancestry of all its
+        descendants, with a single statement.
+
+        :param new_ancestry: default: computed from the parent in the database
+        :returns: the ids and types of the descendants"""
+        post_table = Post.__table__
+        content_table = Content.__table__
+        parent = post_table.alias('parent')
+        (old_ancestry, parent_id, parent_ancestry) = connection.execute(
+            select([post_table.c.ancestry, post_table.c.parent_id,
+                    parent.c.ancestry]).select_from(post_table.outerjoin(
+                        parent, parent.c.id == post_table.c.parent_id)
+            ).where(post_table.c.id == post_id)).first()
+        if new_ancestry is None:
+            new_ancestry = "%s%d," % (
+                parent_ancestry or '', parent_id) if parent_id else ''
+        assert ",%d," % (post_id,) not in ("," + new_ancestry), \
+            "Post %d cannot be its own ancestor" % (post_id,)
+        old_prefix = "%s%d," % (old_ancestry or '', post_id)
+        new_prefix = "%s%d," % (new_ancestry, post_id)
+        connection.execute(post_table.update().where(
+            post_table.c.id == post_id).values(ancestry=new_ancestry))
+        if old_prefix == new_prefix:
+            return []
+        # the new ancestors are active as late as the moved subtree
+        moved = post_table.alias('moved')
+        cls._bump_last_activity(
+            connection, [int(x) for x in new_ancestry.split(',') if x],
+            select([moved.c.last_activity]).where(
+                moved.c.id == post_id).as_scalar())
+        return connection.execute(post_table.update().where(
+            (post_table.c.ancestry.like(old_prefix + '%'))
+            & (content_table.c.id == post_table.c.id)
+        ).values(ancestry=literal(new_prefix) + func.substr(
+            post_table.c.ancestry, len(old_prefix) + 1)
+        ).returning(post_table.c.id, content_table.c.type)).fetchall()
 
-        descendant_ancestry = "%s%d," % (
-            self.ancestry, self.id)
-        for descendant in self.get_descendants():
-            descendant._set_ancestry(descendant_ancestry)
+    @classmethod
+    def _bump_last_activity(cls, connection, post_ids, date):
+        """Set the last activity of some posts to ``date``, if it is later."""
+        if not post_ids:
+            return
+        post_table = Post.__table__
+        connection.execute(post_table.update().where(
+            post_table.c.id.in_(list(post_ids))).values(
+            last_activity=func.greatest(post_table.c.last_activity, date)))
 
-    def set_parent(self, parent):
-        self.parent = parent
+    def _set_ancestry(self, new_ancestry):
+        self.set_parents(self.db, {self: self.parent}, {self: new_ancestry})
 
-        self.db.add(self)
-        self.db.flush()
+    @classmethod
+    def set_parents(cls, db, parents, ancestries=None):
+        """Reparent many posts, and update the ancestry of their subtrees
+        with set-based SQL.
+
+        :param parents: the new parent (or None) of each post
+        :param ancestries: explicit new ancestries of some posts (optional)
+        """
+        from .path_utils import IdeaPostMembership
+        from .idea_content_link import IdeaContentLink
+        if not parents:
+            return
+        ancestries = ancestries or {}
+        # new posts inherit the ideas of their parent on insert
+        old_ancestries = {post: post.ancestry for post in parents
+                          if post.id is not None and post not in db.new}
+        for post, parent in parents.items():
+            post.parent = parent
+            db.add(post)
+        db.flush()
+        connection = db.connection()
+        moved = {}
+        subtrees = defaultdict(set)
+        for post in parents:
+            for (id, sqla_type) in cls._move_subtree(
+                    connection, post.id, ancestries.get(post, None)):
+                moved[id] = sqla_type
+                subtrees[post.discussion_id].add(id)
+            subtrees[post.discussion_id].add(post.id)
+        for post in parents:
+            moved[post.id] = None
+        mark_changed(db)
+        for ob in list(db.identity_map.values()):
+            if isinstance(ob, Post):
+                db.expire(ob, ['ancestry', 'last_activity']
+                          if ob.id in moved else ['last_activity'])
+        # Refresh the ideas that showed the moved subtrees, link to them,
+        # or show their new parents.
+        for discussion_id, post_ids in subtrees.items():
+            moved_posts = [post for post in old_ancestries
+                           if post.discussion_id == discussion_id
+                           and post.ancestry != old_ancestries[post]]
+            if not moved_posts:
+                continue
+            post_ids = list(post_ids)
+            parent_ids = [post.parent_id for post in moved_posts
+                          if post.parent_id is not None]
+            idea_ids = {id for (id,) in db.query(
+                IdeaPostMembership.idea_id).filter(
+                IdeaPostMembership.post_id.in_(post_ids + parent_ids))}
+            idea_ids.update(id for (id,) in db.query(
+                IdeaContentLink.idea_id).filter(
+                IdeaContentLink.content_id.in_(post_ids),
+                IdeaContentLink.idea_id != None))
+            if idea_ids:
+                IdeaPostMembership.refresh(db, discussion_id, idea_ids)
+        # The moved posts are notified by the orm listeners, as their parent
+        # changed. Their descendants' json is unchanged, but caches must be
+        # invalidated.
+        session = object_session(next(iter(parents)))
+        changed_uris = getattr(session, 'changed_uris', None) or {}
+        polymorphic_map = Post.__mapper__.polymorphic_map
+        for discussion_id, post_ids in subtrees.items():
+            for id in post_ids:
+                sqla_type = moved[id]
+                if sqla_type is not None:
+                    changed_uris[polymorphic_map[sqla_type].class_.uri_generic(
+                        id)] = discussion_id
+        session.changed_uris = changed_uris
 
-        if parent is not None:
-            self._set_ancestry("%s%d," % (
-                parent.ancestry or '',
-                parent.id
-            ))
-        else:
-            self._set_ancestry('')
+    def set_parent(self, parent):
+        self.set_parents(self.db, {self: parent})
 
     def last_updated(self):
+        """The latest creation or edition date of this post and its
+        descendants"""
+        if self.last_activity is not None:
+            return self.last_activity
         ancestry_query_string = "%s%d,%%" % (self.ancestry or '', self.id)
 
         query = self.db.query(
@@ -308,6 +452,20 @@ class Post(Content):
 
         return query.scalar()
 
+    @classmethod
+    def threads_by_last_activity(cls, db, discussion_id):
+        """The thread roots of a discussion, most recently active first."""
+        return db.query(cls).filter(
+            cls.discussion_id == discussion_id, cls.parent_id == None
+        ).order_by(cls.last_activity.desc())
+
+    @classmethod
+    def discussion_last_activity(cls, db, discussion_id):
+        """The latest creation or edition date of the discussion's posts"""
+        return db.query(func.max(Post.last_activity)).filter(
+            Post.discussion_id == discussion_id,
+            Post.parent_id == None).scalar()
+
     def ancestor_ids(self):
         return [
             int(ancestor_id) \
@@ -587,20 +745,28 @@ class Post(Content):
         return (query, alias.creator_id == user_id)
 
 
+@event.listens_for(Post, 'before_insert', propagate=True)
+def set_initial_last_activity(mapper, connection, target):
+    if target.last_activity is None:
+        target.last_activity = target.creation_date or datetime.utcnow()
+
+
 def orm_insert_listener(mapper, connection, target):
     """ This is to allow the root idea to send update to "All posts",
     "Synthesis posts" and "orphan posts" in the table of ideas", if the post
-    isn't otherwise linked to the table of idea """
-    if target.discussion.root_idea:
-        target.discussion.root_idea.send_to_changes(connection)
-    # Check if this is the first post by this user in the discussion.
-    # In which case, tell the discussion about this new participant,
-    # which was not in Discussion.get_participants_query originally.
-    if target.db.query(Post).filter_by(
-            creator_id=target.creator_id,
-            discussion_id=target.discussion_id).count() <= 1:
-        creator = target.creator or AgentProfile.get(target.creator_id)
-        creator.send_to_changes(connection, CrudOperation.UPDATE, target.discussion_id)
+    isn't otherwise linked to the table of idea.
+
+    The new posts are only recorded here; notifications are sent once per
+    flush by :py:func:`notify_post_insertions`."""
+    if target.ancestry:
+        Post._bump_last_activity(
+            connection, target.ancestor_ids(), target.last_activity)
+    session = object_session(target)
+    if session is None:
+        return
+    inserted = session.info.setdefault('inserted_posts', {})
+    inserted.setdefault(target.discussion_id, Counter())[
+        target.creator_id] += 1
     # Eagerly translate the post
     # Actually causes DB deadlocks. TODO: Revise this.
     # Let's only do this on import.
@@ -610,6 +776,119 @@ def orm_insert_listener(mapper, connection, target):
 event.listen(Post, 'after_insert', orm_insert_listener, propagate=True)
 
 
+@event.listens_for(get_session_maker(), "after_flush")
+def notify_post_insertions(session, flush_context):
+    """Send the root idea of discussions with new posts, and the creators
+    of their first post in the discussion, to the changes socket.
+
+    Each creator is only checked once per transaction."""
+    inserted = session.info.pop('inserted_posts', None)
+    if not inserted:
+        return
+    from .discussion import Discussion
+    connection = session.connection()
+    checked = session.info.setdefault('post_creators_checked', set())
+    for discussion_id, counts in inserted.items():
+        discussion = Discussion.get(discussion_id)
+        if discussion.root_idea:
+            discussion.root_idea.send_to_changes(connection)
+        creator_ids = [id for id in counts
+                       if (discussion_id, id) not in checked]
+        if not creator_ids:
+            continue
+        checked.update((discussion_id, id) for id in creator_ids)
+        # Check if these are the first posts by these users in the discussion.
+        # In which case, tell the discussion about these new participants,
+        # which were not in Discussion.get_participants_query originally.
+        with session.no_autoflush:
+            totals = dict(session.query(
+                Post.creator_id, func.count(Post.id)).filter(
+                Post.discussion_id == discussion_id,
+                Post.creator_id.in_(creator_ids)).group_by(Post.creator_id))
+        for creator_id in creator_ids:
+            if totals.get(creator_id, 0) <= counts[creator_id]:
+                AgentProfile.get(creator_id).send_to_changes(
+                    connection, CrudOperation.UPDATE, discussion_id)
+
+
+@event.listens_for(get_session_maker(), "after_commit")
+def reset_post_creators_checked(session):
+    session.info.pop('post_creators_checked', None)
+    session.info.pop('inserted_posts', None)
+
+
+@event.listens_for(get_session_maker(), "after_soft_rollback")
+def reset_post_creators_checked_after_rollback(session, previous_transaction):
+    reset_post_creators_checked(session)
+
+
+@event.listens_for(get_session_maker(), "before_flush")
+def update_body_previews(session, flush_context, instances):
+    """Store the previews of new or changed post body entries."""
+    for ob in session.dirty:
+        # posts whose body format changed
+        if isinstance(ob, Post) and \
+                'body_mime_type' in ob.__mapper__.column_attrs.keys() and \
+                inspect(ob).attrs.body_mime_type.history.has_changes():
+            ob.update_body_previews()
+    by_langstring_id = defaultdict(list)
+    by_langstring = defaultdict(list)
+    for ob in chain(session.new, session.dirty):
+        if isinstance(ob, LangStringEntry) and (
+                ob in session.new or
+                inspect(ob).attrs.value.history.has_changes()):
+            if ob.langstring_id:
+                by_langstring_id[ob.langstring_id].append(ob)
+            elif ob.langstring is not None:
+                by_langstring[id(ob.langstring)].append(ob)
+    if not (by_langstring_id or by_langstring):
+        return
+    edited = []
+    # new bodies belong to new or changed posts
+    for post in chain(session.new, session.dirty):
+        if not isinstance(post, Post):
+            continue
+        body = post.__dict__.get('body', None)
+        entries = by_langstring.pop(id(body), []) if body is not None else []
+        entries.extend(by_langstring_id.pop(post.body_id, ()))
+        if entries:
+            post.update_body_previews(entries)
+            if any(_is_edition(entry) for entry in entries):
+                edited.append(post)
+    if by_langstring_id:
+        # bodies of unchanged posts (or other langstrings), in one query
+        with session.no_autoflush:
+            for post in session.query(Post).filter(
+                    Post.body_id.in_(list(by_langstring_id.keys()))):
+                entries = by_langstring_id[post.body_id]
+                post.update_body_previews(entries)
+                if any(_is_edition(entry) for entry in entries):
+                    edited.append(post)
+    record_post_edits(session, edited)
+
+
+def _is_edition(entry):
+    """Whether a new or changed body entry is an edition by a person,
+    and not a machine translation (e.g. made on read)"""
+    return entry.mt_trans_of_id is None and \
+        entry.__dict__.get('mt_trans_of', None) is None
+
+
+def record_post_edits(session, posts):
+    """Make the edition of existing posts the last activity of their
+    subtree and ancestors."""
+    now = datetime.utcnow()
+    ancestor_ids = set()
+    for post in posts:
+        if post in session.new:
+            continue
+        post.last_activity = now
+        if post.ancestry:
+            ancestor_ids.update(post.ancestor_ids())
+    if ancestor_ids:
+        Post._bump_last_activity(session.connection(), ancestor_ids, now)
+
+
 class LocalPost(Post):
     """
     A Post that originated directly on the platform (wasn't imported from elsewhere).
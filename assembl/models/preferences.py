@@ -7,6 +7,8 @@ from future.utils import text_type
 standard_library.install_aliases()
 from builtins import str
 from itertools import chain
+from copy import deepcopy
+from types import MappingProxyType
 
 from future.utils import string_types
 import simplejson as json
@@ -38,6 +40,107 @@ def merge_json(base, patch):
     return base
 
 
+class FrozenDict(dict):
+    """A dict that cannot be modified. Its copies are plain dicts."""
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Preference values are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {k: deepcopy(v, memo) for (k, v) in self.items()}
+
+    def __reduce__(self):
+        return (dict, (dict(self), ))
+
+
+class FrozenList(list):
+    """A list that cannot be modified. Its copies are plain lists."""
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Preference values are read-only")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = clear = extend = insert = pop = remove = _read_only
+    reverse = sort = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (list, (list(self), ))
+
+
+def freeze_json(value):
+    "A read-only copy of a json value"
+    if isinstance(value, dict):
+        return FrozenDict(
+            (k, freeze_json(v)) for (k, v) in value.items())
+    if isinstance(value, (list, tuple)):
+        return FrozenList(freeze_json(v) for v in value)
+    return value
+
+
+class PreferencesSnapshot(object):
+    """The fully resolved values of a cascade of preferences.
+
+    Immutable, and shared by all Preferences with the same cascade of values.
+    """
+    __slots__ = ('values', 'preference_data', 'preference_data_list')
+
+    def __init__(self, cascade):
+        locals_json = [prefs.local_values_json for prefs in cascade]
+        # as in Preferences.get_preference_data
+        preference_data = Preferences.preference_data
+        for local_values in reversed(locals_json):
+            if "preference_data" in local_values:
+                preference_data = merge_json(
+                    preference_data, local_values["preference_data"])
+        # read-only, as it may be the class-level preference_data
+        self.preference_data = MappingProxyType(preference_data)
+        self.preference_data_list = tuple(
+            preference_data[key] for key in Preferences.preference_data_key_list)
+        # As in Preferences.__getitem__: the first local value in the
+        # cascade, else the default in the base preferences' specifications
+        # (the preference_data patches of other preferences do not apply).
+        base_data = Preferences.preference_data
+        if "preference_data" in locals_json[-1]:
+            base_data = merge_json(
+                base_data, locals_json[-1]["preference_data"])
+        values = {}
+        for key in Preferences.preference_data_key_list:
+            for local_values in locals_json:
+                if key in local_values:
+                    values[key] = local_values[key]
+                    break
+            else:
+                if key == "preference_data":
+                    values[key] = [
+                        base_data[k]
+                        for k in Preferences.preference_data_key_list]
+                else:
+                    values[key] = base_data[key].get("default", None)
+        # Values are shared: lists and dicts are frozen, callers who need
+        # to modify one must copy it.
+        self.values = MappingProxyType(
+            {key: freeze_json(value) for (key, value) in values.items()})
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            raise KeyError("Unknown preference: " + key)
+        return self.values[key]
+
+
 class Preferences(NamedClassMixin, AbstractBase): # MutableMapping
     """
     Cascading preferences
@@ -81,6 +184,34 @@ class Preferences(NamedClassMixin, AbstractBase): # MutableMapping
             k: k for k in get_active_auth_strategies(settings)}
         active_strategies[''] = _("No special authentication")
         cls.preference_data['authorization_server_backend']['scalar_values'] = active_strategies
+        cls.clear_snapshots()
+
+    # Snapshots by the values of the cascade of preferences.
+    _snapshots = {}
+    MAX_SNAPSHOTS = 1000
+
+    @property
+    def snapshot(self):
+        """The :py:class:`PreferencesSnapshot` of this cascade of preferences.
+
+        Snapshots are keyed by the values of all the preferences in the
+        cascade, so any write (through ``__setitem__``, ``safe_set``, etc.),
+        here or in another process, gives a new snapshot."""
+        cascade = [self]
+        while cascade[-1].cascade_id:
+            cascade.append(cascade[-1].cascade_preferences)
+        key = tuple(prefs.pref_json for prefs in cascade)
+        snapshot = self._snapshots.get(key, None)
+        if snapshot is None:
+            snapshot = PreferencesSnapshot(cascade)
+            if len(self._snapshots) >= self.MAX_SNAPSHOTS:
+                self._snapshots.clear()
+            self._snapshots[key] = snapshot
+        return snapshot
+
+    @classmethod
+    def clear_snapshots(cls):
+        cls._snapshots.clear()
 
     @property
     def local_values_json(self):
@@ -181,14 +312,7 @@ class Preferences(NamedClassMixin, AbstractBase): # MutableMapping
         if key == '@extends':
             return (self.uri_generic(self.cascade_id)
                     if self.cascade_id else None)
-        exists, value = self._get_local(key)
-        if exists:
-            return value
-        elif self.cascade_id:
-            return self.cascade_preferences[key]
-        if key == "preference_data":
-            return self.get_preference_data_list()
-        return self.get_preference_data()[key].get("default", None)
+        return self.snapshot[key]
 
     def __len__(self):
         return len(self.preference_data_list) + 2
@@ -382,19 +506,11 @@ class Preferences(NamedClassMixin, AbstractBase): # MutableMapping
                 for p in cls.preference_data_list}
 
     def get_preference_data(self):
-        if self.cascade_id:
-            base = self.cascade_preferences.get_preference_data()
-        else:
-            base = self.preference_data
-        exists, patch = self._get_local("preference_data")
-        if exists:
-            base = merge_json(base, patch)
-        return base
+        "A read-only view of the preference specifications, by key"
+        return self.snapshot.preference_data
 
     def get_preference_data_list(self):
-        data = self.get_preference_data()
-        keys = self.preference_data_key_list
-        return [data[key] for key in keys]
+        return list(self.snapshot.preference_data_list)
 
     crud_permissions = CrudPermissions(P_SYSADMIN)
 
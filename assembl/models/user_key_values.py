@@ -1,6 +1,7 @@
 """Models for arbitrary key-values storage, bound to a namespace, a user, and some other object (currently only the discussion)."""
 from __future__ import absolute_import
 from builtins import object
+from collections import defaultdict
 from collections.abc import MutableMapping
 
 import simplejson as json
@@ -164,93 +165,95 @@ class AbstractPerUserNamespacedKeyValue(
 
 
 class NamespacedUserKVCollection(MutableMapping):
-    """View of the :py:class:`AbstractPerUserNamespacedKeyValue` for a given namespace as a python dict"""
+    """View of the :py:class:`AbstractPerUserNamespacedKeyValue` for a given namespace as a python dict
 
-    def __init__(self, target, user_id, namespace):
+    The key-values of the namespace are loaded in one query on first access,
+    and changes are written through to the (loaded) ORM objects, so they
+    are flushed together with the session."""
+
+    def __init__(self, target, user_id, namespace, kvpairs=None):
         self.target = target
         self.user_id = user_id
         self.namespace = namespace
+        # key -> key-value object
+        self._kvpairs = kvpairs
+
+    @classmethod
+    def bulk_fetch(cls, target, user_ids, namespace):
+        """The collections of many users for a namespace, loaded in a
+        single query.
+
+        :returns: a dict of collections, by user_id"""
+        ukv_cls = target.per_user_namespaced_kv_class
+        by_user = {user_id: {} for user_id in user_ids}
+        if by_user:
+            kvpairs = target.db.query(ukv_cls).filter(
+                ukv_cls.user_id.in_(list(by_user.keys()))).filter_by(
+                    namespace=namespace,
+                    **{ukv_cls.target_name: target})
+            for kvpair in kvpairs:
+                by_user[kvpair.user_id][kvpair.key] = kvpair
+        return {
+            user_id: NamespacedUserKVCollection(
+                target, user_id, namespace, kvpairs)
+            for (user_id, kvpairs) in by_user.items()}
+
+    @property
+    def kvpairs(self):
+        if self._kvpairs is None:
+            if self.target is None:
+                self._kvpairs = {}
+            else:
+                ukv_cls = self.target.per_user_namespaced_kv_class
+                self._kvpairs = {
+                    kvpair.key: kvpair for kvpair in self.target.db.query(
+                        ukv_cls).filter_by(
+                            user_id=self.user_id,
+                            namespace=self.namespace,
+                            **{ukv_cls.target_name: self.target})}
+        return self._kvpairs
 
     def __len__(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        return self.target.db.query(
-            ukv_cls.key).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                **{ukv_cls.target_name: self.target}).count()
+        return len(self.kvpairs)
 
     def __iter__(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        ns = self.target.db.query(
-            ukv_cls.key).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                **{ukv_cls.target_name: self.target})
-        return (x for (x,) in ns)
+        return iter(list(self.kvpairs.keys()))
 
     iterkeys = __iter__
 
     def iteritems(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        kvpairs = self.target.db.query(
-            ukv_cls).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                **{ukv_cls.target_name: self.target})
-        return ((kvpair.key, json.loads(kvpair.value)) for kvpair in kvpairs)
+        return ((key, json.loads(kvpair.value))
+                for (key, kvpair) in list(self.kvpairs.items()))
 
     def __getitem__(self, key):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        value = self.target.db.query(
-            ukv_cls.value).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                key=key,
-                **{ukv_cls.target_name: self.target}).first()
-        if not value:
+        kvpair = self.kvpairs.get(key, None)
+        if kvpair is None:
             raise IndexError()
-        (value,) = value
-        return json.loads(value)
+        return json.loads(kvpair.value)
 
     def __setitem__(self, key, value):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        kvpair = self.target.db.query(
-            ukv_cls).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                key=key,
-                **{ukv_cls.target_name: self.target}).first()
-        if kvpair:
+        kvpair = self.kvpairs.get(key, None)
+        if kvpair is not None:
             kvpair.value = json.dumps(value)
         else:
-            self.target.db.add(ukv_cls(
+            ukv_cls = self.target.per_user_namespaced_kv_class
+            kvpair = ukv_cls(
                 user_id=self.user_id,
                 namespace=self.namespace,
                 key=key,
                 value=json.dumps(value),
-                **{ukv_cls.target_name: self.target}))
+                **{ukv_cls.target_name: self.target})
+            self.target.db.add(kvpair)
+            self.kvpairs[key] = kvpair
 
     def __delitem__(self, key):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        kvpair = self.target.db.query(
-            ukv_cls).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                key=key,
-                **{ukv_cls.target_name: self.target}).first()
-        if not kvpair:
+        kvpair = self.kvpairs.pop(key, None)
+        if kvpair is None:
             raise IndexError()
         kvpair.delete()
 
     def __contains__(self, key):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        value = self.target.db.query(
-            ukv_cls.id).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                key=key,
-                **{ukv_cls.target_name: self.target}).first()
-        return value is not None
+        return key in self.kvpairs
 
 
 class NamespacedKVCollection(MutableMapping):
@@ -437,12 +440,16 @@ class UserNsDict(MutableMapping):
 
     def iteritems(self):
         ukv_cls = self.target.per_user_namespaced_kv_class
-        ns = self.target.db.query(
-            ukv_cls.namespace).filter_by(
+        kvpairs = self.target.db.query(
+            ukv_cls).filter_by(
                 user_id=self.user_id,
-                **{ukv_cls.target_name: self.target}).distinct()
-        return {x: NamespacedUserKVCollection(self.target, self.user_id, x)
-                for (x,) in ns}
+                **{ukv_cls.target_name: self.target})
+        by_namespace = defaultdict(dict)
+        for kvpair in kvpairs:
+            by_namespace[kvpair.namespace][kvpair.key] = kvpair
+        return {x: NamespacedUserKVCollection(
+                    self.target, self.user_id, x, nskvpairs)
+                for (x, nskvpairs) in by_namespace.items()}
 
     def __getitem__(self, key):
         return NamespacedUserKVCollection(self.target, self.user_id, key)
@@ -7,18 +7,22 @@ from datetime import datetime
 import simplejson as json
 import math
 from collections import defaultdict
+from itertools import combinations, chain
 from csv import DictWriter
 
+import numpy as np
+
 from sqlalchemy import (
     Column, Integer, ForeignKey, Boolean, String, Float, DateTime, Unicode,
-    Text, and_, UniqueConstraint)
+    Text, and_, UniqueConstraint, event)
 from sqlalchemy.sql import functions
-from sqlalchemy.orm import (relationship, backref, joinedload, aliased)
+from sqlalchemy.orm import (
+    relationship, backref, joinedload, aliased, object_session)
 from pyramid.settings import asbool
 
 from . import (Base, DiscussionBoundBase, HistoryMixinWithOrigin)
 from ..lib.abc import abstractclassmethod
-from ..lib.sqla import DuplicateHandling
+from ..lib.sqla import DuplicateHandling, get_session_maker
 from ..lib.sqla_types import URLString
 from .discussion import Discussion
 from .idea import Idea, AppendingVisitor
@@ -32,6 +36,64 @@ from ..views.traversal import (
 from .langstrings import LangString
 
 
+class VoteColumns(object):
+    """A columnar representation of a set of live votes, as numpy arrays.
+
+    Always has ``idea_id``, ``voter_id``, ``vote_spec_id`` and ``vote_value``
+    columns; vote specifications may ask for more, e.g. token categories."""
+    base_names = ('idea_id', 'voter_id', 'vote_spec_id', 'vote_value')
+
+    def __init__(self, names, columns):
+        self.names = tuple(names)
+        for name, column in zip(self.names, columns):
+            setattr(self, name, column)
+
+    @classmethod
+    def from_rows(cls, rows, extra_names=()):
+        names = cls.base_names + tuple(extra_names)
+        columns = list(zip(*rows)) or [()] * len(names)
+        arrays = []
+        for name, column in zip(names, columns):
+            if name == 'vote_value':
+                arrays.append(np.array(column, dtype=float))
+            else:
+                # Missing foreign keys become -1
+                arrays.append(np.array(
+                    [-1 if x is None else x for x in column], dtype=np.int64))
+        return cls(names, arrays)
+
+    def __len__(self):
+        return len(self.idea_id)
+
+    def select(self, selector):
+        "A subset of the votes, given a boolean mask or index array"
+        return self.__class__(self.names, [
+            getattr(self, name)[selector] for name in self.names])
+
+    def split_by(self, name):
+        "dictionary of column value -> VoteColumns subset"
+        column = getattr(self, name)
+        order = np.argsort(column, kind='stable')
+        keys, starts = np.unique(column[order], return_index=True)
+        groups = np.split(order, starts[1:])
+        return {int(key): self.select(group)
+                for (key, group) in zip(keys, groups)}
+
+    @classmethod
+    def concatenate(cls, vote_columns, names=None):
+        names = names or cls.base_names
+        return cls(names, [
+            np.concatenate([getattr(vc, name) for vc in vote_columns])
+            for name in names])
+
+
+def histogram_bins(values, minimum, maximum, histogram_size):
+    "The histogram bin of each value, as an array"
+    bin_size = (maximum - minimum) / histogram_size
+    bins = ((values - minimum) / bin_size).astype(np.int64)
+    return np.clip(bins, 0, histogram_size - 1)
+
+
 class AbstractVoteSpecification(DiscussionBoundBase):
     """The representation of a way to vote on an idea.
     There can be more than one VoteSpecification in a Question,
@@ -123,34 +185,93 @@ class AbstractVoteSpecification(DiscussionBoundBase):
 
     @abstractmethod
     def results_for(self, voting_results, histogram_size=None):
+        """Aggregate the votes on one idea
+
+        :param voting_results: a :py:class:`VoteColumns`"""
         return {
             "n": len(voting_results)
         }
 
+    @classmethod
+    def extra_vote_columns(cls):
+        "Vote columns needed by :py:meth:`results_for`, beyond the base ones"
+        return ()
+
+    @classmethod
+    def gather_widget_votes(cls, widget):
+        """Gather the live votes of all specifications of a widget, with one
+        query per vote class.
+
+        :returns: a dictionary of vote_spec_id -> :py:class:`VoteColumns`"""
+        specs_by_class = defaultdict(list)
+        for spec in widget.vote_specifications:
+            specs_by_class[spec.__class__].append(spec)
+        results = {}
+        for spec_cls, specs in specs_by_class.items():
+            vote_cls = spec_cls.get_vote_class()
+            extra_names = spec_cls.extra_vote_columns()
+            columns = [getattr(vote_cls, name) for name in
+                       VoteColumns.base_names + extra_names]
+            rows = widget.db.query(*columns).filter(
+                vote_cls.vote_spec_id.in_([spec.id for spec in specs]),
+                vote_cls.tombstone_date == None).all()
+            votes = VoteColumns.from_rows(rows, extra_names)
+            by_spec = votes.split_by('vote_spec_id')
+            for spec in specs:
+                results[spec.id] = by_spec.get(
+                    spec.id, VoteColumns.from_rows((), extra_names))
+        return results
+
+    @classmethod
+    def gather_widget_votes_once(cls, widget):
+        """:py:meth:`gather_widget_votes`, memoized in the session until
+        the end of the transaction, or until a vote or vote specification
+        is flushed."""
+        session = object_session(widget)
+        if session is None:
+            return cls.gather_widget_votes(widget)
+        gathered = session.info.setdefault('gathered_votes', {})
+        if _has_vote_changes(session):
+            # they will be flushed by the query
+            gathered.clear()
+        votes = gathered.get(widget.id, None)
+        if votes is None:
+            votes = cls.gather_widget_votes(widget)
+            gathered[widget.id] = votes
+        return votes
+
     def _gather_results(self):
-        vote_cls = self.get_vote_class()
-        voting_results = self.db.query(vote_cls).filter_by(
-            vote_spec_id=self.id,
-            tombstone_date=None)
-        by_idea = defaultdict(list)
-        for vote in voting_results:
-            by_idea[vote.idea_id].append(vote)
-        return by_idea
+        votes = self.widget.gathered_votes().get(self.id, None)
+        if votes is None:
+            # created after the cached votes
+            votes = self.gather_widget_votes(self.widget)[self.id]
+        return votes
 
     def voting_results(self, histogram_size=None):
-        by_idea = self._gather_results()
+        votes = self._gather_results()
         results = {
             Idea.uri_generic(votable_id):
-            self.results_for(voting_results, histogram_size)
-            for (votable_id, voting_results) in by_idea.items()
+            self.results_for(idea_votes, histogram_size)
+            for (votable_id, idea_votes) in votes.split_by('idea_id').items()
         }
-        results["n_voters"] = self.db.query(
-            getattr(self.get_vote_class(), "voter_id")).filter_by(
-            vote_spec_id=self.id,
-            tombstone_date=None).distinct().count()
-
+        results["n_voters"] = len(np.unique(votes.voter_id))
         return results
 
+    def cached_voting_results(self, histogram_size=None):
+        """The :py:meth:`voting_results`, cached until a vote or vote
+        specification of the widget changes."""
+        from ..lib.jsonld_cache import cached_for_version
+        return cached_for_version(
+            self.widget, "results:%d:%d" % (self.id, histogram_size or 0),
+            lambda: self.voting_results(histogram_size))
+
+    def voting_results_etag(self, histogram_size=None):
+        "An ETag for the :py:meth:`cached_voting_results`, if available"
+        from ..lib.jsonld_cache import version_token
+        token = version_token(self.widget)
+        if token:
+            return "%d-%d-%s" % (self.id, histogram_size or 0, token)
+
     @abstractmethod
     def csv_results(self, csv_file):
         pass
@@ -246,6 +367,10 @@ class AbstractVoteSpecification(DiscussionBoundBase):
               Widget.get(self.widget_id))
         return ob.get_discussion_id()
 
+    def cache_dependencies(self):
+        from .widgets import Widget
+        return (Widget.uri_generic(self.widget_id),)
+
     @classmethod
     def get_discussion_conditions(cls, discussion_id, alias_maker=None):
         from .widgets import VotingWidget
@@ -255,15 +380,6 @@ class AbstractVoteSpecification(DiscussionBoundBase):
     crud_permissions = CrudPermissions(P_ADMIN_DISC, P_READ)
 
 
-def empty_matrix(size, dim):
-    if dim == 0:
-        return 0
-    if dim == 1:
-        # shortcut
-        return [0] * size
-    return [empty_matrix(size, dim-1) for i in range(size)]
-
-
 class TokenVoteSpecification(AbstractVoteSpecification):
     __tablename__ = "token_vote_specification"
     __mapper_args__ = {
@@ -274,15 +390,25 @@ class TokenVoteSpecification(AbstractVoteSpecification):
         Integer, ForeignKey(AbstractVoteSpecification.id), primary_key=True)
     exclusive_categories = Column(Boolean, default=False)
 
+    @classmethod
+    def extra_vote_columns(cls):
+        return ('token_category_id',)
+
     def results_for(self, voting_results, histogram_size=None):
-        sums = defaultdict(int)
-        nums = defaultdict(int)
-        for v in voting_results:
-            sums[v.token_category_id] += v.vote_value
-            nums[v.token_category_id] += 1
         specs = {spec.id: spec.typename for spec in self.token_categories}
-        sums = {specs[id]: total for (id, total) in sums.items()}
-        nums = {specs[id]: total for (id, total) in nums.items()}
+        category_ids, positions = np.unique(
+            voting_results.token_category_id, return_inverse=True)
+        category_sums = np.bincount(
+            positions, weights=voting_results.vote_value,
+            minlength=len(category_ids))
+        category_nums = np.bincount(positions, minlength=len(category_ids))
+        sums = {}
+        nums = {}
+        for (id, total, num) in zip(
+                category_ids, category_sums, category_nums):
+            if id in specs:
+                sums[specs[id]] = int(total)
+                nums[specs[id]] = int(num)
         return {
             "n": len(voting_results),
             "nums": nums,
@@ -299,7 +425,7 @@ class TokenVoteSpecification(AbstractVoteSpecification):
         spec_names.insert(0, "idea")
         dw = DictWriter(csv_file, spec_names, dialect='excel', delimiter=';')
         dw.writeheader()
-        by_idea = self._gather_results()
+        by_idea = self._gather_results().split_by('idea_id')
         values = {
             votable_id: self.results_for(voting_results)
             for (votable_id, voting_results) in by_idea.items()
@@ -452,93 +578,78 @@ class LickertVoteSpecification(AbstractVoteSpecification):
                 if histogram_size:
                     self.joint_histogram(
                         group_specs, histogram_size, base_results)
-                print(base_results)
                 return base_results
         return super(LickertVoteSpecification, self
                      ).voting_results(histogram_size)
 
     @classmethod
     def joint_histogram(
-            cls, group_specs, histogram_size, joint_histograms,
-            votes_by_idea_user_spec=None):
-        if votes_by_idea_user_spec is None:
-            votes_by_idea_user_spec = defaultdict(lambda: defaultdict(dict))
-            for spec in group_specs:
-                votes_by_idea = spec._gather_results()
-                for idea_id, votes in votes_by_idea.items():
-                    for vote in votes:
-                        votes_by_idea_user_spec[idea_id][
-                            vote.voter_id][spec] = vote
-        bin_sizes = {
-            spec: float(spec.maximum - spec.minimum) / histogram_size
-            for spec in group_specs
-        }
-        group_spec_ids = {x.id for x in group_specs}
-        group_signature = ",".join(spec.uri() for spec in group_specs)
-        joint_histograms[group_signature] = histograms_by_idea = {}
-        sums = [0] * len(group_specs)
-        sum_squares = [0] * len(group_specs)
-        sum_prods = 0
-        for idea_id, votes_by_user_spec in votes_by_idea_user_spec.items():
-            histogram = empty_matrix(histogram_size, len(group_specs))
-            results = dict(histogram=histogram)
-            histograms_by_idea[Idea.uri_generic(idea_id)] = results
-            n = 0
-            for votes_by_spec in votes_by_user_spec.values():
-                spec_ids = {spec.id for spec in votes_by_spec}
-                if group_spec_ids <= spec_ids:  # only full
-                    n += 1
-                    h = histogram
-                    prod = 1
-                    for gn, spec in enumerate(group_specs):
-                        vote_val = votes_by_spec[spec].vote_value
-                        sums[gn] += vote_val
-                        sum_squares[gn] += vote_val*vote_val
-                        prod *= vote_val
-                        bin_num = int((vote_val - spec.minimum) / bin_sizes[spec])
-                        bin_num = min(bin_num, histogram_size-1)
-                        bin_num = max(bin_num, 0)
-                        if gn == len(group_specs) - 1:
-                            h[bin_num] += 1
-                        else:
-                            h = h[bin_num]
-                    sum_prods += prod
-            results['n'] = n
-            if len(group_specs) == 2 and n > 1:
-                try:
-                    b1 = (sums[0] * sums[1] - n * sum_prods) / (
-                        sums[0] * sums[0] - n * sum_squares[0])
-                    b0 = (sums[1] - b1 * sums[0]) / n
-                    results['b0'] = b0
-                    results['b1'] = b1
-                except ZeroDivisionError:
-                    pass
-
-        if len(group_specs) > 2:
-            # eliminate a dimension and recurse
-            for n in range(len(group_specs)):
-                sub_group_specs = group_specs[:n] + group_specs[n+1:]
-                cls.joint_histogram(
-                    sub_group_specs, histogram_size, joint_histograms,
-                    votes_by_idea_user_spec)
+            cls, group_specs, histogram_size, joint_histograms):
+        """Compute the joint histograms of votes on the given specs, for
+        every subset of at least two specs.
+
+        Only voters who voted on all specs of a subset are counted."""
+        votes = VoteColumns.concatenate([
+            spec._gather_results() for spec in group_specs])
+        spec_ids = np.array([spec.id for spec in group_specs])
+        # One row per (idea, voter) pair, one column per spec
+        pair_keys = votes.idea_id * (int(votes.voter_id.max(initial=0)) + 1) \
+            + votes.voter_id
+        pair_keys, first_pos, pair_pos = np.unique(
+            pair_keys, return_index=True, return_inverse=True)
+        pair_idea_ids = votes.idea_id[first_pos]
+        spec_pos = np.searchsorted(spec_ids, votes.vote_spec_id)
+        values = np.full((len(pair_keys), len(group_specs)), np.nan)
+        values[pair_pos, spec_pos] = votes.vote_value
+        bins = np.stack([
+            histogram_bins(
+                np.nan_to_num(values[:, n], nan=spec.minimum),
+                spec.minimum, spec.maximum, histogram_size)
+            for (n, spec) in enumerate(group_specs)], axis=1)
+        idea_ids = np.unique(pair_idea_ids)
+        for dim in range(len(group_specs), 1, -1):
+            for columns in combinations(range(len(group_specs)), dim):
+                columns = list(columns)
+                shape = (histogram_size,) * dim
+                group_signature = ",".join(
+                    group_specs[n].uri() for n in columns)
+                joint_histograms[group_signature] = histograms_by_idea = {}
+                full = ~np.isnan(values[:, columns]).any(axis=1)
+                for idea_id in idea_ids:
+                    rows = full & (pair_idea_ids == idea_id)
+                    n = int(rows.sum())
+                    flat_bins = np.ravel_multi_index(
+                        tuple(bins[rows][:, columns].T), shape)
+                    histogram = np.bincount(
+                        flat_bins, minlength=histogram_size ** dim)
+                    results = dict(
+                        histogram=histogram.reshape(shape).tolist(), n=n)
+                    histograms_by_idea[Idea.uri_generic(int(idea_id))] = results
+                    if dim == 2 and n > 1:
+                        (x, y) = values[rows][:, columns].T
+                        (sum_x, sum_y) = (float(x.sum()), float(y.sum()))
+                        try:
+                            b1 = (sum_x * sum_y - n * float((x * y).sum())) / (
+                                sum_x * sum_x - n * float((x * x).sum()))
+                            b0 = (sum_y - b1 * sum_x) / n
+                            results['b0'] = b0
+                            results['b1'] = b1
+                        except ZeroDivisionError:
+                            pass
 
     def results_for(self, voting_results, histogram_size=None):
         base = super(LickertVoteSpecification, self).results_for(voting_results)
-        n = len(voting_results)
-        avg = sum((r.vote_value for r in voting_results)) / n
-        moment2 = sum((r.vote_value**2 for r in voting_results)) / n
+        values = voting_results.vote_value
+        avg = float(values.mean())
+        moment2 = float((values ** 2).mean())
         var = moment2 - avg**2
-        std_dev = math.sqrt(var)
+        std_dev = math.sqrt(max(var, 0))
         base.update(dict(avg=avg, std_dev=std_dev))
         if histogram_size:
-            histogram = [0] * histogram_size
-            bin_size = (self.maximum - self.minimum) / histogram_size
-            for vote in voting_results:
-                bin_num = int((vote.vote_value - self.minimum) / bin_size)
-                bin_num = min(bin_num, histogram_size-1)
-                bin_num = max(bin_num, 0)
-                histogram[bin_num] += 1
-            base['histogram'] = histogram
+            bins = histogram_bins(
+                values, self.minimum, self.maximum, histogram_size)
+            base['histogram'] = np.bincount(
+                bins, minlength=histogram_size).tolist()
         return base
 
     def csv_results(self, csv_file, histogram_size=None):
@@ -549,7 +660,7 @@ class LickertVoteSpecification(AbstractVoteSpecification):
         bins.extend(["avg", "std_dev"])
         dw = DictWriter(csv_file, bins, dialect='excel', delimiter=';')
         dw.writeheader()
-        by_idea = self._gather_results()
+        by_idea = self._gather_results().split_by('idea_id')
         values = {
             votable_id: self.results_for(voting_results, histogram_size)
             for (votable_id, voting_results) in by_idea.items()
@@ -580,7 +691,7 @@ class ResourceVoteSpecification(AbstractVoteSpecification):
 
     def results_for(self, voting_results, histogram_size=None):
         base = super(ResourceVoteSpecification, self).results_for(voting_results)
-        base['total'] = sum(v.vote_value for v in voting_results)
+        base['total'] = float(voting_results.vote_value.sum())
         return base
 
     def vote_range(self):
@@ -591,7 +702,7 @@ class ResourceVoteSpecification(AbstractVoteSpecification):
         dw = DictWriter(csv_file, ["idea", "n", "total"],
                         dialect='excel', delimiter=';')
         dw.writeheader()
-        by_idea = self._gather_results()
+        by_idea = self._gather_results().split_by('idea_id')
         values = {
             votable_id: self.results_for(voting_results)
             for (votable_id, voting_results) in by_idea.items()
@@ -623,7 +734,7 @@ class BinaryVoteSpecification(AbstractVoteSpecification):
     def results_for(self, voting_results, histogram_size=None):
         base = super(BinaryVoteSpecification, self).results_for(voting_results)
         n = len(voting_results)
-        positive = len([r for r in voting_results if r.vote_value])
+        positive = int(np.count_nonzero(voting_results.vote_value))
         base["yes"] = positive
         base["no"] = n - positive
         return base
@@ -635,7 +746,7 @@ class BinaryVoteSpecification(AbstractVoteSpecification):
         dw = DictWriter(csv_file, ["idea", "yes", "no"],
                         dialect='excel', delimiter=';')
         dw.writeheader()
-        by_idea = self._gather_results()
+        by_idea = self._gather_results().split_by('idea_id')
         values = {
             votable_id: self.results_for(voting_results)
             for (votable_id, voting_results) in by_idea.items()
@@ -676,10 +787,10 @@ class MultipleChoiceVoteSpecification(AbstractVoteSpecification):
     def results_for(self, voting_results, histogram_size=None):
         base = super(
             MultipleChoiceVoteSpecification, self).results_for(voting_results)
-        by_result = defaultdict(int)
-        for r in voting_results:
-            by_result[r.vote_value] += 1
-        base['results'] = dict(by_result)
+        choices, counts = np.unique(
+            voting_results.vote_value.astype(np.int64), return_counts=True)
+        base['results'] = {
+            int(choice): int(count) for (choice, count) in zip(choices, counts)}
         return base
 
     def csv_results(self, csv_file, histogram_size=None):
@@ -688,7 +799,7 @@ class MultipleChoiceVoteSpecification(AbstractVoteSpecification):
         cols.insert(0, "idea")
         dw = DictWriter(csv_file, cols, dialect='excel', delimiter=';')
         dw.writeheader()
-        by_idea = self._gather_results()
+        by_idea = self._gather_results().split_by('idea_id')
         values = {
             votable_id: self.results_for(voting_results)
             for (votable_id, voting_results) in by_idea.items()
@@ -854,6 +965,10 @@ class AbstractIdeaVote(HistoryMixinWithOrigin, DiscussionBoundBase):
               Idea.get(self.idea_id))
         return ob.get_discussion_id()
 
+    def cache_dependencies(self):
+        from .widgets import Widget
+        return (Widget.uri_generic(self.widget_id),)
+
     def container_url(self):
         # Or stop at widget or spec?
         return "/data/Discussion/%d/widgets/%d/vote_specifications/%d/vote_targets/%d/votes" % (
@@ -1061,3 +1176,21 @@ class TokenIdeaVote(AbstractIdeaVote):
         token_category_id = self.token_category_id or (
             self.token_category.id if self.token_category else None)
         return (query.filter_by(token_category_id=token_category_id), True)
+
+
+def _has_vote_changes(session):
+    return any(
+        isinstance(ob, (AbstractVoteSpecification, AbstractIdeaVote))
+        for ob in chain(session.new, session.dirty, session.deleted))
+
+
+@event.listens_for(get_session_maker(), "after_flush")
+def forget_gathered_votes_after_flush(session, flush_context):
+    if session.info.get('gathered_votes') and _has_vote_changes(session):
+        session.info['gathered_votes'].clear()
+
+
+@event.listens_for(get_session_maker(), "after_transaction_end")
+def forget_gathered_votes(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('gathered_votes', None)
@@ -820,9 +820,20 @@ class VotingWidget(BaseIdeaWidget):
         return 'local:Conversation/%d/widgets/%d/targets/%d/votes' % (
             self.discussion_id, self.id, Idea.get_database_id(idea_id))
 
+    def gathered_votes(self):
+        """The live votes of this widget, as a dictionary of vote_spec_id ->
+        :py:class:`assembl.models.votes.VoteColumns`.
+
+        Cached until a vote or vote specification of this widget changes,
+        or gathered once per transaction without a fragment cache."""
+        from ..lib.jsonld_cache import cached_for_version
+        return cached_for_version(
+            self, "votes",
+            lambda: AbstractVoteSpecification.gather_widget_votes_once(self))
+
     def all_voting_results(self):
         return {
-            spec.uri(): spec.voting_results()
+            spec.uri(): spec.cached_voting_results()
             for spec in self.vote_specifications
         }
 
@@ -58,9 +58,33 @@ class WordCounter(defaultdict):
         stemmed = self.stemmer.stemWord(word.lower())
         self[stemmed].add(word, weight)
 
+    def as_vector(self):
+        """A compact, serializable term vector: stem -> (weight, shortest word)"""
+        return {stem: (words.counter, words.shortest())
+                for (stem, words) in self.items()}
+
+    def add_vector(self, vector, weight=1.0):
+        """Merge a term vector, as given by :py:meth:`as_vector`."""
+        for stem, (counter, word) in vector.items():
+            self[stem].add(word, counter * weight)
+
     def best(self, num=10):
         all_words = list(self.values())
         all_words.sort(key=lambda x: x.counter, reverse=True)
         if len(all_words) > num:
             all_words = all_words[:num]
         return [x.shortest() for x in all_words]
+
+
+def merge_term_vectors(*vectors):
+    """Merge term vectors, as given by :py:meth:`WordCounter.as_vector`."""
+    result = {}
+    for vector in vectors:
+        for stem, (counter, word) in vector.items():
+            if stem in result:
+                (previous_counter, previous_word) = result[stem]
+                if len(previous_word) <= len(word):
+                    word = previous_word
+                counter += previous_counter
+            result[stem] = (counter, word)
+    return result
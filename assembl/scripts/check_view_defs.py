@@ -0,0 +1,46 @@
+"""Check the view_defs against the models, and report which classes
+each view_def serializes."""
+import argparse
+import sys
+
+from pyramid.paster import get_appsettings
+
+from assembl.lib.sqla import configure_engine
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+
+def check_view_defs(names=None, coverage=False):
+    """Print view_def errors, and optionally coverage.
+
+    :returns: the number of errors"""
+    import assembl.models  # noqa: F401 (load the mappers)
+    from assembl.view_def import view_def_names
+    from assembl.view_def.compiler import compile_view_defs, view_def_coverage
+    names = names or view_def_names()
+    errors = compile_view_defs(names)
+    for (name, typename), error in sorted(errors.items()):
+        print("%s/%s: %s" % (name, typename, error))
+    if coverage:
+        for name in names:
+            print("\n%s:" % (name,))
+            for category, typenames in view_def_coverage(name).items():
+                if typenames:
+                    print("  %s (%d): %s" % (
+                        category, len(typenames), ", ".join(typenames)))
+    return len(errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("view_defs", nargs="*",
+                        help="view_defs to check (default: all)")
+    parser.add_argument("--coverage", action="store_true", default=False,
+                        help="report the classes covered by each view_def")
+    args = parser.parse_args()
+    settings = get_appsettings(args.configuration, 'idealoom')
+    set_config(settings)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    sys.exit(1 if check_view_defs(args.view_defs, args.coverage) else 0)
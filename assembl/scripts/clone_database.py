@@ -1,13 +1,15 @@
 """Clone all data from a database to another. Mostly useful for database migration."""
 from builtins import str
-from builtins import zip
 import argparse
 import logging.config
 import traceback
 import pdb
+from tempfile import SpooledTemporaryFile
+from time import time
 
 from sqlalchemy import (
-    Table, Column, String, insert, select, delete, create_engine, update)
+    Table, Column, String, Integer, BigInteger, MetaData, select, delete,
+    update, func, and_)
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql.expression import cast
 from sqlalchemy.types import TIMESTAMP, DATETIME
@@ -35,6 +37,13 @@ column_casts = {
 history_tables = ["idea", "idea_idea_link", "idea_vote"]
 
 
+# Rows per COPY chunk
+CHUNK_SIZE = 20000
+
+# Chunks larger than this are spooled to disk
+SPOOL_SIZE = 64 * 1024 * 1024
+
+
 def maybe_cast(column):
     cast_to = column_casts.get(column.table.name, {}).get(column.name, None)
     return column if cast_to is None else cast(column, cast_to)
@@ -47,40 +56,105 @@ def set_sequence(session, name, value):
 
 
 def get_sequence(session, name):
-    return session.query("currval('%s')" % (name,)).first()[0]
+    return session.execute("SELECT last_value FROM %s" % (name,)).scalar()
+
+
+def as_sql(session, query):
+    return str(query.compile(
+        dialect=session.bind.dialect, compile_kwargs={"literal_binds": True}))
+
+
+def table_count(session, table):
+    return session.execute(select([func.count()]).select_from(table)).scalar()
+
+
+def create_order_table(source_session, source_table):
+    """Number the rows of a recursive table by depth in a temporary table,
+    so parents are copied in earlier chunks than their children."""
+    idx_name, fkey_name = recursive_tables[source_table.name]
+    order_table = Table(
+        "copy_order_" + source_table.name, MetaData(),
+        Column('id', Integer), Column('ord', BigInteger))
+    source_session.execute("""
+        CREATE TEMPORARY TABLE {order_table} AS
+        WITH RECURSIVE tree(id, depth) AS (
+            SELECT {idx} , 0 FROM {table} WHERE {fkey} IS NULL
+            UNION ALL
+            SELECT t.{idx}, tree.depth + 1 FROM {table} AS t
+                JOIN tree ON t.{fkey} = tree.id)
+        SELECT id, row_number() OVER (ORDER BY depth, id) AS ord FROM tree
+        """.format(order_table=order_table.name, idx=idx_name,
+                   fkey=fkey_name, table=source_table.fullname))
+    source_session.execute("CREATE INDEX ON %s (ord)" % (order_table.name,))
+    return order_table
+
+
+def chunk_queries(source_session, source_table, columns):
+    """Queries for successive chunks of a table, in dependency order"""
+    if source_table.name in recursive_tables:
+        order_table = create_order_table(source_session, source_table)
+        idx_col = source_table.c[recursive_tables[source_table.name][0]]
+        query = select(columns).select_from(source_table.join(
+            order_table, order_table.c.id == idx_col))
+        total = table_count(source_session, order_table)
+        for start in range(0, total, CHUNK_SIZE):
+            yield query.where(and_(
+                order_table.c.ord > start,
+                order_table.c.ord <= start + CHUNK_SIZE))
+        source_session.execute("DROP TABLE %s" % (order_table.name,))
+        return
+    idx_col = source_table.c.get("id", None)
+    if idx_col is None or not isinstance(idx_col.type, Integer):
+        yield select(columns)
+        return
+    last_id = None
+    while True:
+        query = select(columns)
+        boundary_query = select([idx_col]).order_by(idx_col).offset(
+            CHUNK_SIZE - 1).limit(1)
+        if last_id is not None:
+            query = query.where(idx_col > last_id)
+            boundary_query = boundary_query.where(idx_col > last_id)
+        boundary = source_session.execute(boundary_query).scalar()
+        if boundary is None:
+            yield query
+            return
+        yield query.where(idx_col <= boundary)
+        last_id = boundary
 
 
 def copy_table(source_session, dest_session, source_table, dest_table):
+    """Stream a table with COPY, in chunks of bounded size."""
+    preparer = dest_session.bind.dialect.identifier_preparer
     columns = [maybe_cast(c) for c in source_table.c]
-    cnames = [c.name for c in source_table.c]
-    values = source_session.query(*columns)
-    values = [dict(list(zip(cnames, val))) for val in values]
-    if not len(values):
-        return
-    if source_table.name in recursive_tables:
-        idx_name, fkey_name = recursive_tables[source_table.name]
-        done = set()
-        while len(values):
-            batch = values
-            values = []
-            next_batch = []
-            for val in batch:
-                fkey = val[fkey_name]
-                if fkey is None or fkey in done:
-                    values.append(val)
-                else:
-                    next_batch.append(val)
-            assert len(values)
-            dest_session.execute(dest_table.insert(), values)
-            done.update((val[idx_name] for val in values))
-            values = next_batch
-    else:
-        dest_session.execute(dest_table.insert(), values)
-    if str(dest_session.bind.url).startswith('postgresql'):
+    copy_from = "COPY %s (%s) FROM STDIN" % (
+        preparer.format_table(dest_table),
+        ", ".join(preparer.quote(c.name) for c in source_table.c))
+    total = table_count(source_session, source_table)
+    source_cursor = source_session.connection().connection.cursor()
+    dest_cursor = dest_session.connection().connection.cursor()
+    start = time()
+    copied = size = 0
+    for query in chunk_queries(source_session, source_table, columns):
+        with SpooledTemporaryFile(max_size=SPOOL_SIZE) as buffer:
+            source_cursor.copy_expert(
+                "COPY (%s) TO STDOUT" % (as_sql(source_session, query),),
+                buffer)
+            size += buffer.tell()
+            buffer.seek(0)
+            dest_cursor.copy_expert(copy_from, buffer)
+            copied += dest_cursor.rowcount
+        elapsed = (time() - start) or 1e-6
+        print("%s: %d/%d rows, %d rows/s, %.1f MB/s" % (
+            dest_table.name, copied, total, copied / elapsed,
+            size / elapsed / 1048576))
+    assert copied == total, "%s: copied %d rows out of %d" % (
+        dest_table.name, copied, total)
+    if copied:
         idx_col = dest_table.c.get("id", None)
         if idx_col is not None and not idx_col.foreign_keys:
-            (max_id,) = source_session.query(
-                'max(id) from "%s"' % (source_table.name,)).first()
+            max_id = source_session.execute(
+                select([func.max(source_table.c.id)])).scalar()
             if dest_table.name in history_tables:
                 max_id = max(max_id, get_sequence(
                     source_session, source_table.fullname+"_idsequence"))
@@ -89,6 +163,13 @@ def copy_table(source_session, dest_session, source_table, dest_table):
                 set_sequence(dest_session, dest_table.fullname+"_id_seq", max_id)
 
 
+def clear_table(dest_session, table):
+    if table.name in recursive_tables:
+        colname = recursive_tables[table.name][1]
+        dest_session.execute(update(table).values(**{colname: None}))
+    dest_session.execute(delete(table))
+
+
 def engine_from_settings(config, full_config=False):
     settings = get_appsettings(config, 'idealoom')
     db_schema = settings['db_schema']
@@ -110,7 +191,11 @@ def engine_from_settings(config, full_config=False):
     return (metadata, session)
 
 
-def copy_database(source_config, dest_config):
+def copy_database(source_config, dest_config, resume=False):
+    """Copy all tables, committing after each one.
+
+    With resume, tables that already have as many rows as the source
+    are skipped, instead of wiping the destination."""
     dest_metadata, dest_session = engine_from_settings(
         dest_config, True)
     dest_tables = dest_metadata.sorted_tables
@@ -121,17 +206,22 @@ def copy_database(source_config, dest_config):
         for table in dest_tables
     }
 
-    for table in reversed(dest_tables):
-        if table.name in recursive_tables:
-            colname = recursive_tables[table.name][1]
-            dest_session.execute(update(table).values(**{colname: None}))
-        dest_session.execute(delete(table))
+    if not resume:
+        for table in reversed(dest_tables):
+            clear_table(dest_session, table)
+        dest_session.commit()
 
     for table in dest_tables:
-        copy_table(
-            source_session, dest_session,
-            source_tables_by_name[table.name], table)
-    dest_session.commit()
+        source_table = source_tables_by_name[table.name]
+        if resume:
+            dest_count = table_count(dest_session, table)
+            if dest_count == table_count(source_session, source_table):
+                print("%s: already copied" % (table.name,))
+                continue
+            if dest_count:
+                clear_table(dest_session, table)
+        copy_table(source_session, dest_session, source_table, table)
+        dest_session.commit()
 
 
 if __name__ == '__main__':
@@ -145,12 +235,15 @@ if __name__ == '__main__':
         help="""configuration file with target database configuration.""")
     parser.add_argument("--debug", action="store_true", default=False,
                         help="enter pdb on failure")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="do not wipe the destination, and skip tables "
+                        "that were already copied")
 
     args = parser.parse_args()
     assert args.source_config != args.dest_config,\
         "source and destination must be different!"
     try:
-        copy_database(args.source_config, args.dest_config)
+        copy_database(args.source_config, args.dest_config, args.resume)
     except Exception as e:
         traceback.print_exc()
         if args.debug:
@@ -23,8 +23,11 @@ from sqlalchemy.orm import (
 from sqlalchemy.orm.properties import ColumnProperty
 import transaction
 from sqlalchemy.sql.visitors import ClauseVisitor
-from sqlalchemy.sql.expression import and_
-from sqlalchemy import inspect
+from sqlalchemy.sql.expression import (
+    and_, select, func, literal, text)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import (
+    inspect, Table, MetaData, Column, Integer, Sequence)
 
 from assembl.auth import SYSTEM_ROLES, ASSEMBL_PERMISSIONS
 from assembl.lib.config import set_config, get_config
@@ -387,10 +390,10 @@ class JoinColumnsVisitor(ClauseVisitor):
             self.missing.append(column)
 
 
-def delete_discussion(session, discussion_id):
-    from assembl.models import (
-        Base, Discussion, DiscussionBoundBase, Preferences, LangStringEntry)
-    # delete anything related first
+def discussion_classes_by_table():
+    """The mapped classes by table, and the concrete discussion-bound classes,
+    i.e. direct subclasses of an abstract class."""
+    from assembl.models import Base, DiscussionBoundBase
     classes = [m.class_ for m in Base.registry.mappers]
     classes_by_table = defaultdict(list)
     for cls in classes:
@@ -412,6 +415,27 @@ def delete_discussion(session, discussion_id):
                                 *list(classes_by_table.values()))
                             if issubclass(cls, DiscussionBoundBase) and
                             is_concrete_class(cls)])
+    return classes_by_table, concrete_classes
+
+
+def discussion_ids_query(session, cls, discussion_id, classes_by_table):
+    """A query for the ids of the instances of cls in the discussion"""
+    if not hasattr(cls, "get_discussion_conditions"):
+        return None
+    query = session.query(cls.id)
+    conds = cls.get_discussion_conditions(discussion_id)
+    assert conds
+    cond = and_(*conds)
+    v = JoinColumnsVisitor(cls, query, classes_by_table)
+    v.traverse(cond)
+    return v.final_query().filter(cond)
+
+
+def delete_discussion(session, discussion_id):
+    from assembl.models import (
+        Discussion, DiscussionBoundBase, Preferences, LangStringEntry)
+    # delete anything related first
+    classes_by_table, concrete_classes = discussion_classes_by_table()
     concrete_classes.add(Preferences)
     concrete_classes.add(LangStringEntry)
     tables = DiscussionBoundBase.metadata.sorted_tables
@@ -428,16 +452,10 @@ def delete_discussion(session, discussion_id):
             if cls not in concrete_classes:
                 continue
             print('deleting', cls.__name__)
-            query = session.query(cls.id)
-            if hasattr(cls, "get_discussion_conditions"):
-                conds = cls.get_discussion_conditions(discussion_id)
-            else:
+            query = discussion_ids_query(
+                session, cls, discussion_id, classes_by_table)
+            if query is None:
                 continue
-            assert conds
-            cond = and_(*conds)
-            v = JoinColumnsVisitor(cls, query, classes_by_table)
-            v.traverse(cond)
-            query = v.final_query().filter(cond)
             if query.count():
                 print("*" * 20, "Not all deleted!")
                 ids = {x for (x,) in query.all() if x}
@@ -449,6 +467,30 @@ def delete_discussion(session, discussion_id):
             session.flush()
 
 
+def update_vote_specification_uris(widget):
+    """Make the vote specification URIs in the settings of a cloned
+    :py:class:`assembl.models.widgets.MultiCriterionVotingWidget`
+    designate the cloned vote specifications."""
+    # TODO similar for tokens?
+    uri_equivs = {}
+    uri_qnum = {}
+    for vs in widget.vote_specifications:
+        j = vs.settings_json
+        old_id = j.get('@id', None)
+        uri = vs.uri()
+        j['@id'] = uri
+        vs.settings_json = j
+        if old_id:
+            uri_equivs[old_id] = uri
+        uri_qnum[vs.question_id] = uri
+    j = widget.settings_json
+    for qnum, item in enumerate(j['items']):
+        for spec in item['vote_specifications']:
+            old_id = spec["@id"]
+            spec["@id"] = uri_equivs.get(old_id, uri_qnum.get(qnum, old_id))
+    widget.settings_json = j
+
+
 def clone_discussion(
         from_session, discussion_id, to_session=None, new_slug=None):
     from assembl.models import (
@@ -658,24 +700,7 @@ def clone_discussion(
             for subob in subobs:
                 stage_2_rec_clone(subob, path + [(r.key, subob)])
         if isinstance(copy, MultiCriterionVotingWidget):
-            # TODO similar for tokens?
-            uri_equivs = {}
-            uri_qnum = {}
-            for vs in copy.vote_specifications:
-                j = vs.settings_json
-                old_id = j.get('@id', None)
-                uri = vs.uri()
-                j['@id'] = uri
-                vs.settings_json = j
-                if old_id:
-                    uri_equivs[old_id] = uri
-                uri_qnum[vs.question_id] = uri
-            j = copy.settings_json
-            for qnum, item in enumerate(j['items']):
-                for spec in item['vote_specifications']:
-                    old_id = spec["@id"]
-                    spec["@id"] = uri_equivs.get(old_id, uri_qnum.get(qnum, old_id))
-            copy.settings_json = j
+            update_vote_specification_uris(copy)
 
     path = [('', discussion)]
     copy = recursive_clone(discussion, path)
@@ -688,6 +713,251 @@ def clone_discussion(
     return copy
 
 
+class BulkDiscussionCloner(object):
+    """Clones a discussion within a database, table by table in dependency
+    order, with ``INSERT ... SELECT`` statements.
+
+    New ids are allocated in temporary mapping tables (old id -> new id),
+    one per inheritance root table, and foreign keys to cloned rows are
+    rewritten through them. Besides discussion-bound objects, the
+    discussion's preferences, the langstrings of cloned objects and the
+    identity tables of history classes are cloned; users, roles, permissions
+    and other shared objects are referenced, not copied."""
+
+    def __init__(self, session, discussion_id, new_slug=None):
+        from assembl.models import Base, Discussion
+        self.session = session
+        self.discussion = session.query(Discussion).get(discussion_id)
+        assert self.discussion
+        self.new_slug = new_slug or (self.discussion.slug + "_copy")
+        self.connection = session.connection()
+        self.tables = Base.metadata.sorted_tables
+        self.table_order = {table: i for (i, table) in enumerate(self.tables)}
+        self.classes_by_table, self.concrete_classes = \
+            discussion_classes_by_table()
+        self.root_of_table = {}
+        for mapper in Base.registry.mappers:
+            root = mapper.base_mapper.local_table
+            for table in mapper.tables:
+                self.root_of_table.setdefault(table, root)
+        self.maps = {}
+        self.identity_maps = {}
+        self.forward_references = []
+
+    def map_table(self, root):
+        "The temporary table mapping old to new ids of a root table"
+        map_table = self.maps.get(root, None)
+        if map_table is None:
+            map_table = Table(
+                "clone_map_" + root.name, MetaData(),
+                Column('old_id', Integer, primary_key=True),
+                Column('new_id', Integer, index=True),
+                prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
+            map_table.create(self.connection)
+            self.maps[root] = map_table
+            self.root_of_table.setdefault(root, root)
+        return map_table
+
+    def add_ids(self, root, ids_select):
+        self.connection.execute(pg_insert(self.map_table(root)).from_select(
+            ['old_id'], ids_select).on_conflict_do_nothing())
+
+    def history_class(self, root):
+        from assembl.models import HistoryMixin
+        for cls in self.classes_by_table.get(root, ()):
+            if issubclass(cls, HistoryMixin):
+                return cls
+
+    @staticmethod
+    def next_id(table):
+        id_default = table.c.id.default
+        if isinstance(id_default, Sequence):
+            return id_default.next_value()
+        return func.nextval(func.pg_get_serial_sequence(table.fullname, 'id'))
+
+    def collect_ids(self):
+        """Fill the mapping tables with the ids of the rows to clone"""
+        from assembl.models import Preferences, LangString, LangStringEntry
+        discussion_id = self.discussion.id
+        for cls in self.concrete_classes:
+            query = discussion_ids_query(
+                self.session, cls, discussion_id, self.classes_by_table)
+            if query is not None:
+                self.add_ids(
+                    cls.__mapper__.base_mapper.local_table, query.statement)
+        preferences = self.discussion.preferences
+        if preferences and preferences.name != Preferences.BASE_PREFS_NAME:
+            self.add_ids(Preferences.__table__, select([
+                literal(preferences.id, Integer)]))
+        for root in list(self.maps):
+            cls = self.history_class(root)
+            if cls is not None:
+                root_map = self.maps[root]
+                identity_table = cls.identity_table
+                self.add_ids(identity_table, select(
+                    [root.c.base_id]).select_from(root.join(
+                        root_map, root_map.c.old_id == root.c.id)).distinct())
+                self.identity_maps[identity_table] = (root, cls.id_sequence)
+        # Langstrings of cloned rows are cloned, with their entries.
+        langstring_table = LangString.__table__
+        for table in self.tables:
+            root = self.root_of_table.get(table, None)
+            if root not in self.maps or root in self.identity_maps:
+                continue
+            root_map = self.maps[root]
+            for column in table.columns:
+                if any(fk.column.table is langstring_table
+                       for fk in column.foreign_keys):
+                    self.add_ids(langstring_table, select(
+                        [column]).select_from(table.join(
+                            root_map, root_map.c.old_id == table.c.id)
+                        ).where(column != None))
+        if langstring_table in self.maps:
+            entry_table = LangStringEntry.__table__
+            self.add_ids(entry_table, select([entry_table.c.id]).where(
+                entry_table.c.langstring_id.in_(
+                    select([self.maps[langstring_table].c.old_id]))))
+
+    def allocate_ids(self):
+        for root, map_table in self.maps.items():
+            if root not in self.identity_maps:
+                self.connection.execute(map_table.update().values(
+                    new_id=self.next_id(root)))
+        # The live version of a history object has id == base_id
+        for identity_table, (root, sequence) in self.identity_maps.items():
+            map_table = self.maps[identity_table]
+            root_map = self.maps[root].alias()
+            self.connection.execute(map_table.update().values(
+                new_id=func.coalesce(
+                    select([root_map.c.new_id]).where(
+                        root_map.c.old_id == map_table.c.old_id
+                    ).as_scalar(), sequence.next_value())))
+
+    def overrides(self, table):
+        from assembl.models import Discussion, Preferences
+        if table is Discussion.__table__:
+            return {'slug': literal(self.new_slug)}
+        if table is Preferences.__table__:
+            return {'name': literal('discussion_' + self.new_slug)}
+        return {}
+
+    def insert_rows(self, table):
+        map_table = self.maps[self.root_of_table[table]]
+        overrides = self.overrides(table)
+        source = table.join(map_table, map_table.c.old_id == table.c.id)
+        values = []
+        for column in table.columns:
+            if column.name == 'id':
+                values.append(map_table.c.new_id)
+                continue
+            if column.name in overrides:
+                values.append(overrides[column.name])
+                continue
+            value = column
+            for fk in column.foreign_keys:
+                target_root = self.root_of_table.get(fk.column.table, None)
+                if target_root not in self.maps or not fk.column.primary_key:
+                    continue
+                if self.table_order[fk.column.table] > self.table_order[table]:
+                    # Keep the old reference until the target is cloned
+                    self.forward_references.append((table, column, target_root))
+                    continue
+                target_map = self.maps[target_root].alias()
+                source = source.outerjoin(
+                    target_map, target_map.c.old_id == column)
+                value = func.coalesce(target_map.c.new_id, column)
+            values.append(value)
+        result = self.connection.execute(table.insert().from_select(
+            list(table.columns), select(values).select_from(source)))
+        print("cloned", result.rowcount, "rows of", table.name)
+
+    def update_forward_references(self):
+        for (table, column, target_root) in self.forward_references:
+            map_table = self.maps[self.root_of_table[table]]
+            target_map = self.maps[target_root].alias()
+            self.connection.execute(table.update().values(
+                {column: target_map.c.new_id}).where(and_(
+                    table.c.id == map_table.c.new_id,
+                    column == target_map.c.old_id)))
+
+    def set_post_ancestry(self):
+        from assembl.models import Post
+        post = Post.__table__
+        content_map = self.maps.get(self.root_of_table[post], None)
+        if content_map is None:
+            return
+        self.connection.execute(text("""
+            WITH RECURSIVE ancestry(id, ancestry) AS (
+                SELECT post.id, CAST('' AS VARCHAR) FROM {post} AS post
+                    JOIN {map} AS map ON map.new_id = post.id
+                    WHERE post.parent_id IS NULL
+                UNION ALL
+                SELECT post.id, ancestry.ancestry || post.parent_id || ','
+                    FROM {post} AS post
+                    JOIN ancestry ON post.parent_id = ancestry.id)
+            UPDATE {post} SET ancestry = ancestry.ancestry FROM ancestry
+                WHERE {post}.id = ancestry.id""".format(
+            post=post.fullname, map=content_map.name)))
+
+    def new_id(self, table, old_id):
+        map_table = self.maps[self.root_of_table[table]]
+        return self.connection.execute(select([map_table.c.new_id]).where(
+            map_table.c.old_id == old_id)).scalar()
+
+    def clone(self):
+        from assembl.models import (
+            Discussion, MultiCriterionVotingWidget, IdeaClosure,
+            IdeaPostMembership)
+        self.collect_ids()
+        self.allocate_ids()
+        for table in self.tables:
+            if self.root_of_table.get(table, None) in self.maps:
+                self.insert_rows(table)
+        self.update_forward_references()
+        self.set_post_ancestry()
+        copy = self.session.query(Discussion).get(
+            self.new_id(Discussion.__table__, self.discussion.id))
+        IdeaClosure.rebuild(self.connection, copy.id)
+        IdeaPostMembership.refresh(self.session, copy.id)
+        for widget in self.session.query(MultiCriterionVotingWidget
+                                         ).filter_by(discussion_id=copy.id):
+            update_vote_specification_uris(widget)
+        return copy
+
+    def verify(self):
+        """Compare the row counts of the original and the clone, per table.
+
+        Returns the list of (table name, original count, copy count)
+        that differ."""
+        differences = []
+        for table in self.tables:
+            map_table = self.maps.get(self.root_of_table.get(table, None))
+            if map_table is None:
+                continue
+            counts = [self.connection.execute(select(
+                [func.count(table.c.id)]).select_from(table.join(
+                    map_table, table.c.id == map_column))).scalar()
+                for map_column in (map_table.c.old_id, map_table.c.new_id)]
+            if counts[0] != counts[1]:
+                differences.append((table.name, counts[0], counts[1]))
+            print(table.name, counts[0], counts[1],
+                  "" if counts[0] == counts[1] else "MISMATCH")
+        return differences
+
+
+def bulk_clone_discussion(session, discussion_id, new_slug=None, verify=False):
+    """Clone a discussion within a database, with bulk statements.
+
+    Cf. :py:class:`BulkDiscussionCloner`"""
+    cloner = BulkDiscussionCloner(session, discussion_id, new_slug)
+    copy = cloner.clone()
+    if verify:
+        differences = cloner.verify()
+        assert not differences, "Clone differs from original: %s" % (
+            differences,)
+    return copy
+
+
 def engine_from_settings(config, full_config=False):
     settings = get_appsettings(config, 'idealoom')
     db_schema = settings['db_schema']
@@ -712,7 +982,7 @@ def engine_from_settings(config, full_config=False):
 
 
 def copy_discussion(source_config, dest_config, source_slug, dest_slug,
-                    delete=False, debug=False, permissions=None):
+                    delete=False, debug=False, permissions=None, verify=False):
     if (session_maker_is_initialized() and abspath(source_config) == get_config()["__file__"]):
         # not running from script
         dest_session = get_session_maker()()
@@ -756,8 +1026,12 @@ def copy_discussion(source_config, dest_config, source_slug, dest_slug,
                 exit(0)
         from assembl.models import Role, Permission, DiscussionPermission
         with dest_session.no_autoflush:
-            copy = clone_discussion(
-                source_session, discussion.id, dest_session, dest_slug)
+            if source_session is dest_session:
+                copy = bulk_clone_discussion(
+                    dest_session, discussion.id, dest_slug, verify)
+            else:
+                copy = clone_discussion(
+                    source_session, discussion.id, dest_session, dest_slug)
             for (role, permission) in permissions:
                 role = dest_session.query(Role).filter_by(name=role).one()
                 permission = dest_session.query(Permission).filter_by(
@@ -790,6 +1064,9 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--permissions", action="append", default=[],
                         help="Add a role+permission pair to the copy "
                         "(eg system.Authenticated+admin_discussion)")
+    parser.add_argument("--verify", action="store_true", default=False,
+                        help="compare row counts per table after a clone "
+                        "within the same database")
     args = parser.parse_args()
     new_name = args.new_name or (
         args.discussion + ("" if args.source_db_configuration else "_copy"))
@@ -798,4 +1075,4 @@ if __name__ == '__main__':
             args.source_db_configuration or args.configuration,
             args.configuration,
             args.discussion, new_name,
-            args.delete, args.debug, args.permissions)
+            args.delete, args.debug, args.permissions, args.verify)
@@ -0,0 +1,32 @@
+"""Delete old values from the file-backed dogpile cache, which never evicts
+them (e.g. JSON-LD fragments of old object versions).
+Run it periodically, e.g. from cron."""
+import argparse
+import logging.config
+
+from pyramid.paster import get_appsettings
+
+from assembl.lib.config import set_config
+from assembl.lib.jsonld_cache import (
+    get_dogpile_region, purge_expired, FRAGMENT_REGION)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("--max-age", type=int, default=None,
+                        help="in seconds (default: the expiration time)")
+    args = parser.parse_args()
+    settings = get_appsettings(args.configuration, 'idealoom')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    # all regions share the cache file
+    region = get_dogpile_region(FRAGMENT_REGION)
+    if not region.is_configured:
+        print("The dogpile cache is not configured")
+    else:
+        purged = purge_expired(region, args.max_age)
+        if purged is None:
+            print("The dogpile cache is not file-backed")
+        else:
+            print("Purged %d cache entries" % (purged,))
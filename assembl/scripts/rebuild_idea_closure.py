@@ -0,0 +1,46 @@
+"""Rebuild the closure table of the idea hierarchy,
+for all discussions or the given ones."""
+import argparse
+import traceback
+import pdb
+import logging.config
+
+from pyramid.paster import get_appsettings
+import transaction
+
+from assembl.lib.sqla import configure_engine, get_session_maker, mark_changed
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+
+def rebuild_idea_closure(db, discussion_ids=None):
+    from assembl.models import Discussion, IdeaClosure
+    if not discussion_ids:
+        discussion_ids = [id for (id,) in db.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        IdeaClosure.rebuild(db, discussion_id)
+        print("Rebuilt idea closure of discussion %d" % (discussion_id,))
+    mark_changed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion_ids", nargs="*", type=int,
+                        help="discussions to rebuild (default: all)")
+    parser.add_argument("--debug", action="store_true", default=False,
+                        help="enter pdb on failure")
+    args = parser.parse_args()
+    settings = get_appsettings(args.configuration, 'idealoom')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    session = get_session_maker()()
+    try:
+        with transaction.manager:
+            rebuild_idea_closure(session, args.discussion_ids)
+    except Exception:
+        traceback.print_exc()
+        if args.debug:
+            pdb.post_mortem()
@@ -0,0 +1,59 @@
+"""Recompute the stored previews of post bodies,
+for all discussions or the given ones.
+
+Run this after changing :py:attr:`assembl.models.post.Post.PREVIEW_LENGTH`."""
+import argparse
+import traceback
+import pdb
+import logging.config
+
+from pyramid.paster import get_appsettings
+import transaction
+
+from assembl.lib.sqla import configure_engine, get_session_maker
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+BATCH_SIZE = 500
+
+
+def rebuild_post_previews(db, discussion_ids=None, batch_size=BATCH_SIZE):
+    from assembl.models import Discussion, Post
+    if not discussion_ids:
+        discussion_ids = [id for (id,) in db.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        post_ids = [id for (id,) in db.query(Post.id).filter_by(
+            discussion_id=discussion_id).order_by(Post.id)]
+        for start in range(0, len(post_ids), batch_size):
+            posts = db.query(Post).filter(
+                Post.id.in_(post_ids[start:start + batch_size])).options(
+                *Post.subqueryload_options())
+            for post in posts:
+                post.update_body_previews()
+            db.flush()
+            db.expunge_all()
+        print("Rebuilt %d post previews of discussion %d" % (
+            len(post_ids), discussion_id))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion_ids", nargs="*", type=int,
+                        help="discussions to rebuild (default: all)")
+    parser.add_argument("--debug", action="store_true", default=False,
+                        help="enter pdb on failure")
+    args = parser.parse_args()
+    settings = get_appsettings(args.configuration, 'idealoom')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    session = get_session_maker()()
+    try:
+        with transaction.manager:
+            rebuild_post_previews(session, args.discussion_ids)
+    except Exception:
+        traceback.print_exc()
+        if args.debug:
+            pdb.post_mortem()
@@ -3,9 +3,17 @@ import re
 from os import urandom
 from abc import abstractmethod
 from base64 import urlsafe_b64encode, urlsafe_b64decode
+from functools import lru_cache
 
 
 class Obfuscator(object):
+    """Replaces agent ids in URIs by an encrypted form.
+
+    Encrypted ids are memoized per obfuscator (hence per salt), as the same
+    few agents recur many times in a discussion export."""
+    def __init__(self):
+        self._encrypted = {}
+
     @abstractmethod
     def encrypt(self, text):
         pass
@@ -19,10 +27,35 @@ class Obfuscator(object):
     obfuscate_re = re.compile(r'(%s/)(\d+)\b' % (type_names,))
     deobfuscate_re = re.compile(r'(%s(?:\\?)/)([-=\w]+)' % (type_names,))
 
+    def encrypt_memo(self, text):
+        code = self._encrypted.get(text, None)
+        if code is None:
+            code = self._encrypted[text] = self.encrypt(text)
+        return code
+
+    def obfuscate_uri(self, uri):
+        """Obfuscate a single (short or full) URI."""
+        return self.obfuscate(uri)
+
     def obfuscate(self, serialized_rdf, obfuscator=None):
-        # Work in progress.
         return self.obfuscate_re.sub(lambda matchob: (
-            matchob.group(1) + self.encrypt(matchob.group(2))), serialized_rdf)
+            matchob.group(1) + self.encrypt_memo(matchob.group(2))),
+            serialized_rdf)
+
+    @classmethod
+    def split_ids(cls, serialized_rdf):
+        """Split a serialized text around its agent ids, once, so it can then
+        be obfuscated with any salt by :py:meth:`obfuscate_parts`,
+        without a regex pass.
+
+        :returns: a list alternating text, URI prefix and agent id"""
+        return cls.obfuscate_re.split(serialized_rdf)
+
+    def obfuscate_parts(self, parts):
+        """Join the parts made by :py:meth:`split_ids`, with encrypted ids"""
+        return ''.join(
+            self.encrypt_memo(part) if i % 3 == 2 else part
+            for (i, part) in enumerate(parts))
 
     def deobfuscate(self, serialized_rdf):
         # Work in progress.
@@ -31,25 +64,47 @@ class Obfuscator(object):
 
 
 class AESObfuscator(Obfuscator):
+    """Encrypts with AES in CTR mode with a constant IV.
+
+    The keystream is thus the same for every text, and is computed once
+    and XORed with the texts, instead of creating an encryptor per text."""
     def __init__(self, key=None, blocklen=16):
+        super(AESObfuscator, self).__init__()
         from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
         from cryptography.hazmat.backends import default_backend
         key = key or urandom(blocklen)
         iv = b' ' * blocklen
         self.blocklen = blocklen
         self.cipher = Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend())
+        self._keystream = b''
+
+    def keystream(self, length):
+        if length > len(self._keystream):
+            length = max(length, 4 * self.blocklen)
+            encryptor = self.cipher.encryptor()
+            self._keystream = encryptor.update(b'\0' * length) + encryptor.finalize()
+        return self._keystream
+
+    def _xor(self, data):
+        keystream = self.keystream(len(data))
+        return bytes(a ^ b for (a, b) in zip(data, keystream))
 
     def encrypt(self, text):
         text = text.encode('utf-8')
-        encryptor = self.cipher.encryptor()
-        return urlsafe_b64encode(encryptor.update(text) + encryptor.finalize()).decode('iso-8859-1')
+        return urlsafe_b64encode(self._xor(text)).decode('iso-8859-1')
 
     def decrypt(self, code):
-        decryptor = self.cipher.decryptor()
         code = code.encode('iso-8859-1')
-        text = decryptor.update(urlsafe_b64decode(code)) + decryptor.finalize()
+        text = self._xor(urlsafe_b64decode(code))
         return text.decode('utf-8')
 
     def pad(self, key, blocklen=None, padding=b' '):
         blocklen = blocklen or self.blocklen
         return key + padding * (blocklen - (len(key) % blocklen))
+
+
+@lru_cache(maxsize=64)
+def get_obfuscator(salt):
+    """A shared :py:class:`AESObfuscator` for a given salt, so its memo table
+    can be reused across requests using the same token."""
+    return AESObfuscator(salt)
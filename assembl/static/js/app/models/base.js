@@ -316,6 +316,16 @@ class BaseCollection extends Backbone.Collection {
                     );
                 }
             }
+        } else if ((model === null || model === undefined) && item["@partial"]) {
+            // partial updates cannot create a model
+            if (debug) {
+                console.log(
+                    "updateFromSocket(): Ignoring partial update not in collection: ",
+                    item["@type"],
+                    item["@id"],
+                    item
+                );
+            }
         } else if (model === null || model === undefined) {
             // oops, doesn't exist
             if (debug) {
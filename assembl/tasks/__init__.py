@@ -144,6 +144,7 @@ class CeleryWithConfig(Celery):
         import assembl.tasks.imap
         import assembl.tasks.notify
         import assembl.tasks.notification_dispatch
+        import assembl.tasks.piwik
         import assembl.tasks.translate
 
 
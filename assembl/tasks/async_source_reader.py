@@ -0,0 +1,187 @@
+"""Run the source readers on an asyncio event loop, instead of a thread each.
+
+The reading cycle of each reader (:py:meth:`SourceReader.run_steps`) is
+driven by a coroutine. Waiting (between reads, during error backoff,
+or until woken) happens on the loop and holds no thread.
+The blocking parts of the cycle (login, reads, database updates) run in a
+thread pool per reader class, whose size bounds the concurrency of that
+source type.
+
+IMAP IDLE is still a blocking call of the IMAP client libraries, so
+readers that wait for pushed data hold a thread while they wait.
+
+Each reader gets its own database session, which is installed as the
+scoped session of the pool thread while its steps run.
+"""
+import asyncio
+import logging
+from threading import Thread
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+from ..lib.sqla import get_session_maker
+from .source_reader import WAIT_FOR_PUSH
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 4
+
+# Marks the end of a reader's cycle
+_DONE = object()
+
+
+class LoopEvent(object):
+    """Replaces the reader's :py:class:`threading.Event`, so it can be woken
+    from any thread while it waits on the loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = None
+
+    def _get_event(self):
+        # created lazily, in the loop's thread
+        if self.event is None:
+            self.event = asyncio.Event()
+        return self.event
+
+    def set(self):
+        self.loop.call_soon_threadsafe(lambda: self._get_event().set())
+
+    def clear(self):
+        self.loop.call_soon_threadsafe(lambda: self._get_event().clear())
+
+    async def wait(self, timeout):
+        event = self._get_event()
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            event.clear()
+
+
+class AsyncReaderHost(object):
+    """Hosts source readers on an event loop, running in its own thread.
+
+    :param concurrency: the maximum number of concurrent blocking
+        calls, by reader class name"""
+
+    def __init__(self, concurrency=None,
+                 default_concurrency=DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.executors = {}
+        self.push_executors = {}
+        self.tasks = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(
+            target=self.run_loop, name="source_reader_loop", daemon=True)
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def executor_for(self, reader):
+        cls_name = reader.__class__.__name__
+        executor = self.executors.get(cls_name, None)
+        if executor is None:
+            executor = self.executors[cls_name] = ThreadPoolExecutor(
+                self.concurrency.get(cls_name, self.default_concurrency),
+                thread_name_prefix=cls_name)
+        return executor
+
+    def push_executor_for(self, reader):
+        # waiting for push blocks, and must not starve the shared pool
+        executor = self.push_executors.get(reader.source_id, None)
+        if executor is None:
+            executor = self.push_executors[reader.source_id] = \
+                ThreadPoolExecutor(1, thread_name_prefix="push_%d" % (
+                    reader.source_id,))
+        return executor
+
+    def start_reader(self, reader):
+        """Start the reading cycle of a reader. Thread-safe."""
+        reader.event = LoopEvent(self.loop)
+        future = asyncio.run_coroutine_threadsafe(
+            self.drive(reader), self.loop)
+        self.tasks[reader.source_id] = future
+        future.add_done_callback(
+            lambda f: self.reader_done(reader, f))
+        return future
+
+    def reader_done(self, reader, future):
+        if self.tasks.get(reader.source_id, None) is future:
+            self.tasks.pop(reader.source_id)
+        executor = self.push_executors.pop(reader.source_id, None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Reader %s failed: %s", reader, future.exception())
+
+    @staticmethod
+    def in_session(session, function, *args):
+        session_maker = get_session_maker()
+        session_maker.registry.set(session)
+        try:
+            return function(*args)
+        finally:
+            session_maker.registry.clear()
+
+    @staticmethod
+    def step(steps, error):
+        try:
+            return steps.throw(error) if error else next(steps)
+        except StopIteration:
+            return _DONE
+
+    async def drive(self, reader):
+        """Drive :py:meth:`SourceReader.run_steps` on the loop."""
+        session = get_session_maker().session_factory()
+        executor = self.executor_for(reader)
+        steps = reader.run_steps()
+        error = None
+        try:
+            while True:
+                wait = await self.loop.run_in_executor(
+                    executor, self.in_session, session,
+                    self.step, steps, error)
+                error = None
+                if wait is _DONE:
+                    break
+                elif wait is WAIT_FOR_PUSH:
+                    try:
+                        await self.loop.run_in_executor(
+                            self.push_executor_for(reader), self.in_session,
+                            session, reader.wait_for_push)
+                    except Exception as e:
+                        error = e
+                else:
+                    await reader.event.wait(wait)
+        finally:
+            await self.loop.run_in_executor(executor, session.close)
+
+    def shutdown(self, timeout=30):
+        """Stop the loop, after letting the readers (which must have been
+        shut down) finish their cycle."""
+        futures = list(self.tasks.values())
+        if futures:
+            wait_futures(futures, timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        for executor in chain(self.executors.values(),
+                              self.push_executors.values()):
+            executor.shutdown(wait=False)
+
+
+def make_reader_host(settings):
+    """Create the reader host, with concurrency limits from the settings.
+
+    ``source_reader.concurrency`` sets the default limit per reader class,
+    ``source_reader.concurrency.<ReaderClass>`` the limit of that class."""
+    prefix = 'source_reader.concurrency.'
+    concurrency = {
+        key[len(prefix):]: int(value) for (key, value) in settings.items()
+        if key.startswith(prefix)}
+    return AsyncReaderHost(concurrency, int(settings.get(
+        'source_reader.concurrency', DEFAULT_CONCURRENCY)))
@@ -1,3 +1,8 @@
+"""Create the Piwik (Matomo) site and user of a discussion.
+
+When ``web_analytics_piwik_background`` is set, this is done by a celery task
+after the discussion creation is committed, instead of during it.
+"""
 from __future__ import print_function
 
 from builtins import range
@@ -5,14 +10,20 @@ from builtins import object
 import string
 import random
 import logging
+from time import time
+from urllib.parse import urlencode
 
 import requests
+import transaction
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from zope import interface
 from pyramid.settings import asbool
 
 
 from assembl.lib import config
 from assembl.lib.discussion_creation import IDiscussionCreationCallback
+from . import celery
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +33,25 @@ class AutomaticPiwikBindingAtDiscussionCreation(object):
     """A :py:class:`IDiscussionCreationCallback` that creates a Piwik site and user at discussion creation"""
 
     def discussionCreated(self, discussion):
+        if asbool(config.get('web_analytics_piwik_background', False)):
+            discussion.db.flush()
+            transaction.get().addAfterCommitHook(
+                bind_piwik_after_commit, (discussion.id,))
+        else:
+            bind_piwik(discussion)
+
+
+def bind_piwik_after_commit(success, discussion_id):
+    if success:
+        bind_piwik_task.delay(discussion_id)
+
+
+@celery.task(ignore_result=True, shared=False)
+def bind_piwik_task(discussion_id):
+    from ..models import Discussion
+    with transaction.manager:
+        discussion = Discussion.get(discussion_id)
+        assert discussion is not None
         bind_piwik(discussion)
 
 
@@ -43,15 +73,20 @@ def bind_piwik(discussion, admin=None):
         missing_variables.append("piwik_api_token")
     if len(missing_variables):
         raise RuntimeError("missing configuration variables: " + ", ".join(missing_variables))
+    client = get_client(piwik_url, piwik_api_token)
 
     # TODO: Should this process first check that discussion.web_analytics_piwik_id_site is empty and do something different if it's not? (for example: return an error, so that we empeach discussion statistics to be scattered on different Piwik sites, which is difficult to merge)
 
     try:
-        # Check wether a Piwik user with a `user_email` email exists
+        # Check wether a Piwik user with a `user_email` email exists,
+        # and wether a Piwik site with this URL already exists
+        discussion_urls = discussion.get_discussion_urls()
+        site_url = discussion_urls[0]
         try:
-            user_already_exists = piwik_UsersManager_getUserByEmail(piwik_url, piwik_api_token, user_email)
+            user_already_exists, sites_ids_with_this_url = \
+                client.lookup_user_and_sites(user_email, site_url)
         except requests.ConnectionError:
-            raise RuntimeError("call to Piwik returned an error (piwik_UsersManager_getUserByEmail)")
+            raise RuntimeError("call to Piwik returned an error (lookup_user_and_sites)")
 
         user_created = False
         user_password = ""
@@ -60,11 +95,11 @@ def bind_piwik(discussion, admin=None):
         if not user_already_exists:
             # Create a Piwik user with `user_email` as login and as email
             user_password = string_generator(size=10)
-            user_created = piwik_UsersManager_addUser(piwik_url, piwik_api_token, user_email, user_password, user_email)
+            user_created = client.addUser(user_email, user_password, user_email)
             if not user_created:
                 # Try to find if creation failed because of rare/edge case of a Piwik user already existing with the user_email as login but not as email
                 log.error("##### user not created, trying to find why")
-                user_with_email_as_login_exists = piwik_UsersManager_userExists(piwik_url, piwik_api_token, user_email)
+                user_with_email_as_login_exists = client.userExists(user_email)
                 if user_with_email_as_login_exists:
                     # We will use this strange Piwik user
                     user_login = user_email
@@ -74,10 +109,6 @@ def bind_piwik(discussion, admin=None):
         else:
             user_login = user_already_exists["login"]
 
-        # Check wether a Piwik site with this URL already exists
-        discussion_urls = discussion.get_discussion_urls()
-        site_url = discussion_urls[0]
-        sites_ids_with_this_url = piwik_SitesManager_getSitesIdFromSiteUrl(piwik_url, piwik_api_token, site_url)
         site_id = None
 
         site_already_exists = len(sites_ids_with_this_url) > 0
@@ -94,7 +125,7 @@ def bind_piwik(discussion, admin=None):
             # create a Piwik website
             site_name = discussion.slug
             # TODO: Some parameters here should probably be variables received from somewhere, because they could be different from one platform instance to another, or from one discussion to another, like timezone for example
-            addsite_result = piwik_SitesManager_addSite(piwik_url, piwik_api_token, site_name, discussion_urls, timezone="Europe/Paris", currency="EUR")
+            addsite_result = client.addSite(site_name, discussion_urls, timezone="Europe/Paris", currency="EUR")
             if addsite_result is not False and isinstance(addsite_result, int):
                 site_id = addsite_result
             else:
@@ -102,10 +133,10 @@ def bind_piwik(discussion, admin=None):
 
         if site_id:
             # Give "view" permission to Piwik user on Piwik site
-            permission_given = piwik_UsersManager_setUserAccess(piwik_url, piwik_api_token, user_login, "view", [site_id])
+            permission_given = client.setUserAccess(user_login, "view", [site_id])
             if not permission_given:
                 # Handle corner case of Piwik response being {"result":"error","message":"This user has Super User access and has already permission to access and modify all websites in Piwik. You may remove the Super User access from this user and try again."}
-                user_has_super_user_access = piwik_UsersManager_hasSuperUserAccess(piwik_url, piwik_api_token, user_login)
+                user_has_super_user_access = client.hasSuperUserAccess(user_login)
                 if user_has_super_user_access:
                     permission_given = True
                     log.error("##### This Piwik user exists and is Super User, so he has access to any Piwik site")
@@ -129,198 +160,255 @@ def bind_piwik(discussion, admin=None):
         raise RuntimeError("call to Piwik returned an error")
 
 
-def piwik_UsersManager_userExists(piwik_url, piwik_api_token, userLogin):
-    params = {
-        "module": "API",
-        "format": "JSON",
-        "token_auth": piwik_api_token
-    }
-    params["method"] = "UsersManager.userExists"
-    params["userLogin"] = userLogin # Piwik has two different fields for login and email, but a user can have the same value as login and email
-    result = requests.get(piwik_url, params=params, timeout=15)
-    if result.status_code != 200:
-        raise requests.ConnectionError()
-
-    content = result.json()
-    # log.info( "piwik_UsersManager_userExists", content)
-    if not content:
-        raise requests.ConnectionError()
-
-    user_already_exists = asbool(content.get("value", False))
-    return user_already_exists
+class PiwikClient(object):
+    """A client of the Piwik (Matomo) HTTP API.
+
+    Requests go through pooled :py:class:`requests.Session` objects, with
+    keep-alive. Failed lookups are retried, but not the calls that create
+    or change something (:py:meth:`call_once`), which could be applied twice.
+    Site and user lookups are memoized for ``cache_ttl`` seconds, and
+    invalidated when the client creates them.
+    """
+
+    def __init__(self, piwik_url, piwik_api_token, timeout=15, retries=3,
+                 cache_ttl=300):
+        self.piwik_url = piwik_url
+        self.piwik_api_token = piwik_api_token
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(
+            total=retries, backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.write_session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(total=0, read=False))
+        self.write_session.mount('http://', adapter)
+        self.write_session.mount('https://', adapter)
+
+    def base_params(self, method):
+        return {
+            "module": "API",
+            "format": "JSON",
+            "token_auth": self.piwik_api_token,
+            "method": method,
+        }
 
-def piwik_UsersManager_getUserByEmail(piwik_url, piwik_api_token, userEmail):
-    params = {
-        "module": "API",
-        "format": "JSON",
-        "token_auth": piwik_api_token
-    }
-    params["method"] = "UsersManager.getUserByEmail"
-    params["userEmail"] = userEmail # Piwik has two different fields for login and email, but a user can have the same value as login and email
-    result = requests.get(piwik_url, params=params, timeout=15)
-    if result.status_code != 200:
-        raise requests.ConnectionError()
-
-    content = result.json() # returns something like [{"login":"aaa","email":"aaa@aaa.com"}] or {"result":"error","message":"L'utilisateur 'aaa@aaa.com' est inexistant."}
-    # log.info( "piwik_UsersManager_getUserByEmail", content)
-    if not content:
-        raise requests.ConnectionError()
-
-    if "result" in content and content["result"] == "error":
-        return False
-    else:
+    def get(self, params, session=None):
+        session = session or self.session
+        try:
+            result = session.get(
+                self.piwik_url, params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise requests.ConnectionError(e)
+        if result.status_code != 200:
+            raise requests.ConnectionError()
+        return result.json()
+
+    def call(self, method, **params):
+        """Call a single API lookup method, with retries"""
+        params.update(self.base_params(method))
+        return self.get(params)
+
+    def call_once(self, method, **params):
+        """Call a single API method that changes something, without retries"""
+        params.update(self.base_params(method))
+        return self.get(params, self.write_session)
+
+    def bulk(self, *calls):
+        """Call many API methods in a single request.
+
+        :param calls: pairs of method name and parameters
+        :returns: the list of results, in order"""
+        params = self.base_params("API.getBulkRequest")
+        for i, (method, call_params) in enumerate(calls):
+            call_params = dict(call_params, method=method)
+            params["urls[%d]" % i] = urlencode(call_params, doseq=True)
+        content = self.get(params)
+        if not isinstance(content, list) or len(content) != len(calls):
+            raise requests.ConnectionError()
         return content
 
+    def _cached(self, key):
+        value, expiry = self._cache.get(key, (None, 0))
+        if expiry > time():
+            return value
 
-def piwik_UsersManager_addUser(piwik_url, piwik_api_token, userLogin, password, email, alias=''):
-    params = {
-        "module": "API",
-        "format": "JSON",
-        "token_auth": piwik_api_token
-    }
-    params["method"] = "UsersManager.addUser"
-    params["userLogin"] = userLogin # Piwik has two different fields for login and email, but a user can have the same value as login and email
-    params["password"] = password
-    params["email"] = email
-    if ( alias ):
-        params["alias"] = alias
-    result = requests.get(piwik_url, params=params, timeout=15)
-    if result.status_code != 200:
-        raise requests.ConnectionError()
-
-    content = result.json()
-    # log.debug( "piwik_UsersManager_addUser", content)
-    if not content:
-        raise requests.ConnectionError()
-
-    user_added = ("result" in content and content["result"] == "success")
-    return user_added
+    def _store(self, key, value):
+        self._cache[key] = (value, time() + self.cache_ttl)
 
+    def invalidate(self, key=None):
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    @staticmethod
+    def parse_user_by_email(content):
+        # returns something like [{"login":"aaa","email":"aaa@aaa.com"}] or {"result":"error","message":"L'utilisateur 'aaa@aaa.com' est inexistant."}
+        if not content:
+            raise requests.ConnectionError()
+        if "result" in content and content["result"] == "error":
+            return False
+        return content
 
-def piwik_SitesManager_getSitesIdFromSiteUrl(piwik_url, piwik_api_token, url):
-    params = {
-        "module": "API",
-        "format": "JSON",
-        "token_auth": piwik_api_token,
-        "method": "SitesManager.getSitesIdFromSiteUrl",
-        "url": url,
-    }
+    @staticmethod
+    def parse_sites_ids(content):
+        # Content should be either an empty array, or an array like [{"idsite":"44"}]
+        if not isinstance(content, list):
+            raise requests.ConnectionError()
+        return content
 
-    result = requests.get(piwik_url, params=params, timeout=15)
+    def lookup_user_and_sites(self, user_email, site_url):
+        """Get the user with this email and the ids of sites with this url,
+        in a single request if neither is cached."""
+        user_key = ("user_by_email", user_email)
+        sites_key = ("sites_by_url", site_url)
+        user, sites = self._cached(user_key), self._cached(sites_key)
+        if user is None and sites is None:
+            user, sites = self.bulk(
+                ("UsersManager.getUserByEmail", {"userEmail": user_email}),
+                ("SitesManager.getSitesIdFromSiteUrl", {"url": site_url}))
+            user = self.parse_user_by_email(user)
+            sites = self.parse_sites_ids(sites)
+            self._store(user_key, user)
+            self._store(sites_key, sites)
+        else:
+            if user is None:
+                user = self.getUserByEmail(user_email)
+            if sites is None:
+                sites = self.getSitesIdFromSiteUrl(site_url)
+        return user, sites
+
+    def userExists(self, userLogin):
+        key = ("user_exists", userLogin)
+        value = self._cached(key)
+        if value is None:
+            # Piwik has two different fields for login and email, but a user can have the same value as login and email
+            content = self.call("UsersManager.userExists", userLogin=userLogin)
+            if not content:
+                raise requests.ConnectionError()
+            value = asbool(content.get("value", False))
+            self._store(key, value)
+        return value
+
+    def getUserByEmail(self, userEmail):
+        key = ("user_by_email", userEmail)
+        value = self._cached(key)
+        if value is None:
+            value = self.parse_user_by_email(self.call(
+                "UsersManager.getUserByEmail", userEmail=userEmail))
+            self._store(key, value)
+        return value
+
+    def addUser(self, userLogin, password, email, alias=''):
+        params = dict(userLogin=userLogin, password=password, email=email)
+        if alias:
+            params["alias"] = alias
+        content = self.call_once("UsersManager.addUser", **params)
+        if not content:
+            raise requests.ConnectionError()
+        self.invalidate(("user_by_email", email))
+        self.invalidate(("user_exists", userLogin))
+        return ("result" in content and content["result"] == "success")
+
+    def getSitesIdFromSiteUrl(self, url):
+        key = ("sites_by_url", url)
+        value = self._cached(key)
+        if value is None:
+            value = self.parse_sites_ids(self.call(
+                "SitesManager.getSitesIdFromSiteUrl", url=url))
+            self._store(key, value)
+        return value
+
+    def addSite(self, siteName, urls, **params):
+        """Returns the Piwik id_site of the created website
+        Warning: A new Piwik site is created everytime this method is called, even if another Piwik website already exists with the same name and URLs"""
+        params = {k: v for (k, v) in params.items() if v}
+        if "param_type" in params:
+            params["type"] = params.pop("param_type")
+        content = self.call_once(
+            "SitesManager.addSite", siteName=siteName, urls=urls, **params)
+        # Content should be something like {"value": 47}
+        if not content:
+            raise requests.ConnectionError()
+        for url in urls:
+            self.invalidate(("sites_by_url", url))
+        if "value" in content:
+            return content['value']
+        return False
 
-    if result.status_code != 200:
-        raise requests.ConnectionError()
-    content = result.json() # Content should be either an empty array, or an array like [{"idsite":"44"}]
-    # log.debug( "piwik_SitesManager_getSitesIdFromSiteUrl", content)
-    if not isinstance(content, list):
-        raise requests.ConnectionError()
+    def setUserAccess(self, userLogin, access, idSites):
+        content = self.call_once(
+            "UsersManager.setUserAccess", userLogin=userLogin,
+            access=access, idSites=idSites)
+        if not content:
+            raise requests.ConnectionError()
+        return ("result" in content and content["result"] == "success")
 
-    return content
+    def hasSuperUserAccess(self, userLogin):
+        content = self.call(
+            "UsersManager.hasSuperUserAccess", userLogin=userLogin)
+        # Content should be like {"value": true}
+        if not content:
+            raise requests.ConnectionError()
+        return asbool(content.get("value", False))
 
 
-def piwik_SitesManager_addSite(piwik_url, piwik_api_token, siteName, urls, ecommerce = '', siteSearch = '', searchKeywordParameters = '', searchCategoryParameters = '', excludedIps = '', excludedQueryParameters = '', timezone = '', currency = '', group = '', startDate = '', excludedUserAgents = '', keepURLFragments = '', param_type = '', settings = '', excludeUnknownUrls = ''):
-    """Returns the Piwik id_site of the created website
-    Warning: A new Piwik site is created everytime this method is called, even if another Piwik website already exists with the same name and URLs"""
-    params = {
-        "module": "API",
-        "format": "JSON",
-        "token_auth": piwik_api_token,
-        "method": "SitesManager.addSite",
-        "siteName": siteName,
-        "urls": urls,
-    }
-
-    if ( ecommerce ):
-        params["ecommerce"] = ecommerce
-    if ( siteSearch ):
-        params["siteSearch"] = siteSearch
-    if ( searchKeywordParameters ):
-        params["searchKeywordParameters"] = searchKeywordParameters
-    if ( searchCategoryParameters ):
-        params["searchCategoryParameters"] = searchCategoryParameters
-    if ( excludedIps ):
-        params["excludedIps"] = excludedIps
-    if ( excludedQueryParameters ):
-        params["excludedQueryParameters"] = excludedQueryParameters
-    if ( timezone ):
-        params["timezone"] = timezone
-    if ( currency ):
-        params["currency"] = currency
-    if ( group ):
-        params["group"] = group
-    if ( startDate ):
-        params["startDate"] = startDate
-    if ( excludedUserAgents ):
-        params["excludedUserAgents"] = excludedUserAgents
-    if ( keepURLFragments ):
-        params["keepURLFragments"] = keepURLFragments
-    if ( param_type ):
-        params["type"] = param_type
-    if ( settings ):
-        params["settings"] = settings
-    if ( excludeUnknownUrls ):
-        params["excludeUnknownUrls"] = excludeUnknownUrls
-
-    result = requests.get(piwik_url, params=params, timeout=15)
-
-    if result.status_code != 200:
-        raise requests.ConnectionError()
-
-    content = result.json() # Content should be something like {"value": 47}
-    # log.debug( "piwik_SitesManager_addSite", content)
-
-    if not content:
-        raise requests.ConnectionError()
-
-    if "value" in content:
-        return content['value']
-    return False
+_clients = {}
 
 
-def piwik_UsersManager_setUserAccess(piwik_url, piwik_api_token, userLogin, access, idSites):
-    params = {
-        "module": "API",
-        "format": "JSON",
-        "token_auth": piwik_api_token,
-        "method": "UsersManager.setUserAccess",
-        "userLogin": userLogin,
-        "access": access,
-        "idSites": idSites,
-    }
+def get_client(piwik_url, piwik_api_token):
+    """The shared :py:class:`PiwikClient` of this Piwik server and token"""
+    key = (piwik_url, piwik_api_token)
+    client = _clients.get(key, None)
+    if client is None:
+        client = _clients[key] = PiwikClient(piwik_url, piwik_api_token)
+    return client
 
-    result = requests.get(piwik_url, params=params, timeout=15)
 
-    if result.status_code != 200:
-        raise requests.ConnectionError()
-    content = result.json() # Content should be either an empty array, or an array like [{"idsite":"44"}]
-    # log.debug( "piwik_UsersManager_setUserAccess", content)
+def piwik_UsersManager_userExists(piwik_url, piwik_api_token, userLogin):
+    return get_client(piwik_url, piwik_api_token).userExists(userLogin)
 
-    if not content:
-        raise requests.ConnectionError()
 
-    return ("result" in content and content["result"] == "success")
+def piwik_UsersManager_getUserByEmail(piwik_url, piwik_api_token, userEmail):
+    return get_client(piwik_url, piwik_api_token).getUserByEmail(userEmail)
+
+
+def piwik_UsersManager_addUser(piwik_url, piwik_api_token, userLogin, password, email, alias=''):
+    return get_client(piwik_url, piwik_api_token).addUser(
+        userLogin, password, email, alias)
+
+
+def piwik_SitesManager_getSitesIdFromSiteUrl(piwik_url, piwik_api_token, url):
+    return get_client(piwik_url, piwik_api_token).getSitesIdFromSiteUrl(url)
 
-def piwik_UsersManager_hasSuperUserAccess(piwik_url, piwik_api_token, userLogin):
-    params = {
-        "module": "API",
-        "format": "JSON",
-        "token_auth": piwik_api_token,
-        "method": "UsersManager.hasSuperUserAccess",
-        "userLogin": userLogin,
-    }
 
-    result = requests.get(piwik_url, params=params, timeout=15)
+def piwik_SitesManager_addSite(piwik_url, piwik_api_token, siteName, urls, ecommerce = '', siteSearch = '', searchKeywordParameters = '', searchCategoryParameters = '', excludedIps = '', excludedQueryParameters = '', timezone = '', currency = '', group = '', startDate = '', excludedUserAgents = '', keepURLFragments = '', param_type = '', settings = '', excludeUnknownUrls = ''):
+    """Returns the Piwik id_site of the created website
+    Warning: A new Piwik site is created everytime this method is called, even if another Piwik website already exists with the same name and URLs"""
+    return get_client(piwik_url, piwik_api_token).addSite(
+        siteName, urls, ecommerce=ecommerce, siteSearch=siteSearch,
+        searchKeywordParameters=searchKeywordParameters,
+        searchCategoryParameters=searchCategoryParameters,
+        excludedIps=excludedIps,
+        excludedQueryParameters=excludedQueryParameters,
+        timezone=timezone, currency=currency, group=group,
+        startDate=startDate, excludedUserAgents=excludedUserAgents,
+        keepURLFragments=keepURLFragments, param_type=param_type,
+        settings=settings, excludeUnknownUrls=excludeUnknownUrls)
 
-    if result.status_code != 200:
-        raise requests.ConnectionError()
-    content = result.json() # Content should be like {"value": true}
-    # log.debug( "piwik_UsersManager_hasSuperUserAccess", content)
 
-    if not content:
-        raise requests.ConnectionError()
+def piwik_UsersManager_setUserAccess(piwik_url, piwik_api_token, userLogin, access, idSites):
+    return get_client(piwik_url, piwik_api_token).setUserAccess(
+        userLogin, access, idSites)
 
 
-    return asbool(content.get("value", False))
+def piwik_UsersManager_hasSuperUserAccess(piwik_url, piwik_api_token, userLogin):
+    return get_client(piwik_url, piwik_api_token).hasSuperUserAccess(
+        userLogin)
 
 
 def string_generator(size=10, chars=string.ascii_uppercase + string.ascii_lowercase + string.digits):
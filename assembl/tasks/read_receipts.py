@@ -0,0 +1,229 @@
+"""Buffer the read receipts (:py:class:`assembl.models.action.ViewPost`)
+of readers, and write them in batches.
+
+Marking a post as read only queues the (user, post) pair here. A background
+thread inserts the queued receipts every ``read_receipts_flush_interval``
+seconds (2 by default), or as soon as ``read_receipts_batch_size`` are
+queued, in a single transaction which skips the receipts already in the
+database. The receipts are bulk-inserted, so they do not go through the
+ORM listeners (history, changes socket).
+
+Until they are written, the pending receipts of a user are added to the
+read state returned by this process. Receipts discarded while they are being
+written are tombstoned right after the write.
+Setting ``read_receipts_flush_interval`` to 0 writes receipts synchronously.
+"""
+import atexit
+from time import time
+from datetime import datetime
+from threading import Thread, Condition
+from itertools import chain
+from collections import OrderedDict
+
+import transaction
+from sqlalchemy import tuple_
+
+from ..lib.config import get_config
+from ..lib.sqla import mark_changed
+from ..lib.logging import getLogger
+
+
+log = getLogger()
+
+FLUSH_INTERVAL = 2
+
+BATCH_SIZE = 500
+
+
+class ReadReceiptBuffer(object):
+    """Queues read receipts, and writes them from a background thread."""
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # (user_id, post_id) -> (discussion_id, date), in reading order
+        self.pending = OrderedDict()
+        # the batch being written, and its receipts discarded meanwhile
+        self.in_flight = {}
+        self.discarded = set()
+        self.written = 0
+        self.condition = Condition()
+        self.thread = None
+
+    def mark_read(self, user_id, post_id, discussion_id):
+        """Queue a read receipt. Does not block.
+
+        :returns: whether the receipt was not already queued"""
+        key = (user_id, post_id)
+        with self.condition:
+            if self._is_pending(key):
+                return False
+            self.pending[key] = (discussion_id, datetime.utcnow())
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(
+                    target=self.run, name="read_receipts", daemon=True)
+                self.thread.start()
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+        return True
+
+    def discard(self, user_id, post_id):
+        """Forget a queued receipt, e.g. when the post is marked unread.
+
+        A receipt being written is tombstoned after the write."""
+        key = (user_id, post_id)
+        with self.condition:
+            queued = self.pending.pop(key, None) is not None
+            if key in self.in_flight and key not in self.discarded:
+                self.discarded.add(key)
+                queued = True
+            return queued
+
+    def _is_pending(self, key):
+        return key in self.pending or (
+            key in self.in_flight and key not in self.discarded)
+
+    def is_pending(self, user_id, post_id):
+        with self.condition:
+            return self._is_pending((user_id, post_id))
+
+    def pending_post_ids(self, user_id, discussion_id):
+        """The posts of a discussion this user read, whose receipts are
+        not written yet"""
+        with self.condition:
+            return {post_id for ((uid, post_id), (did, _)) in chain(
+                        self.pending.items(), self.in_flight.items())
+                    if uid == user_id and did == discussion_id
+                    and self._is_pending((uid, post_id))}
+
+    def run(self):
+        while True:
+            with self.condition:
+                deadline = time() + self.flush_interval
+                while len(self.pending) < self.batch_size:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Could not write read receipts: %s", e)
+
+    def flush(self):
+        """Write the queued receipts, by batches."""
+        while True:
+            with self.condition:
+                if not self.pending:
+                    return
+                batch = OrderedDict()
+                for key in list(self.pending.keys())[:self.batch_size]:
+                    batch[key] = self.pending.pop(key)
+                self.in_flight = batch
+            try:
+                with transaction.manager:
+                    self.write(batch)
+            except Exception:
+                with self.condition:
+                    # queue them again, unless discarded or read again
+                    for key, value in batch.items():
+                        if key not in self.discarded:
+                            self.pending.setdefault(key, value)
+                    self.discarded.difference_update(batch)
+                    self.in_flight = {}
+                raise
+            # Receipts discarded during the write were missed by the
+            # discarding transaction; stay in flight until they are
+            # tombstoned, so later discards go to the database.
+            while True:
+                with self.condition:
+                    discarded = self.discarded.intersection(batch)
+                    self.discarded.difference_update(discarded)
+                    if not discarded:
+                        self.in_flight = {}
+                        self.written += len(batch)
+                        break
+                with transaction.manager:
+                    self.tombstone(discarded)
+
+    @staticmethod
+    def write(receipts):
+        """Insert the read receipts that are not already in the database.
+
+        :param receipts: a dict of (discussion_id, date) by (user_id, post_id)
+        """
+        from ..models import ViewPost
+        db = ViewPost.default_db
+        existing = set(db.query(ViewPost.actor_id, ViewPost.post_id).filter(
+            tuple_(ViewPost.actor_id, ViewPost.post_id).in_(
+                list(receipts.keys())),
+            ViewPost.tombstone_date == None))
+        # return_defaults: the action ids are needed for action_on_post
+        db.bulk_save_objects([
+            ViewPost(actor_id=user_id, post_id=post_id, creation_date=date)
+            for ((user_id, post_id), (_, date)) in receipts.items()
+            if (user_id, post_id) not in existing], return_defaults=True)
+        mark_changed(db)
+
+    @staticmethod
+    def tombstone(keys):
+        """Tombstone the read receipts of these (user_id, post_id) pairs."""
+        from ..models import ViewPost
+        db = ViewPost.default_db
+        for view in db.query(ViewPost).filter(
+                tuple_(ViewPost.actor_id, ViewPost.post_id).in_(list(keys)),
+                ViewPost.tombstone_date == None):
+            view.is_tombstone = True
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "written": self.written,
+                "flush_interval": self.flush_interval,
+                "batch_size": self.batch_size,
+            }
+
+
+_buffer = None
+
+
+def get_read_receipt_buffer():
+    """The read receipt buffer of this process, or None if receipts are
+    written synchronously."""
+    global _buffer
+    if _buffer is None:
+        config = get_config()
+        flush_interval = float(config.get(
+            'read_receipts_flush_interval', FLUSH_INTERVAL))
+        if not flush_interval:
+            return None
+        _buffer = ReadReceiptBuffer(flush_interval, int(config.get(
+            'read_receipts_batch_size', BATCH_SIZE)))
+        atexit.register(flush_at_exit)
+    return _buffer
+
+
+def flush_at_exit():
+    try:
+        _buffer.flush()
+    except Exception as e:
+        log.error("Could not write read receipts: %s", e)
+
+
+def mark_post_read(db, user_id, post, discussion_id):
+    """Mark a post as read by a user, through the buffer if there is one.
+
+    :returns: whether the post was not already read"""
+    from ..models import ViewPost
+    buffer = get_read_receipt_buffer()
+    if buffer is not None and buffer.is_pending(user_id, post.id):
+        return False
+    if db.query(ViewPost).filter_by(
+            post_id=post.id, actor_id=user_id,
+            tombstone_date=None).count():
+        return False
+    if buffer is None:
+        db.add(ViewPost(post=post, actor_id=user_id))
+        return True
+    return buffer.mark_read(user_id, post.id, discussion_id)
@@ -16,6 +16,7 @@ import pdb
 
 from future.utils import as_native_str, with_metaclass
 from pyramid.paster import get_appsettings
+from pyramid.settings import asbool
 from zope.component import getGlobalSiteManager
 from kombu import BrokerConnection, Exchange, Queue
 from kombu.mixins import ConsumerMixin
@@ -117,6 +118,10 @@ QUEUE_NAME = "source_reader"
 ROUTING_KEY = QUEUE_NAME
 
 
+# Yielded by SourceReader.run_steps to wait for pushed data
+WAIT_FOR_PUSH = object()
+
+
 class ReaderError(RuntimeError):
     status = ReaderStatus.TRANSIENT_ERROR
     pass
@@ -292,14 +297,40 @@ class SourceReader(with_metaclass(ABCMeta, Thread)):
         self.last_prod = datetime.utcnow()
 
     def run(self):
+        """Drive :py:meth:`run_steps` in this thread."""
+        steps = self.run_steps()
+        error = None
+        while True:
+            try:
+                wait = steps.throw(error) if error else next(steps)
+            except StopIteration:
+                break
+            error = None
+            if wait is WAIT_FOR_PUSH:
+                try:
+                    self.wait_for_push()
+                except Exception as e:
+                    error = e
+            else:
+                self.event.wait(wait)
+                self.event.clear()
+
+    def run_steps(self):
+        """The reading cycle, as a generator.
+
+        It yields whenever the reader has to wait: either a timeout in
+        seconds, to wait on :py:attr:`event`; or :py:data:`WAIT_FOR_PUSH`,
+        to call :py:meth:`wait_for_push`, whose exceptions are thrown back
+        into the generator. This allows the cycle to be driven by a thread
+        (:py:meth:`run`) or by an event loop
+        (:py:class:`assembl.tasks.async_source_reader.AsyncReaderHost`)."""
         self.setup()
         while self.status not in (
                 ReaderStatus.SHUTDOWN, ReaderStatus.IRRECOVERABLE_ERROR):
             if self.error_backoff_until:
                 interval = (self.error_backoff_until - datetime.utcnow()).total_seconds()
                 if interval > 0:
-                    self.event.wait(interval)
-                    self.event.clear()
+                    yield interval
             try:
                 self.login()
                 self.successful_login()
@@ -335,7 +366,7 @@ class SourceReader(with_metaclass(ABCMeta, Thread)):
                         try:
                             # This is not a final close, but sends it back to the QueuePool
                             self.source.db.close()
-                            self.wait_for_push()
+                            yield WAIT_FOR_PUSH
                         except ReaderError as e:
                             self.new_error(e)
                             if self.status > ReaderStatus.TRANSIENT_ERROR:
@@ -370,11 +401,9 @@ class SourceReader(with_metaclass(ABCMeta, Thread)):
                         self.close()
 
                     if self.status != ReaderStatus.SHUTDOWN:
-                        self.event.wait(0)
-                        self.event.clear()
+                        yield 0
                 else:
-                    self.event.wait(self.time_between_reads.total_seconds())
-                    self.event.clear()
+                    yield self.time_between_reads.total_seconds()
         if self.status == ReaderStatus.SHUTDOWN or self.is_connected():
             self.close()
         if self.source and not inspect(self.source).detached:
@@ -511,11 +540,13 @@ def external_shutdown():
 
 class SourceDispatcher(ConsumerMixin):
 
-    def __init__(self, connection, debug=False):
+    def __init__(self, connection, debug=False, host=None):
         super(SourceDispatcher, self).__init__()
         self.connection = connection
         self.readers = {}
         self.debug = debug
+        # An AsyncReaderHost, or None to run each reader in its own thread
+        self.host = host
         log.disabled = False
 
     def get_consumers(self, Consumer, channel):
@@ -563,7 +594,10 @@ class SourceDispatcher(ConsumerMixin):
                 return False
 
             reader.setup_read(reimport, **kwargs)
-            reader.start()
+            if self.host is not None:
+                self.host.start_reader(reader)
+            else:
+                reader.start()
             return True
 
         if reader is None:
@@ -579,6 +613,8 @@ class SourceDispatcher(ConsumerMixin):
         for reader in self.readers.values():
             if reader is not None:
                 reader.shutdown()
+        if self.host is not None:
+            self.host.shutdown()
 
 
 def includeme(config):
@@ -628,8 +664,12 @@ if __name__ == '__main__':
     log.disabled = False
     url = (settings.get('celery_tasks.broker') or
            settings.get('celery_tasks.imap.broker'))
+    host = None
+    if not asbool(settings.get('source_reader.use_threads', False)):
+        from .async_source_reader import make_reader_host
+        host = make_reader_host(settings)
     with BrokerConnection(url) as conn:
-        sourcedispatcher = SourceDispatcher(conn, args.debug)
+        sourcedispatcher = SourceDispatcher(conn, args.debug, host)
         def shutdown(*args):
             sourcedispatcher.shutdown()
         signal.signal(signal.SIGTERM, shutdown)
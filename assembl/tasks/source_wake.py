@@ -0,0 +1,147 @@
+"""Coalesce the content source wakes requested by readers.
+
+Reading posts asks for new content from the discussion's sources.
+Instead of sending a wake message per source on every such request,
+requests are queued here, and a background thread sends them:
+
+* wakes requested while one is pending for the same source are collapsed;
+* a source is woken at most once every ``source_wake_min_interval``
+  seconds (60 by default), by all processes sharing the dogpile cache.
+  The last wake is claimed under the region's dogpile lock, which is shared
+  by processes with the dbm backend, or the memcached and redis backends
+  with ``distributed_lock``; otherwise two processes may rarely both wake
+  a source.
+
+Explicit imports (:py:meth:`assembl.models.Discussion.import_from_sources`)
+do not go through this scheduler.
+"""
+from time import time
+from datetime import datetime
+from threading import Thread, Condition
+from collections import OrderedDict, defaultdict
+
+from ..lib.config import get_config
+from ..lib.logging import getLogger
+
+
+log = getLogger()
+
+MIN_INTERVAL = 60
+
+WAKE_REGION = 'source_wake'
+
+
+def _shared_region():
+    from ..lib.jsonld_cache import get_dogpile_region
+    region = get_dogpile_region(WAKE_REGION)
+    if region.is_configured:
+        return region
+
+
+def _last_wake_key(source_id):
+    return "last_wake:%d" % (source_id,)
+
+
+class SourceWakeScheduler(object):
+    """Queues source wakes, and sends them from a background thread."""
+
+    def __init__(self, min_interval=MIN_INTERVAL):
+        self.min_interval = min_interval
+        # source_id -> source class, in request order
+        self.pending = OrderedDict()
+        self.last_wake = {}
+        self.requested = defaultdict(int)
+        self.coalesced = defaultdict(int)
+        self.condition = Condition()
+        self.thread = None
+
+    def request_wake(self, source_id, source_cls):
+        """Ask for a source to be woken. Does not block.
+
+        :returns: whether the wake was queued"""
+        now = time()
+        with self.condition:
+            self.requested[source_id] += 1
+            if source_id in self.pending or (
+                    now - self.last_wake.get(source_id, 0) < self.min_interval):
+                self.coalesced[source_id] += 1
+                return False
+            self.pending[source_id] = source_cls
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(
+                    target=self.run, name="source_wake", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                source_id, source_cls = self.pending.popitem(last=False)
+            try:
+                self.dispatch(source_id, source_cls)
+            except Exception as e:
+                log.error("Could not wake source %d: %s", source_id, e)
+
+    def dispatch(self, source_id, source_cls):
+        now = time()
+        region = _shared_region()
+        if region is not None:
+            claimed = []
+
+            def claim():
+                claimed.append(now)
+                return now
+            # only one creator runs under the dogpile lock
+            last_wake = region.get_or_create(
+                _last_wake_key(source_id), claim,
+                expiration_time=self.min_interval)
+            if not claimed:
+                # woken by another process
+                with self.condition:
+                    self.last_wake[source_id] = last_wake
+                    self.coalesced[source_id] += 1
+                return
+        with self.condition:
+            self.last_wake[source_id] = now
+        source_cls.dispatch_import(source_id)
+
+    def stats(self):
+        """The queue depth, and the wake statistics of each source
+        (in this process)."""
+        with self.condition:
+            return {
+                "queue_depth": len(self.pending),
+                "min_interval": self.min_interval,
+                "sources": {
+                    source_id: {
+                        "last_wake": (
+                            datetime.utcfromtimestamp(
+                                self.last_wake[source_id]).isoformat() + "Z"
+                            if source_id in self.last_wake else None),
+                        "pending": source_id in self.pending,
+                        "requested": count,
+                        "coalesced": self.coalesced[source_id],
+                    } for (source_id, count) in self.requested.items()
+                }
+            }
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = SourceWakeScheduler(float(get_config().get(
+            'source_wake_min_interval', MIN_INTERVAL)))
+    return _scheduler
+
+
+def schedule_source_wakes(discussion):
+    """Queue wakes for all the sources of a discussion."""
+    scheduler = get_scheduler()
+    for source in discussion.sources:
+        scheduler.request_wake(source.id, source.__class__)
@@ -263,6 +263,16 @@ def test_server(request, test_app, empty_db):
     return server
 
 
+@pytest.fixture(scope="function")
+def memory_cache(request, monkeypatch):
+    """A configured, in-memory fragment cache region"""
+    from assembl.lib import jsonld_cache
+    monkeypatch.setattr(jsonld_cache, "_regions", {})
+    return jsonld_cache.get_dogpile_region(jsonld_cache.FRAGMENT_REGION, {
+        "dogpile_cache.backend": "memory",
+        "dogpile_cache.expiration_time": "10000"})
+
+
 @pytest.fixture(scope="module")
 def browser(request):
     """A Splinter-based browser fixture - used for integration
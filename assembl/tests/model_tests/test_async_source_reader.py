@@ -0,0 +1,61 @@
+from time import sleep
+
+from assembl.tasks.source_reader import WAIT_FOR_PUSH
+
+
+class StubReader(object):
+    """Follows the reading cycle of a SourceReader, and records it"""
+
+    def __init__(self, source_id):
+        self.source_id = source_id
+        self.event = None
+        self.running = True
+        self.steps = []
+
+    def run_steps(self):
+        self.steps.append("start")
+        yield 1000
+        self.steps.append("woken")
+        try:
+            yield WAIT_FOR_PUSH
+        except ValueError as e:
+            self.steps.append("push error: %s" % (e,))
+        while self.running:
+            yield 1000
+        self.steps.append("stop")
+
+    def wait_for_push(self):
+        raise ValueError("no push")
+
+    def shutdown(self):
+        self.running = False
+        self.event.set()
+
+
+def _wait_for_step(reader, step, timeout=5):
+    for i in range(int(timeout / 0.01)):
+        if step in reader.steps:
+            return True
+        sleep(0.01)
+    return False
+
+
+def test_async_reader_host(test_session):
+    from assembl.tasks.async_source_reader import AsyncReaderHost
+    host = AsyncReaderHost()
+    reader = StubReader(1)
+    future = host.start_reader(reader)
+    assert _wait_for_step(reader, "start")
+    # waits on the loop until woken
+    sleep(0.1)
+    assert reader.steps == ["start"]
+    reader.event.set()
+    # the push error is thrown back into the reading cycle
+    assert _wait_for_step(reader, "push error: no push")
+    assert reader.steps == ["start", "woken", "push error: no push"]
+    reader.shutdown()
+    future.result(5)
+    assert reader.steps[-1] == "stop"
+    host.shutdown(5)
+    assert not host.thread.is_alive()
+    assert 1 not in host.tasks
@@ -74,3 +74,104 @@ def test_restricted_discussion_expiry_override(
     admin_social_account.last_checked = now
     test_session.flush()
     assert not admin_user.login_expired(closed_discussion)
+
+
+def test_permission_resolver_matches_queries(
+        test_session, discussion, participant1_user, root_idea,
+        subidea_1, subidea_1_1):
+    from assembl.auth import P_EDIT_IDEA, R_MODERATOR, R_PARTICIPANT
+    from assembl.auth.util import PermissionResolver, get_permissions
+    from assembl.lib.sqla import BaseOps
+    from assembl.models import (
+        IdeaLocalUserRole, Permission, PublicationFlow, PublicationState,
+        Role, StateDiscussionPermission)
+    flow = PublicationFlow(label="test_flow")
+    state = PublicationState(label="test_state", flow=flow)
+    test_session.add(flow)
+    sdp = StateDiscussionPermission(
+        discussion=discussion, publication_state=state,
+        role=Role.getByName(R_PARTICIPANT, test_session),
+        permission=Permission.getByName(P_EDIT_IDEA, test_session))
+    lur = IdeaLocalUserRole(
+        user=participant1_user, idea=subidea_1_1,
+        role=Role.getByName(R_MODERATOR, test_session))
+    test_session.add_all((sdp, lur))
+    subidea_1.pub_state = state
+    subidea_1_1.creator = participant1_user
+    test_session.flush()
+    ideas = (root_idea, subidea_1, subidea_1_1)
+    for user_id in (participant1_user.id, None):
+        resolver = PermissionResolver(discussion.id, user_id)
+        for idea in ideas:
+            for include_global in (False, True):
+                assert set(resolver.local_permissions(idea, include_global)) \
+                    == set(BaseOps.local_permissions(
+                        idea, user_id, discussion, include_global))
+            assert set(resolver.permissions_for(idea)) == set(
+                get_permissions(user_id, discussion.id, idea))
+    # the resolver sees the object-local role and the state permission
+    resolver = PermissionResolver(discussion.id, participant1_user.id)
+    assert P_EDIT_IDEA in resolver.local_permissions(subidea_1)
+    assert P_EDIT_IDEA not in resolver.local_permissions(root_idea)
+    assert set(resolver.permissions_for(subidea_1_1)) > set(
+        resolver.permissions_for())
+    test_session.delete(lur)
+    test_session.delete(sdp)
+    subidea_1.pub_state = None
+    subidea_1_1.creator = None
+    test_session.delete(flow)
+    test_session.flush()
+
+
+def test_permission_cache_invalidation(
+        test_session, discussion, participant1_user):
+    from assembl.auth import P_ADMIN_DISC, R_MODERATOR
+    from assembl.auth.util import user_has_permission, roles_with_permission
+    from assembl.models import (
+        DiscussionPermission, LocalUserRole, Permission, Role)
+    assert not user_has_permission(
+        discussion.id, participant1_user.id, P_ADMIN_DISC)
+    moderator = Role.getByName(R_MODERATOR, test_session)
+    lur = LocalUserRole(
+        user=participant1_user, discussion=discussion, role=moderator)
+    dp = DiscussionPermission(
+        discussion=discussion, role=moderator,
+        permission=Permission.getByName(P_ADMIN_DISC, test_session))
+    test_session.add_all((lur, dp))
+    test_session.flush()
+    assert R_MODERATOR in roles_with_permission(discussion, P_ADMIN_DISC)
+    assert user_has_permission(
+        discussion.id, participant1_user.id, P_ADMIN_DISC)
+    test_session.delete(lur)
+    test_session.flush()
+    assert not user_has_permission(
+        discussion.id, participant1_user.id, P_ADMIN_DISC)
+    test_session.delete(dp)
+    test_session.flush()
+    assert R_MODERATOR not in roles_with_permission(discussion, P_ADMIN_DISC)
+
+
+def test_user_kv_collection_bulk(
+        test_session, discussion, participant1_user, participant2_user):
+    from assembl.models.user_key_values import NamespacedUserKVCollection
+    coll = NamespacedUserKVCollection(
+        discussion, participant1_user.id, "test_ns")
+    coll["a"] = {"x": 1}
+    coll["b"] = 2
+    assert coll["a"] == {"x": 1}
+    assert len(coll) == 2
+    test_session.flush()
+    collections = NamespacedUserKVCollection.bulk_fetch(
+        discussion, [participant1_user.id, participant2_user.id], "test_ns")
+    assert dict(collections[participant1_user.id].items()) == {
+        "a": {"x": 1}, "b": 2}
+    assert len(collections[participant2_user.id]) == 0
+    coll = collections[participant1_user.id]
+    del coll["a"]
+    coll["b"] = 3
+    test_session.flush()
+    coll = NamespacedUserKVCollection(
+        discussion, participant1_user.id, "test_ns")
+    assert dict(coll.items()) == {"b": 3}
+    del coll["b"]
+    test_session.flush()
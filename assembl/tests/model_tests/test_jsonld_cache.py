@@ -0,0 +1,26 @@
+def test_invalidate_fragments_without_pyramid(monkeypatch):
+    # As in celery or the source reader: settings, but no pyramid includes
+    from assembl.lib import jsonld_cache
+    monkeypatch.setattr(jsonld_cache, "_regions", {})
+    monkeypatch.setattr(jsonld_cache, "get_config", lambda: {
+        "dogpile_cache.backend": "memory",
+        "dogpile_cache.expiration_time": "10000"})
+    region = jsonld_cache.get_dogpile_region(jsonld_cache.FRAGMENT_REGION)
+    assert region.is_configured
+    uri = "local:Content/1"
+    key = jsonld_cache._version_key(uri)
+    token = jsonld_cache._get_token(region, key)
+    export = jsonld_cache.export_version(1)
+    jsonld_cache.invalidate_fragments({uri: 1})
+    assert jsonld_cache._get_token(region, key) != token
+    assert jsonld_cache.export_version(1) != export
+
+
+def test_unconfigured_region(monkeypatch):
+    from assembl.lib import jsonld_cache
+    monkeypatch.setattr(jsonld_cache, "_regions", {})
+    monkeypatch.setattr(jsonld_cache, "get_config", lambda: {})
+    assert not jsonld_cache.get_dogpile_region(
+        jsonld_cache.FRAGMENT_REGION).is_configured
+    # does not fail
+    jsonld_cache.invalidate_fragments({"local:Content/1": 1})
@@ -79,3 +79,8 @@ def test_translate(test_adminuser_webrequest, discussion, langstring_body, fr_la
     langstring_body.update_from_json(json, context=context)
     print(langstring_body.__dict__)
     assert len(langstring_body.entries)==2
+
+
+def test_view_defs_compile(discussion):
+    from assembl.view_def.compiler import compile_view_defs
+    assert not compile_view_defs()
@@ -157,3 +157,199 @@ def test_delete_posts(
     assert reply_post_2.is_tombstone
     assert reply_post_1.is_tombstone
 
+
+def test_set_parents(
+        test_session, root_post_1, reply_post_1, reply_post_2):
+    from assembl.models import Post
+    assert reply_post_2.ancestry == "%d,%d," % (root_post_1.id, reply_post_1.id)
+    # move reply_post_1 and its subtree to the top
+    reply_post_1.set_parent(None)
+    assert reply_post_1.ancestry == ''
+    assert reply_post_2.ancestry == "%d," % (reply_post_1.id,)
+    # and back, along with an inner move
+    Post.set_parents(test_session, {
+        reply_post_2: root_post_1, reply_post_1: root_post_1})
+    assert reply_post_1.ancestry == "%d," % (root_post_1.id,)
+    assert reply_post_2.ancestry == "%d," % (root_post_1.id,)
+    reply_post_2.set_parent(reply_post_1)
+    assert reply_post_2.ancestry == "%d,%d," % (root_post_1.id, reply_post_1.id)
+
+
+def test_set_parents_membership(
+        test_session, jack_layton_linked_discussion, subidea_1):
+    from sqlalchemy.orm import object_session
+    from assembl.models import Post, IdeaPostMembership
+    discussion_id = subidea_1.discussion_id
+    membership = IdeaPostMembership.__table__
+
+    def members():
+        return set(test_session.query(
+            membership.c.idea_id, membership.c.post_id).filter(
+            membership.c.discussion_id == discussion_id))
+
+    def check_members():
+        maintained = members()
+        IdeaPostMembership.refresh(test_session, discussion_id)
+        assert members() == maintained
+    # a negatively and a positively linked post
+    posts = [jack_layton_linked_discussion[i].content for i in (2, 5)]
+    parents = {post: post.parent for post in posts}
+    Post.set_parents(test_session, {post: None for post in posts})
+    check_members()
+    descendant = test_session.query(Post).filter(
+        Post.ancestry.like("%d,%%" % (posts[0].id,))).first()
+    if descendant is not None:
+        # descendants are not notified, but their caches are invalidated
+        assert descendant.uri() in object_session(
+            descendant).changed_uris
+    Post.set_parents(test_session, parents)
+    check_members()
+
+
+def test_post_last_activity(
+        test_session, discussion, root_post_1, reply_post_1, reply_post_2):
+    from assembl.models import Post
+    # the root is as active as its latest reply
+    assert root_post_1.last_updated() == reply_post_2.last_activity
+    assert reply_post_1.last_updated() == reply_post_2.last_activity
+    assert Post.discussion_last_activity(
+        test_session, discussion.id) == reply_post_2.last_activity
+    threads = Post.threads_by_last_activity(test_session, discussion.id).all()
+    assert threads[0] == root_post_1
+
+
+def test_translation_is_not_post_activity(
+        test_session, discussion, root_post_1, reply_post_1):
+    from assembl.nlp.translation_service import (
+        DummyTranslationServiceTwoSteps)
+    posts = (root_post_1, reply_post_1)
+
+    def activity():
+        for post in posts:
+            test_session.expire(post, ['last_activity'])
+        return [post.last_activity for post in posts]
+    before = activity()
+    entry = reply_post_1.body.first_original()
+    # as identified
+    entry.locale = "en"
+    test_session.flush()
+    assert activity() == before
+    # as translated on read
+    service = DummyTranslationServiceTwoSteps(discussion)
+    translation = service.translate_lse(entry, "fr")
+    test_session.flush()
+    assert translation.is_machine_translated
+    assert activity() == before
+    # whereas an edition is
+    entry.value = u"edited post body"
+    test_session.flush()
+    after = activity()
+    assert after[0] > before[0] and after[1] > before[1]
+    test_session.delete(translation)
+    test_session.flush()
+
+
+def test_idea_closure(
+        test_session, root_idea, subidea_1, subidea_1_1, subidea_1_1_1,
+        subidea_1_2):
+    from assembl.models import IdeaClosure
+    assert set(subidea_1.get_all_descendants(True)) == {
+        subidea_1.id, subidea_1_1.id, subidea_1_1_1.id, subidea_1_2.id}
+    assert set(subidea_1_1_1.get_all_ancestors(True)) == {
+        root_idea.id, subidea_1.id, subidea_1_1.id, subidea_1_1_1.id}
+    # reparent subidea_1_1_1 under subidea_1_2
+    link = subidea_1_1_1.source_links[0]
+    link.source = subidea_1_2
+    test_session.flush()
+    assert set(subidea_1_2.get_all_descendants(True, False)) == {
+        subidea_1_1_1.id}
+    assert set(subidea_1_1.get_all_descendants(True, False)) == set()
+    # the maintained closure is the rebuilt closure
+    closure = IdeaClosure.__table__
+    maintained = set(test_session.execute(
+        closure.select().where(
+            closure.c.discussion_id == subidea_1.discussion_id)))
+    IdeaClosure.rebuild(test_session, subidea_1.discussion_id)
+    assert maintained == set(test_session.execute(
+        closure.select().where(
+            closure.c.discussion_id == subidea_1.discussion_id)))
+    link.source = subidea_1_1
+    test_session.flush()
+    assert set(subidea_1_1.get_all_descendants(True, False)) == {
+        subidea_1_1_1.id}
+
+
+def test_idea_post_membership(
+        test_session, test_webrequest, jack_layton_linked_discussion,
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1):
+    from assembl.models import Idea, IdeaPostMembership
+    ideas = (
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1)
+    discussion_id = subidea_1.discussion_id
+    counters = subidea_1.prepare_counters(discussion_id)
+    membership = IdeaPostMembership.__table__
+
+    def members():
+        return {idea.id: {post_id for (post_id,) in test_session.query(
+            membership.c.post_id).filter(membership.c.idea_id == idea.id)}
+            for idea in ideas}
+    maintained = members()
+    for idea in ideas:
+        from_paths = {post_id for (post_id,) in test_session.execute(
+            test_session.query(counters.paths[idea.id].as_clause_base(
+                test_session, discussion_id, include_deleted=None)))}
+        assert maintained[idea.id] == from_paths
+    IdeaPostMembership.refresh(test_session, discussion_id)
+    assert members() == maintained
+    for post_id in maintained[subidea_1_1_1.id]:
+        assert subidea_1_1_1.id in Idea.get_idea_ids_showing_post(post_id)
+
+
+def test_idea_post_membership_refresh_scope(
+        test_session, jack_layton_linked_discussion, root_idea,
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_2, monkeypatch):
+    from assembl.models import Idea, IdeaLink, IdeaPostMembership, LangString
+    discussion_id = subidea_1.discussion_id
+    membership = IdeaPostMembership.__table__
+    refresh = IdeaPostMembership.refresh.__func__
+    refreshed = []
+
+    def recording_refresh(cls, db, discussion_id, idea_ids=None):
+        refreshed.append(idea_ids)
+        refresh(cls, db, discussion_id, idea_ids)
+    monkeypatch.setattr(
+        IdeaPostMembership, "refresh", classmethod(recording_refresh))
+
+    def check_members():
+        maintained = set(test_session.query(
+            membership.c.idea_id, membership.c.post_id).filter(
+            membership.c.discussion_id == discussion_id))
+        refresh(IdeaPostMembership, test_session, discussion_id)
+        assert maintained == set(test_session.query(
+            membership.c.idea_id, membership.c.post_id).filter(
+            membership.c.discussion_id == discussion_id))
+    # a new idea shows no posts
+    idea = Idea(title=LangString.create(u"A new idea", 'en'),
+                discussion_id=discussion_id)
+    idea_link = IdeaLink(source=subidea_1_1, target=idea)
+    test_session.add(idea)
+    test_session.add(idea_link)
+    test_session.flush()
+    assert refreshed == []
+    # moving a subtree refreshes its old and new ancestors
+    link = subidea_1_1_1.source_links[0]
+    link.source = subidea_1_2
+    test_session.flush()
+    assert refreshed == [{
+        root_idea.id, subidea_1.id, subidea_1_1.id, subidea_1_2.id}]
+    check_members()
+    link.source = subidea_1_1
+    test_session.flush()
+    check_members()
+    test_session.delete(idea_link)
+    test_session.delete(idea)
+    test_session.flush()
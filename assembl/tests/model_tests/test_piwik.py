@@ -0,0 +1,100 @@
+import json
+from threading import Thread
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+
+class PiwikStubHandler(BaseHTTPRequestHandler):
+    """Answers a few Piwik API methods, and records the calls"""
+
+    def answer(self, params):
+        method = params["method"][0]
+        self.server.calls.append(method)
+        if method == "API.getBulkRequest":
+            urls = sorted(
+                (k, v[0]) for (k, v) in params.items() if k.startswith("urls["))
+            return [self.answer(parse_qs(url)) for (k, url) in urls]
+        elif method == "UsersManager.getUserByEmail":
+            return {"result": "error", "message": "unknown user"}
+        elif method == "SitesManager.getSitesIdFromSiteUrl":
+            return self.server.sites
+        elif method == "UsersManager.addUser":
+            return {"result": "success"}
+        elif method == "SitesManager.addSite":
+            self.server.sites = [{"idsite": "47"}]
+            return {"value": 47}
+        elif method == "UsersManager.setUserAccess":
+            return {"result": "success"}
+        return {"result": "error", "message": "unknown method"}
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        if self.server.unavailable:
+            self.server.calls.append(params["method"][0])
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(self.answer(params)).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="function")
+def piwik_stub(request):
+    server = HTTPServer(("127.0.0.1", 0), PiwikStubHandler)
+    server.calls = []
+    server.sites = []
+    server.unavailable = False
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def fin():
+        server.shutdown()
+        server.server_close()
+    request.addfinalizer(fin)
+    return server
+
+
+def test_piwik_client(piwik_stub):
+    from assembl.tasks.piwik import PiwikClient
+    client = PiwikClient("http://127.0.0.1:%d/" % piwik_stub.server_port, "tk")
+    user, sites = client.lookup_user_and_sites("a@example.com", "http://x/y")
+    assert user is False
+    assert sites == []
+    # both lookups in a single request
+    assert piwik_stub.calls == [
+        "API.getBulkRequest", "UsersManager.getUserByEmail",
+        "SitesManager.getSitesIdFromSiteUrl"]
+    # then memoized
+    client.lookup_user_and_sites("a@example.com", "http://x/y")
+    assert len(piwik_stub.calls) == 3
+    assert client.addSite("y", ["http://x/y"], timezone="UTC") == 47
+    # creating the site invalidates the lookup
+    assert client.getSitesIdFromSiteUrl("http://x/y") == [{"idsite": "47"}]
+    assert piwik_stub.calls[-1] == "SitesManager.getSitesIdFromSiteUrl"
+
+
+def test_piwik_client_retries(piwik_stub):
+    import requests
+    from assembl.tasks.piwik import PiwikClient
+    client = PiwikClient(
+        "http://127.0.0.1:%d/" % piwik_stub.server_port, "tk", retries=2)
+    piwik_stub.unavailable = True
+    # lookups are retried
+    with pytest.raises(requests.ConnectionError):
+        client.getSitesIdFromSiteUrl("http://x/y")
+    assert piwik_stub.calls == ["SitesManager.getSitesIdFromSiteUrl"] * 3
+    # but not creations, which could be applied twice
+    piwik_stub.calls = []
+    with pytest.raises(requests.ConnectionError):
+        client.addSite("y", ["http://x/y"])
+    assert piwik_stub.calls == ["SitesManager.addSite"]
@@ -0,0 +1,73 @@
+from copy import deepcopy
+
+import pytest
+
+from assembl.auth import P_READ, R_PARTICIPANT
+
+
+def _uncached_preference_data(prefs):
+    # Preferences.get_preference_data, without snapshots
+    from assembl.models.preferences import Preferences, merge_json
+    if prefs.cascade_id:
+        base = _uncached_preference_data(prefs.cascade_preferences)
+    else:
+        base = Preferences.preference_data
+    local_values = prefs.local_values_json
+    if "preference_data" in local_values:
+        base = merge_json(base, local_values["preference_data"])
+    return base
+
+
+def _uncached_value(prefs, key):
+    # Preferences.__getitem__, without snapshots
+    from assembl.models.preferences import Preferences
+    local_values = prefs.local_values_json
+    if key in local_values:
+        return local_values[key]
+    if prefs.cascade_id:
+        return _uncached_value(prefs.cascade_preferences, key)
+    data = _uncached_preference_data(prefs)
+    if key == "preference_data":
+        return [data[k] for k in Preferences.preference_data_key_list]
+    return data[key].get("default", None)
+
+
+def test_preferences_snapshot(test_session, default_preferences):
+    from assembl.models.preferences import Preferences
+    old_json = default_preferences.pref_json
+    default_preferences.local_values_json = {
+        "preference_data": {
+            "default_idea_pub_state": {"default": "draft"}},
+        "simple_view_panel_order": "NIM"}
+    child = Preferences(
+        name="test_child", cascade_preferences=default_preferences)
+    test_session.add(child)
+    child.local_values_json = {
+        "preference_data": {"social_sharing": {"default": False}},
+        "simple_view_panel_order": "NMI"}
+    test_session.flush()
+    for prefs in (default_preferences, child):
+        assert dict(prefs.get_preference_data()) == \
+            _uncached_preference_data(prefs)
+        for key in Preferences.preference_data_key_list:
+            assert prefs[key] == _uncached_value(prefs, key), key
+    # defaults come from the patched preference data
+    assert child["default_idea_pub_state"] == "draft"
+    assert child["simple_view_panel_order"] == "NMI"
+    # but not from the patches of the preferences they cascade from
+    assert child.get_preference_data()["social_sharing"]["default"] is False
+    assert child["social_sharing"] is True
+    # json values are shared, and read-only
+    permissions = child["default_permissions"]
+    assert permissions is child["default_permissions"]
+    with pytest.raises(TypeError):
+        permissions[R_PARTICIPANT].append(P_READ)
+    copied = deepcopy(permissions)
+    copied[R_PARTICIPANT].append(P_READ)
+    assert copied != child["default_permissions"]
+    # the snapshot is shared, and must not be modified
+    with pytest.raises(TypeError):
+        child.get_preference_data()["default_idea_pub_state"] = {}
+    test_session.delete(child)
+    default_preferences.pref_json = old_json
+    test_session.flush()
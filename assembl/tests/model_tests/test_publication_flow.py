@@ -0,0 +1,95 @@
+import pytest
+
+from assembl.auth import (
+    P_EDIT_IDEA, P_READ, P_READ_IDEA, R_CATCHER, R_MODERATOR)
+
+
+@pytest.fixture(scope="function")
+def draft_flow(request, test_session, discussion, root_idea):
+    """A discussion publication flow where ideas are drafts, then published.
+
+    Catchers can only read published ideas."""
+    from assembl.models import (
+        Permission, PublicationFlow, PublicationState,
+        PublicationTransition, Role, StateDiscussionPermission)
+    flow = PublicationFlow(label="test_draft_flow")
+    draft = PublicationState(label="draft", flow=flow)
+    published = PublicationState(label="published", flow=flow)
+    PublicationTransition(
+        label="publish", flow=flow, source=draft, target=published,
+        requires_permission=Permission.getByName(P_EDIT_IDEA, test_session))
+    test_session.add(flow)
+    sdp = StateDiscussionPermission(
+        discussion=discussion, publication_state=published,
+        role=Role.getByName(R_CATCHER, test_session),
+        permission=Permission.getByName(P_READ_IDEA, test_session))
+    test_session.add(sdp)
+    old_flow = discussion.idea_publication_flow
+    old_root_state = root_idea.pub_state
+    discussion.idea_publication_flow = flow
+    discussion.preferences['default_idea_pub_state'] = "draft"
+    root_idea.pub_state = published
+    test_session.flush()
+
+    def fin():
+        for idea in discussion.ideas:
+            test_session.expire(idea, ['pub_state_id', 'pub_state'])
+            if idea.pub_state_id in (draft.id, published.id):
+                idea.pub_state = None
+        root_idea.pub_state = old_root_state
+        del discussion.preferences['default_idea_pub_state']
+        discussion.idea_publication_flow = old_flow
+        test_session.delete(sdp)
+        test_session.delete(flow)
+        test_session.flush()
+    request.addfinalizer(fin)
+    return flow
+
+
+def test_bulk_change_publication_states(
+        test_session, discussion, draft_flow, subidea_1, subidea_1_1,
+        participant1_user):
+    draft = draft_flow.state_by_label("draft")
+    subidea_1.pub_state = draft
+    # in the default state
+    subidea_1_1.pub_state = None
+    test_session.flush()
+    connection = test_session.connection()
+    connection.info.pop('cdict', None)
+    discussion.bulk_change_publication_states(
+        {"draft": "published"}, participant1_user.id,
+        [P_READ, P_READ_IDEA, P_EDIT_IDEA])
+    for idea in (subidea_1, subidea_1_1):
+        assert idea.pub_state_name == "published"
+        # catchers can now read them: full serialization
+        assert connection.info['cdict'][(idea.uri(), "changes")][1] is idea
+    assert discussion.root_idea.pub_state_name == "published"
+
+
+def test_bulk_change_publication_states_fallback(
+        test_session, discussion, draft_flow, subidea_1, subidea_1_1,
+        participant1_user):
+    from assembl.models import IdeaLocalUserRole, Role
+    draft = draft_flow.state_by_label("draft")
+    subidea_1.pub_state = draft
+    subidea_1_1.pub_state = draft
+    test_session.flush()
+    # the participant may not publish ideas by themselves
+    with pytest.raises(AssertionError):
+        discussion.bulk_change_publication_states(
+            {"draft": "published"}, participant1_user.id,
+            [P_READ, P_READ_IDEA])
+    test_session.expire(subidea_1, ['pub_state_id', 'pub_state'])
+    assert subidea_1.pub_state_name == "draft"
+    # except as local moderator of an idea
+    lur = IdeaLocalUserRole(
+        user=participant1_user, idea=subidea_1,
+        role=Role.getByName(R_MODERATOR, test_session))
+    test_session.add(lur)
+    subidea_1_1.pub_state = draft_flow.state_by_label("published")
+    test_session.flush()
+    discussion.bulk_change_publication_states(
+        {"draft": "published"}, participant1_user.id, [P_READ, P_READ_IDEA])
+    assert subidea_1.pub_state_name == "published"
+    test_session.delete(lur)
+    test_session.flush()
@@ -0,0 +1,117 @@
+from threading import Event, Thread
+
+from assembl.tasks.read_receipts import ReadReceiptBuffer
+
+
+class RecordingBuffer(ReadReceiptBuffer):
+    """Records the writes instead of going to the database.
+
+    A write can be held back, to act on the buffer while it is in flight."""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingBuffer, self).__init__(*args, **kwargs)
+        self.writes = []
+        self.tombstones = []
+        self.hold = None
+        self.writing = Event()
+
+    def write(self, receipts):
+        self.writing.set()
+        if self.hold is not None:
+            self.hold.wait(5)
+        self.writes.append(list(receipts.keys()))
+
+    def tombstone(self, keys):
+        self.tombstones.append(set(keys))
+
+
+def test_read_receipts_dedup():
+    buffer = RecordingBuffer(flush_interval=1000)
+    assert buffer.mark_read(1, 10, 100)
+    assert not buffer.mark_read(1, 10, 100)
+    assert buffer.mark_read(2, 10, 100)
+    assert buffer.mark_read(1, 11, 100)
+    assert buffer.mark_read(1, 12, 101)
+    assert buffer.is_pending(1, 10)
+    assert buffer.pending_post_ids(1, 100) == {10, 11}
+    assert buffer.pending_post_ids(2, 100) == {10}
+    buffer.flush()
+    assert buffer.writes == [[(1, 10), (2, 10), (1, 11), (1, 12)]]
+    assert not buffer.is_pending(1, 10)
+    assert buffer.pending_post_ids(1, 100) == set()
+    assert buffer.stats()["written"] == 4
+
+
+def test_read_receipts_batches():
+    buffer = RecordingBuffer(flush_interval=1000, batch_size=2)
+    for post_id in range(5):
+        buffer.mark_read(1, post_id, 100)
+    buffer.flush()
+    assert buffer.writes == [
+        [(1, 0), (1, 1)], [(1, 2), (1, 3)], [(1, 4)]]
+    assert buffer.stats()["pending"] == 0
+
+
+def test_read_receipts_discard():
+    buffer = RecordingBuffer(flush_interval=1000)
+    buffer.mark_read(1, 10, 100)
+    buffer.mark_read(1, 11, 100)
+    assert buffer.discard(1, 10)
+    assert not buffer.discard(1, 10)
+    assert not buffer.discard(1, 12)
+    assert buffer.pending_post_ids(1, 100) == {11}
+    buffer.flush()
+    assert buffer.writes == [[(1, 11)]]
+    assert buffer.tombstones == []
+
+
+def test_read_receipts_discard_while_writing():
+    buffer = RecordingBuffer(flush_interval=1000)
+    buffer.mark_read(1, 10, 100)
+    buffer.mark_read(1, 11, 100)
+    buffer.hold = Event()
+    flush = Thread(target=buffer.flush)
+    flush.start()
+    assert buffer.writing.wait(5)
+    # in flight: still pending, and not queued twice
+    assert buffer.is_pending(1, 10)
+    assert not buffer.mark_read(1, 10, 100)
+    assert buffer.discard(1, 10)
+    assert not buffer.discard(1, 10)
+    assert not buffer.is_pending(1, 10)
+    assert buffer.pending_post_ids(1, 100) == {11}
+    buffer.hold.set()
+    flush.join(5)
+    assert buffer.writes == [[(1, 10), (1, 11)]]
+    # the written receipt was tombstoned after the write
+    assert buffer.tombstones == [{(1, 10)}]
+    assert buffer.pending_post_ids(1, 100) == set()
+    assert not buffer.in_flight and not buffer.discarded
+
+
+def test_read_receipts_write(
+        test_session, discussion, participant1_user,
+        root_post_1, reply_post_1, reply_post_2):
+    from assembl.models import ViewPost
+    user_id = participant1_user.id
+    test_session.add(ViewPost(post=root_post_1, actor=participant1_user))
+    test_session.flush()
+    buffer = RecordingBuffer(flush_interval=1000)
+    for post in (root_post_1, reply_post_1, reply_post_2):
+        buffer.mark_read(user_id, post.id, discussion.id)
+    receipts = buffer.pending
+    # already read posts are skipped
+    ReadReceiptBuffer.write(receipts)
+    test_session.flush()
+    views = test_session.query(ViewPost).filter_by(
+        actor_id=user_id, tombstone_date=None).all()
+    assert sorted(v.post_id for v in views) == sorted(
+        (root_post_1.id, reply_post_1.id, reply_post_2.id))
+    ReadReceiptBuffer.tombstone([(user_id, reply_post_1.id)])
+    test_session.flush()
+    assert {v.post_id for v in test_session.query(ViewPost).filter_by(
+        actor_id=user_id, tombstone_date=None)} == {
+        root_post_1.id, reply_post_2.id}
+    for view in test_session.query(ViewPost).filter_by(actor_id=user_id):
+        test_session.delete(view)
+    test_session.flush()
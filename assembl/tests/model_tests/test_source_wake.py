@@ -0,0 +1,66 @@
+from time import sleep
+
+
+class StubSource(object):
+    """Records the wakes instead of sending them"""
+    woken = []
+
+    @classmethod
+    def dispatch_import(cls, source_id):
+        cls.woken.append(source_id)
+
+
+def _wait_for_wakes(count, timeout=5):
+    for i in range(int(timeout / 0.01)):
+        if len(StubSource.woken) >= count:
+            break
+        sleep(0.01)
+    return StubSource.woken
+
+
+def test_source_wake_coalescing(monkeypatch):
+    from assembl.tasks import source_wake
+    monkeypatch.setattr(source_wake, "_shared_region", lambda: None)
+    StubSource.woken = []
+    scheduler = source_wake.SourceWakeScheduler(min_interval=1000)
+    assert scheduler.request_wake(1, StubSource)
+    # pending, or woken less than min_interval ago
+    assert not scheduler.request_wake(1, StubSource)
+    assert scheduler.request_wake(2, StubSource)
+    assert sorted(_wait_for_wakes(2)) == [1, 2]
+    assert not scheduler.request_wake(1, StubSource)
+    stats = scheduler.stats()
+    assert stats["sources"][1]["requested"] == 3
+    assert stats["sources"][1]["coalesced"] == 2
+    assert stats["sources"][2]["coalesced"] == 0
+    assert stats["sources"][1]["last_wake"]
+
+
+def test_source_wake_min_interval(monkeypatch):
+    from assembl.tasks import source_wake
+    monkeypatch.setattr(source_wake, "_shared_region", lambda: None)
+    StubSource.woken = []
+    scheduler = source_wake.SourceWakeScheduler(min_interval=0.2)
+    assert scheduler.request_wake(1, StubSource)
+    assert _wait_for_wakes(1) == [1]
+    assert not scheduler.request_wake(1, StubSource)
+    sleep(0.3)
+    assert scheduler.request_wake(1, StubSource)
+    assert _wait_for_wakes(2) == [1, 1]
+
+
+def test_source_wake_shared_between_processes(monkeypatch):
+    from dogpile.cache import make_region
+    from assembl.tasks import source_wake
+    region = make_region().configure("dogpile.cache.memory")
+    monkeypatch.setattr(source_wake, "_shared_region", lambda: region)
+    StubSource.woken = []
+    # as if in two processes
+    scheduler1 = source_wake.SourceWakeScheduler(min_interval=1000)
+    scheduler2 = source_wake.SourceWakeScheduler(min_interval=1000)
+    scheduler1.dispatch(1, StubSource)
+    scheduler2.dispatch(1, StubSource)
+    assert StubSource.woken == [1]
+    assert scheduler2.stats()["sources"] == {}
+    assert scheduler2.last_wake[1] == scheduler1.last_wake[1]
+    assert scheduler2.coalesced[1] == 1
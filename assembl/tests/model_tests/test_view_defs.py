@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""Check that the compiled view_defs serialize representative objects as
+:py:meth:`assembl.lib.sqla.BaseOps.generic_json` did before they were
+compiled; that implementation is kept below as a reference."""
+import json
+import inspect as pyinspect
+from datetime import datetime
+from collections.abc import Iterable
+
+import pytest
+from future.utils import string_types
+from past.builtins import long
+from simplejson import loads
+from sqlalchemy.ext.associationproxy import (
+    AssociationProxy, ObjectAssociationProxyInstance)
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+from assembl.auth import (
+    Everyone, CrudPermissions, P_READ, P_READ_IDEA, P_SYSADMIN)
+from assembl.lib.decl_enums import EnumSymbol
+from assembl.lib.sqla import Base, BaseOps
+from assembl.view_def import get_view_def
+
+VIEW_DEFS = ("default", "extended", "changes", "private", "id_only", "cif")
+
+
+def baseline_generic_json(
+        self, view_def_name='default', user_id=None,
+        permissions=(P_READ, P_READ_IDEA), base_uri='local:'):
+    """BaseOps.generic_json before view_defs were compiled"""
+    user_id = user_id or Everyone
+    if not self.user_can(user_id, CrudPermissions.READ, permissions):
+        return None
+    view_def = get_view_def(view_def_name or 'default')
+    my_typename = self.external_typename()
+    result = {}
+    local_view = self.expand_view_def(view_def)
+    if not local_view:
+        return None
+    mapper = self.__class__.__mapper__
+    relns = {r.key: r for r in mapper.relationships}
+    cols = {c.key: c for c in mapper.columns}
+    fkeys = {c for c in mapper.columns if c.foreign_keys}
+    reln_of_fkeys = {
+        frozenset(r._calculated_foreign_keys): r
+        for r in mapper.relationships
+    }
+    fkey_of_reln = {r.key: r._calculated_foreign_keys
+                    for r in mapper.relationships}
+    methods = self.__class__.get_single_arg_methods()
+    properties = self.__class__.get_props_of()
+    known = set()
+    for name, spec in local_view.items():
+        vals = None
+        if name == "_default":
+            continue
+        if name == "@update":
+            update_dict = getattr(self, spec)
+            if pyinspect.ismethod(update_dict):
+                update_dict = update_dict()
+            assert isinstance(update_dict, dict)
+            result.update(update_dict)
+            continue
+        elif spec is False:
+            known.add(name)
+            continue
+        elif type(spec) is list:
+            if not spec:
+                spec = [True]
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(list) > 1" % (
+                    view_def_name, my_typename, name)
+            subspec = spec[0]
+        elif type(spec) is dict:
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(dict) > 1" % (
+                    view_def_name, my_typename, name)
+            assert "@id" in spec,\
+                "in viewdef %s, class %s, name %s, key should be '@id'" % (
+                    view_def_name, my_typename, name)
+            subspec = spec["@id"]
+        else:
+            subspec = spec
+        if subspec is True:
+            prop_name = name
+            view_name = None
+        else:
+            assert isinstance(subspec, string_types),\
+                "in viewdef %s, class %s, name %s, spec not a string" % (
+                    view_def_name, my_typename, name)
+            if subspec[0] == "'":
+                # literals.
+                result[name] = loads(subspec[1:])
+                continue
+            if ':' in subspec:
+                prop_name, view_name = subspec.split(':', 1)
+                if not view_name:
+                    view_name = view_def_name
+                if not prop_name:
+                    prop_name = name
+            else:
+                prop_name = subspec
+                view_name = None
+        if view_name:
+            assert get_view_def(view_name),\
+                "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
+                    view_def_name, my_typename, name, view_name)
+        # print prop_name, name, view_name
+
+        def translate_to_json(v):
+            if isinstance(v, Base):
+                p = getattr(v, 'user_can', None)
+                if p and not v.user_can(
+                        user_id, CrudPermissions.READ, permissions):
+                    return None
+                if view_name:
+                    return v.generic_json(
+                        view_name, user_id, permissions, base_uri)
+                else:
+                    return v.uri(base_uri)
+            elif isinstance(v, (
+                    string_types, int, long, float, bool, type(None))):
+                return v
+            elif isinstance(v, EnumSymbol):
+                return v.name
+            elif isinstance(v, datetime):
+                return v.isoformat() + "Z"
+            elif isinstance(v, dict):
+                v = {translate_to_json(k): translate_to_json(val)
+                     for k, val in v.items()}
+                return {k: val for (k, val) in v.items()
+                        if val is not None}
+            elif isinstance(v, Iterable):
+                v = [translate_to_json(i) for i in v]
+                return [x for x in v if x is not None]
+            else:
+                raise NotImplementedError("Cannot translate", v)
+
+        if prop_name == 'self':
+            if view_name:
+                r = self.generic_json(
+                    view_name, user_id, permissions, base_uri)
+                if r is not None:
+                    result[name] = r
+            else:
+                result[name] = self.uri()
+            continue
+        elif prop_name == '@view':
+            result[name] = view_def_name
+            continue
+        elif prop_name[0] == '&':
+            prop_name = prop_name[1:]
+            assert prop_name in methods,\
+                "in viewdef %s, class %s, name %s, unknown method %s" % (
+                    view_def_name, my_typename, name, prop_name)
+            # Function call. PLEASE RETURN JSON, Base objects,
+            # or list or dicts thereof
+            val = getattr(self, prop_name)()
+            result[name] = translate_to_json(val)
+            continue
+        elif prop_name in cols:
+            assert not view_name,\
+                "in viewdef %s, class %s, viewdef for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, list),\
+                "in viewdef %s, class %s, list for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, dict),\
+                "in viewdef %s, class %s, dict for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            known.add(prop_name)
+            val = getattr(self, prop_name)
+            if val is not None:
+                val = translate_to_json(val)
+            if val is not None:
+                result[name] = val
+            continue
+        elif prop_name in properties:
+            known.add(prop_name)
+            if view_name or (prop_name not in fkey_of_reln) or (
+                    relns[prop_name].direction != MANYTOONE):
+                val = getattr(self, prop_name)
+                if val is not None:
+                    val = translate_to_json(val)
+                if val is not None:
+                    result[name] = val
+            else:
+                fkeys = list(fkey_of_reln[prop_name])
+                assert(len(fkeys) == 1)
+                fkey = fkeys[0]
+                result[name] = relns[prop_name].mapper.class_.uri_generic(
+                    getattr(self, fkey.key))
+
+            continue
+        elif isinstance(getattr(self.__class__, prop_name, None),
+                        (AssociationProxy, ObjectAssociationProxyInstance)):
+            vals = getattr(self, prop_name)
+        else:
+            assert prop_name in relns,\
+                "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
+                    view_def_name, my_typename, prop_name)
+            known.add(prop_name)
+            # Add derived prop?
+            reln = relns[prop_name]
+            if reln.uselist:
+                vals = getattr(self, prop_name)
+        if vals is not None:
+            known.add(prop_name)
+            if view_name:
+                if isinstance(spec, dict):
+                    result[name] = {
+                        ob.uri(base_uri):
+                        ob.generic_json(
+                            view_name, user_id, permissions, base_uri)
+                        for ob in vals
+                        if ob.user_can(
+                            user_id, CrudPermissions.READ, permissions)}
+                else:
+                    result[name] = [
+                        ob.generic_json(
+                            view_name, user_id, permissions, base_uri)
+                        for ob in vals
+                        if ob.user_can(
+                            user_id, CrudPermissions.READ, permissions)]
+            else:
+                assert not isinstance(spec, dict),\
+                    "in viewdef %s, class %s, dict without viewname for %s" % (
+                        view_def_name, my_typename, name)
+                result[name] = [
+                    ob.uri(base_uri) for ob in vals
+                    if ob.user_can(
+                        user_id, CrudPermissions.READ, permissions)]
+            continue
+        assert not isinstance(spec, dict),\
+            "in viewdef %s, class %s, dict for non-list relation %s" % (
+                view_def_name, my_typename, prop_name)
+        if view_name:
+            ob = getattr(self, prop_name)
+            if ob and ob.user_can(
+                    user_id, CrudPermissions.READ, permissions):
+                val = ob.generic_json(
+                    view_name, user_id, permissions, base_uri)
+                if val is not None:
+                    if isinstance(spec, list):
+                        result[name] = [val]
+                    else:
+                        result[name] = val
+            else:
+                if isinstance(spec, list):
+                    result[name] = []
+                else:
+                    result[name] = None
+        else:
+            uri = None
+            if len(reln._calculated_foreign_keys) == 1 \
+                    and reln._calculated_foreign_keys < fkeys:
+                # shortcut, avoid fetch
+                fkey = list(reln._calculated_foreign_keys)[0]
+                ob_id = getattr(self, fkey.name)
+                if ob_id:
+                    uri = reln.mapper.class_.uri_generic(
+                        ob_id, base_uri)
+            else:
+                ob = getattr(self, prop_name)
+                if ob:
+                    uri = ob.uri(base_uri)
+            if uri:
+                if isinstance(spec, list):
+                    result[name] = [uri]
+                else:
+                    result[name] = uri
+            else:
+                if isinstance(spec, list):
+                    result[name] = []
+                else:
+                    result[name] = None
+
+    if local_view.get('_default') is not False:
+        for name, col in cols.items():
+            if name in known:
+                continue  # already done
+            as_rel = reln_of_fkeys.get(frozenset((col, )))
+            if as_rel:
+                name = as_rel.key
+                if name in known:
+                    continue
+                else:
+                    ob_id = getattr(self, col.key)
+                    if ob_id:
+                        result[name] = as_rel.mapper.class_.uri_generic(
+                            ob_id, base_uri)
+                    else:
+                        result[name] = None
+            else:
+                ob = getattr(self, name)
+                if ob:
+                    if type(ob) == datetime:
+                        ob = ob.isoformat() + "Z"
+                    result[name] = ob
+                else:
+                    result[name] = None
+    return result
+
+
+def _check_against_baseline(ob, monkeypatch):
+    serialized = {
+        view_def: ob.generic_json(view_def, permissions=(P_SYSADMIN, ))
+        for view_def in VIEW_DEFS}
+    # nested objects and overrides go through the reference too
+    with monkeypatch.context() as m:
+        m.setattr(BaseOps, "generic_json", baseline_generic_json)
+        expected = {
+            view_def: ob.generic_json(view_def, permissions=(P_SYSADMIN, ))
+            for view_def in VIEW_DEFS}
+    for view_def in VIEW_DEFS:
+        assert serialized[view_def] == expected[view_def], \
+            "%s differs in view_def %s" % (ob, view_def)
+
+
+@pytest.fixture(scope="function")
+def voting_widget(request, test_session, discussion, subidea_1):
+    """A voting widget on subidea_1"""
+    from assembl.models import MultiCriterionVotingWidget
+    widget = MultiCriterionVotingWidget(
+        discussion=discussion,
+        settings=json.dumps({"votable_root_id": subidea_1.uri()}))
+    test_session.add(widget)
+    test_session.flush()
+
+    def fin():
+        test_session.delete(widget)
+        test_session.flush()
+    request.addfinalizer(fin)
+    return widget
+
+
+def test_serialize_post(test_session, discussion, root_post_1, monkeypatch):
+    _check_against_baseline(root_post_1, monkeypatch)
+
+
+def test_serialize_idea(test_session, discussion, subidea_1, monkeypatch):
+    _check_against_baseline(subidea_1, monkeypatch)
+
+
+def test_serialize_user(
+        test_session, discussion, participant1_user, monkeypatch):
+    _check_against_baseline(participant1_user, monkeypatch)
+
+
+def test_serialize_voting_widget(
+        test_session, discussion, voting_widget, monkeypatch):
+    _check_against_baseline(voting_widget, monkeypatch)
+
+
+def test_serialize_discussion(test_session, discussion, monkeypatch):
+    _check_against_baseline(discussion, monkeypatch)
@@ -375,6 +375,36 @@ def test_api_get_posts_queries(
     # TODO: Other query types, and sorting
 
 
+def test_api_get_posts_pending_read_receipts(
+        discussion, test_app, test_session, admin_user,
+        root_post_1, reply_post_1, reply_post_2, monkeypatch):
+    from assembl.views.api import post as post_api
+    from assembl.tasks.read_receipts import ReadReceiptBuffer
+    receipts = ReadReceiptBuffer(flush_interval=1000)
+    monkeypatch.setattr(
+        post_api, "get_read_receipt_buffer", lambda: receipts)
+    # queued, not written
+    receipts.mark_read(admin_user.id, root_post_1.id, discussion.id)
+    base_post_url = get_url(discussion, 'posts')
+
+    def post_ids(query):
+        res = test_app.get(base_post_url + query)
+        assert res.status_code == 200
+        return {p['@id'] for p in json.loads(res.body)['posts']}
+
+    assert post_ids("?is_unread=false") == {root_post_1.uri()}
+    assert post_ids("?is_unread=true") == {
+        reply_post_1.uri(), reply_post_2.uri()}
+    # marked unread before the write
+    res = test_app.put(
+        get_url(discussion, 'post_read/%d' % root_post_1.id),
+        json.dumps({"read": False}))
+    assert res.status_code == 200
+    assert not receipts.is_pending(admin_user.id, root_post_1.id)
+    assert post_ids("?is_unread=false") == set()
+    assert receipts.stats()["written"] == 0
+
+
 def test_api_weird_failure_on_joinedload(
         discussion, test_app, test_session, participant1_user,
         root_post_1, reply_post_1, reply_post_2):
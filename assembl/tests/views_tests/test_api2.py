@@ -63,6 +63,24 @@ def test_get_ideas(discussion, test_app, synthesis_1,
     assert subidea_1_1_1_id not in syn_ideas
 
 
+def test_get_ideas_paged(discussion, test_app, subidea_1_1_1, test_session):
+    url = '/data/Conversation/%d/ideas' % (discussion.id,)
+    disc_ideas = test_app.get(url + '?view=id_only&order=id').json
+    assert len(disc_ideas) > 2
+    assert disc_ideas == sorted(
+        disc_ideas, key=lambda uri: Idea.get_database_id(uri))
+    pages = [test_app.get(url + '?view=id_only&order=id&limit=2&offset=%d' % (
+        offset,)).json for offset in range(0, len(disc_ideas), 2)]
+    assert [uri for page in pages for uri in page] == disc_ideas
+    last = test_app.get(url + '?order=-id&limit=1')
+    assert [idea['@id'] for idea in last.json] == disc_ideas[-1:]
+    assert last.headers['X-Page-Rows'] == '1'
+    assert last.headers['X-Page-Omitted'] == '0'
+    assert 'X-Page-Rows' not in test_app.get(url).headers
+    test_app.get(url + '?order=not_a_column', status=400)
+    test_app.get(url + '?limit=-1', status=400)
+
+
 def test_add_idea_in_synthesis(
         discussion, test_app, test_session, subidea_1_1):
     synthesis = discussion.next_synthesis
@@ -563,7 +581,7 @@ def test_inspiration_widget(
 def test_voting_widget(
         discussion, test_app, subidea_1_1, criterion_1, criterion_2,
         criterion_3, admin_user, participant1_user,
-        test_session, request):
+        test_session, memory_cache, request, monkeypatch):
     # Post the initial configuration
     db = discussion.db
     criteria = (criterion_1, criterion_2, criterion_3)
@@ -693,10 +711,39 @@ def test_voting_widget(
         assert vote_results_url
         vote_results = test_app.get(local_to_absolute(vote_results_url), headers=accept_json)
         assert vote_results.status_code == 200
+        etag = vote_results.headers.get('ETag', None)
+        assert etag
         vote_results = vote_results.json
         assert vote_results[subidea_1_1.uri()]['n'] == 1
         if spec_rep['@type'] == "LickertRange":
             assert vote_results[subidea_1_1.uri()]['avg'] == 0
+        headers = dict(accept_json)
+        headers['If-None-Match'] = etag
+        test = test_app.get(
+            local_to_absolute(vote_results_url), headers=headers,
+            status=304)
+        assert test.status_code == 304
+
+    # Without the fragment cache, the widget's votes are gathered once
+    from assembl.lib import jsonld_cache
+    monkeypatch.setattr(
+        jsonld_cache, "cached_for_version",
+        lambda ob, name, creator: creator())
+    gather = AbstractVoteSpecification.gather_widget_votes.__func__
+    gathered = []
+
+    def counting_gather(cls, widget):
+        gathered.append(widget.id)
+        return gather(cls, widget)
+    monkeypatch.setattr(
+        AbstractVoteSpecification, "gather_widget_votes",
+        classmethod(counting_gather))
+    db.info.pop('gathered_votes', None)
+    results = new_widget.all_voting_results()
+    assert len(results) == len(vote_spec_reps)
+    for spec_results in results.values():
+        assert spec_results[subidea_1_1.uri()]['n'] == 1
+    assert gathered == [new_widget.id]
     return
     # So far so good, rest to be done.
 
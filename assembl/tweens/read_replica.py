@@ -0,0 +1,117 @@
+"""Route safe requests to the read replica, when one is configured.
+
+Read queries of GET and HEAD requests on the API go through the ``dbro_``
+engine (cf. :py:func:`assembl.lib.sqla.configure_engine`), unless:
+
+* the user wrote something recently (read-your-writes stickiness,
+  through a timestamp cookie set after unsafe requests), or
+* the replica lags behind the primary by more than ``dbro_max_lag`` seconds.
+
+The engine used is bound to the request logger as ``db_engine``, so it
+appears in the response log line of
+:py:func:`assembl.tweens.logging.logging_tween_factory`.
+"""
+from time import time
+from threading import Lock
+
+from pyramid.settings import aslist
+
+from ..lib.sqla import get_session_maker
+from ..lib.logging import getLogger
+
+
+log = getLogger()
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+WRITE_COOKIE = 'idealoom_last_write'
+
+REPLICA_LAG_QUERY = """SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END"""
+
+
+class ReplicaLagMonitor(object):
+    """Measures the replica lag, at most once every ``check_interval`` seconds"""
+
+    def __init__(self, read_engine, check_interval=5):
+        self.read_engine = read_engine
+        self.check_interval = check_interval
+        self.lag = None
+        self.last_check = 0
+        self.lock = Lock()
+
+    def measure(self):
+        try:
+            with self.read_engine.connect() as connection:
+                lag = connection.execute(REPLICA_LAG_QUERY).scalar()
+            return float(lag or 0)
+        except Exception as e:
+            log.error("Could not measure replica lag: %s", e)
+            return None
+
+    def get_lag(self):
+        now = time()
+        if now - self.last_check > self.check_interval:
+            # only one thread measures, others use the previous value
+            if self.lock.acquire(False):
+                try:
+                    self.lag = self.measure()
+                    self.last_check = now
+                finally:
+                    self.lock.release()
+        return self.lag
+
+
+def read_replica_tween_factory(handler, registry):
+    """This defines a tween that routes safe requests to the read replica."""
+    session_maker = get_session_maker()
+    read_engine = session_maker.session_factory.kw.get('read_bind', None)
+    if read_engine is None:
+        return handler
+    settings = registry.settings
+    max_lag = float(settings.get('dbro_max_lag', 5))
+    sticky_seconds = int(settings.get('dbro_sticky_seconds', 30))
+    path_prefixes = tuple(aslist(settings.get(
+        'dbro_path_prefixes', '/data/ /api/v1/')))
+    lag_monitor = ReplicaLagMonitor(read_engine)
+
+    def recently_wrote(request):
+        try:
+            last_write = float(request.cookies.get(WRITE_COOKIE, 0))
+        except ValueError:
+            return False
+        return time() - last_write < sticky_seconds
+
+    def route_name(request):
+        if request.matched_route:
+            return request.matched_route.name
+        return "%s:%s" % (
+            request.context.__class__.__name__, request.view_name)
+
+    def read_replica_tween(request):
+        safe = request.method in SAFE_METHODS
+        use_replica = (
+            safe and request.path.startswith(path_prefixes)
+            and not recently_wrote(request))
+        if use_replica:
+            lag = lag_monitor.get_lag()
+            use_replica = lag is not None and lag <= max_lag
+        session = session_maker()
+        session.set_readonly(use_replica)
+        try:
+            response = handler(request)
+            used_replica = use_replica and not session.wrote
+        finally:
+            session.set_readonly(False)
+        if not safe and response.status_code < 400:
+            response.set_cookie(
+                WRITE_COOKIE, str(time()), max_age=sticky_seconds,
+                httponly=True)
+        request._logger = request.logger().bind(
+            db_engine="replica" if used_replica else "primary",
+            db_route=route_name(request))
+        return response
+
+    return read_replica_tween
@@ -31,6 +31,7 @@ IDs will always take the form ``local:<classname>/<object_id>``
 """
 
 import traceback
+from os import listdir
 from os.path import exists, join, dirname, getmtime
 
 import simplejson
@@ -62,6 +63,23 @@ def get_view_def(name):
     return _def_cache.get(name, None)
 
 
+def view_def_names(include_reverse=False):
+    """The names of the view_defs, excluding reverse view_defs by default."""
+    names = sorted(
+        fname[:-5] for fname in listdir(dirname(__file__))
+        if fname.endswith('.json'))
+    if not include_reverse:
+        names = [name for name in names if not name.endswith('_reverse')]
+    return names
+
+
 def includeme(config):
     global _check_modified
-    _check_modified = not asbool(config.registry.settings.get('cache_viewdefs', True))
+    settings = config.registry.settings
+    _check_modified = not asbool(settings.get('cache_viewdefs', True))
+    if asbool(settings.get('compile_viewdefs', True)):
+        from ..lib.logging import getLogger
+        from .compiler import compile_view_defs
+        log = getLogger()
+        for (name, typename), error in sorted(compile_view_defs().items()):
+            log.error("Invalid view_def %s for %s: %s", name, typename, error)
@@ -0,0 +1,297 @@
+"""Compilation of view_defs into per-class serialization plans.
+
+Each (class, view_def) pair is expanded with
+:py:meth:`assembl.lib.sqla.BaseOps.expand_view_def`, checked against the
+class's mapper, and turned into a :py:class:`CompiledView`: a tuple of
+:py:class:`ViewEntry`, whose kind tells
+:py:meth:`assembl.lib.sqla.BaseOps.generic_json` how to get each value
+without further checks.
+
+All view_defs are compiled when the application starts, so errors are
+reported then rather than when some rare serialization path runs.
+"""
+from collections import namedtuple
+from inspect import isclass
+from copy import deepcopy
+
+from simplejson import loads
+from future.utils import string_types
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.ext.associationproxy import (
+    AssociationProxy, ObjectAssociationProxyInstance)
+
+from . import get_view_def, view_def_names
+
+
+class ViewDefError(ValueError):
+    pass
+
+
+ViewEntry = namedtuple('ViewEntry', (
+    'name', 'kind', 'prop_name', 'view_name', 'container', 'value'))
+"""A compiled view_def entry.
+
+:param kind: one of ``update``, ``literal``, ``self``, ``view``,
+    ``method``, ``column``, ``property``, ``fkey_uri``, ``collection``,
+    ``scalar_json`` and ``scalar_uri``
+:param container: None, ``list`` or ``dict``
+:param value: the literal for ``literal`` entries; a (column key,
+    target class) pair for ``fkey_uri`` entries, and for ``scalar_uri``
+    entries where the foreign key can be used instead of the relationship
+"""
+
+DefaultEntry = namedtuple('DefaultEntry', ('name', 'column', 'target'))
+"""A column that is serialized by default.
+
+:param target: the related class, if the column is the foreign key of a
+    relationship, which is then serialized by URI under its own name.
+"""
+
+
+class CompiledView(object):
+    """The serialization plan of a class in a view_def"""
+    def __init__(self, cls, view_def_name, view_def, local_view):
+        self.cls = cls
+        self.view_def_name = view_def_name
+        self.source = view_def
+        self.entries = ()
+        self.defaults = ()
+        self._compile(local_view)
+
+    def error(self, name, message, *args):
+        return ViewDefError("in viewdef %s, class %s, name %s, %s" % (
+            (self.view_def_name, self.cls.external_typename(), name,
+             message % args)))
+
+    def _compile(self, local_view):
+        cls = self.cls
+        mapper = cls.__mapper__
+        relns = {r.key: r for r in mapper.relationships}
+        cols = {c.key: c for c in mapper.columns}
+        fkeys = {c for c in mapper.columns if c.foreign_keys}
+        fkey_of_reln = {r.key: r._calculated_foreign_keys
+                        for r in mapper.relationships}
+        methods = cls.get_single_arg_methods()
+        properties = cls.get_props_of()
+        entries = []
+        known = set()
+        for name, spec in local_view.items():
+            container = None
+            if name == "_default":
+                continue
+            if name == "@update":
+                entries.append(ViewEntry(name, 'update', spec, None, None, None))
+                continue
+            elif spec is False:
+                known.add(name)
+                continue
+            elif type(spec) is list:
+                if not spec:
+                    spec = [True]
+                if len(spec) != 1:
+                    raise self.error(name, "len(list) > 1")
+                subspec = spec[0]
+                container = 'list'
+            elif type(spec) is dict:
+                if len(spec) != 1:
+                    raise self.error(name, "len(dict) > 1")
+                if "@id" not in spec:
+                    raise self.error(name, "key should be '@id'")
+                subspec = spec["@id"]
+                container = 'dict'
+            else:
+                subspec = spec
+            if subspec is True:
+                prop_name = name
+                view_name = None
+            else:
+                if not isinstance(subspec, string_types):
+                    raise self.error(name, "spec not a string")
+                if subspec[0] == "'":
+                    entries.append(ViewEntry(
+                        name, 'literal', None, None, None,
+                        loads(subspec[1:])))
+                    continue
+                if ':' in subspec:
+                    prop_name, view_name = subspec.split(':', 1)
+                    if not view_name:
+                        view_name = self.view_def_name
+                    if not prop_name:
+                        prop_name = name
+                else:
+                    prop_name = subspec
+                    view_name = None
+            if view_name and not get_view_def(view_name):
+                raise self.error(name, "unknown viewdef %s", view_name)
+
+            def entry(kind, value=None):
+                entries.append(ViewEntry(
+                    name, kind, prop_name, view_name, container, value))
+
+            if prop_name == 'self':
+                entry('self')
+            elif prop_name == '@view':
+                entry('view')
+            elif prop_name[0] == '&':
+                prop_name = prop_name[1:]
+                if prop_name not in methods:
+                    raise self.error(name, "unknown method %s", prop_name)
+                entry('method')
+            elif prop_name in cols:
+                if view_name:
+                    raise self.error(name, "viewdef for literal property")
+                if container:
+                    raise self.error(
+                        name, "%s for literal property", container)
+                known.add(prop_name)
+                entry('column')
+            elif prop_name in properties:
+                known.add(prop_name)
+                if view_name or (prop_name not in fkey_of_reln) or (
+                        relns[prop_name].direction != MANYTOONE):
+                    entry('property')
+                else:
+                    reln_fkeys = list(fkey_of_reln[prop_name])
+                    if len(reln_fkeys) != 1:
+                        raise self.error(name, "composite foreign key")
+                    entry('fkey_uri', (
+                        reln_fkeys[0].key, relns[prop_name].mapper.class_))
+            elif isinstance(getattr(cls, prop_name, None),
+                            (AssociationProxy, ObjectAssociationProxyInstance)):
+                known.add(prop_name)
+                entry('collection')
+            else:
+                if prop_name not in relns:
+                    raise self.error(
+                        name, "prop_name %s not a column, property or relation",
+                        prop_name)
+                known.add(prop_name)
+                reln = relns[prop_name]
+                if reln.uselist:
+                    if container == 'dict' and not view_name:
+                        raise self.error(name, "dict without viewname")
+                    entry('collection')
+                    continue
+                if container == 'dict':
+                    raise self.error(name, "dict for non-list relation")
+                if view_name:
+                    entry('scalar_json')
+                elif len(reln._calculated_foreign_keys) == 1 \
+                        and reln._calculated_foreign_keys < fkeys:
+                    # shortcut, avoid fetch
+                    fkey = list(reln._calculated_foreign_keys)[0]
+                    entry('scalar_uri', (fkey.name, reln.mapper.class_))
+                else:
+                    entry('scalar_uri')
+        self.entries = tuple(entries)
+        if local_view.get('_default') is not False:
+            reln_of_fkeys = {
+                frozenset(r._calculated_foreign_keys): r
+                for r in mapper.relationships
+            }
+            defaults = []
+            for name, col in cols.items():
+                if name in known:
+                    continue  # already done
+                as_rel = reln_of_fkeys.get(frozenset((col, )))
+                if as_rel:
+                    if as_rel.key not in known:
+                        defaults.append(DefaultEntry(
+                            as_rel.key, col.key, as_rel.mapper.class_))
+                else:
+                    defaults.append(DefaultEntry(name, name, None))
+            self.defaults = tuple(defaults)
+
+    def literal(self, entry):
+        value = entry.value
+        if isinstance(value, (list, dict)):
+            value = deepcopy(value)
+        return value
+
+
+_compiled = {}
+
+
+def compile_view(cls, view_def_name):
+    """The :py:class:`CompiledView` of a class in a view_def,
+    or None if the view_def does not apply to that class.
+
+    Compiled views are cached, and compiled again if the view_def
+    file was reloaded."""
+    key = (cls, view_def_name)
+    view_def = get_view_def(view_def_name)
+    cached = _compiled.get(key, None)
+    if cached is not None and cached[0] is view_def:
+        return cached[1]
+    if view_def is None:
+        raise ViewDefError("Unknown viewdef " + view_def_name)
+    local_view = cls.expand_view_def(view_def)
+    compiled = None
+    if local_view:
+        compiled = CompiledView(cls, view_def_name, view_def, local_view)
+    _compiled[key] = (view_def, compiled)
+    return compiled
+
+
+def serialized_classes():
+    from ..lib.sqla import class_registry, BaseOps
+    return sorted({
+        cls for cls in class_registry.values()
+        if isclass(cls) and issubclass(cls, BaseOps)
+        and getattr(cls, '__mapper__', None) is not None},
+        key=lambda cls: cls.external_typename())
+
+
+def compile_view_defs(names=None):
+    """Compile the given view_defs (default: all but reverse view_defs)
+    for all mapped classes.
+
+    :returns: a dictionary of errors by (view_def name, class typename)"""
+    errors = {}
+    classes = serialized_classes()
+    for name in names or view_def_names():
+        for cls in classes:
+            try:
+                compile_view(cls, name)
+            except (ViewDefError, AssertionError) as e:
+                errors[(name, cls.external_typename())] = str(e)
+    return errors
+
+
+def view_def_coverage(name):
+    """How a view_def applies to the mapped classes.
+
+    :returns: a dictionary with lists of typenames, under ``explicit``
+        (classes named in the view_def), ``inherited`` (classes that use the
+        definition of a superclass), ``excluded`` (classes defined as
+        ``false``), ``missing`` (classes not serialized by the view_def)
+        and ``unused`` (view_def entries that match no class
+        and are not extended)"""
+    view_def = get_view_def(name)
+    if view_def is None:
+        raise ViewDefError("Unknown viewdef " + name)
+    # expand_view_def adds expanded entries to the view_def
+    declared = set(view_def.keys())
+    coverage = {k: [] for k in (
+        'explicit', 'inherited', 'excluded', 'missing', 'unused')}
+    typenames = set()
+    for cls in serialized_classes():
+        typename = cls.external_typename()
+        typenames.add(typename)
+        try:
+            local_view = cls.expand_view_def(view_def)
+        except AssertionError:
+            local_view = None
+        if local_view is False:
+            coverage['excluded'].append(typename)
+        elif not local_view:
+            coverage['missing'].append(typename)
+        elif typename in declared:
+            coverage['explicit'].append(typename)
+        else:
+            coverage['inherited'].append(typename)
+    extended = {v.get('@extends', None) for v in view_def.values()
+                if isinstance(v, dict)}
+    coverage['unused'] = sorted(
+        declared - typenames - extended - {'_default'})
+    return coverage
@@ -15,4 +15,6 @@ def includeme(config):
     config.add_route('discussion_edit',
                      '/admin/discussion/edit/{discussion_id:\d+}')
     config.add_route('test_simultaneous_ajax_calls', '/admin/test_simultaneous_ajax_calls/')
+    config.add_route('source_wakes', '/admin/source_wakes')
+    config.add_route('read_receipts', '/admin/read_receipts')
     config.include(frontend_include, route_prefix='/admin')
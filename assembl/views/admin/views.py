@@ -102,6 +102,21 @@ def base_admin_view(request):
     return response
 
 
+@view_config(route_name='source_wakes', permission=P_SYSADMIN,
+             request_method="GET", renderer="json")
+def source_wakes(request):
+    from assembl.tasks.source_wake import get_scheduler
+    return get_scheduler().stats()
+
+
+@view_config(route_name='read_receipts', permission=P_SYSADMIN,
+             request_method="GET", renderer="json")
+def read_receipts(request):
+    from assembl.tasks.read_receipts import get_read_receipt_buffer
+    buffer = get_read_receipt_buffer()
+    return buffer.stats() if buffer is not None else {"buffered": False}
+
+
 @view_config(route_name='test_simultaneous_ajax_calls',
              permission=P_SYSADMIN, request_method="GET")
 def test_simultaneous_ajax_calls(request):
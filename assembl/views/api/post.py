@@ -31,6 +31,9 @@ from assembl.lib.text_search import (
     add_text_search, postgres_language_configurations)
 from assembl.views.api import API_DISCUSSION_PREFIX
 from assembl.auth import P_READ, P_ADD_POST
+from assembl.tasks.source_wake import schedule_source_wakes
+from assembl.tasks.read_receipts import (
+    get_read_receipt_buffer, mark_post_read as mark_read)
 from assembl.tasks.translate import (
     translate_content,
     PrefCollectionTranslationTable)
@@ -65,7 +68,8 @@ def get_posts(request):
     Filters have two forms:
     only_*, is for filters that cannot be reversed (ex: only_synthesis, only_orphan)
     is_*, is for filters that can be reversed (ex:is_unread=true returns only unread message, is_unread=false returns only read messages)
-    order: can be chronological, reverse_chronological, popularity
+    order: can be chronological, reverse_chronological, popularity, last_activity (most recent activity in the post's subtree first)
+    only_threads: only the thread roots (posts without parent)
     root_post_id: all posts below the one specified.
     family_post_id: all posts below the one specified, and all its ancestors.
     post_reply_to: replies to a given post
@@ -79,7 +83,7 @@ def get_posts(request):
     localizer = request.localizer
     discussion = request.context
 
-    discussion.import_from_sources()
+    schedule_source_wakes(discussion)
 
     user_id = authenticated_userid(request) or Everyone
     permissions = request.permissions
@@ -103,7 +107,8 @@ def get_posts(request):
     order = request.GET.get('order')
     if order is None:
         order = 'chronological'
-    assert order in ('chronological', 'reverse_chronological', 'score', 'popularity')
+    assert order in ('chronological', 'reverse_chronological', 'score',
+                     'popularity', 'last_activity')
     if order == 'score' and not keywords:
         raise HTTPBadRequest("Cannot ask for a score without keywords")
 
@@ -169,6 +174,9 @@ def get_posts(request):
     #    deleted = False
     # end v4
 
+    if asbool(request.GET.get('only_threads', False)):
+        posts = posts.filter(PostClass.parent_id == None)
+
     only_orphan = asbool(request.GET.get('only_orphan', False))
     if only_orphan:
         if root_idea_id:
@@ -262,6 +270,11 @@ def get_posts(request):
                 ViewPost.tombstone_condition(),
                 ViewPost.actor_id == user_id,
                 *ViewPost.get_discussion_conditions(discussion.id))}
+        receipts = get_read_receipt_buffer()
+        # read receipts not written yet
+        pending_read_posts = receipts.pending_post_ids(
+            user_id, discussion.id) if receipts else set()
+        read_posts |= pending_read_posts
         liked_posts = {l.post_id: l.id for l in discussion.db.query(
             LikedPost).filter(
                 LikedPost.tombstone_condition(),
@@ -275,8 +288,15 @@ def get_posts(request):
                     ViewPost.tombstone_date == None))
             if is_unread == "true":
                 posts = posts.filter(ViewPost.id == None)
+                if pending_read_posts:
+                    posts = posts.filter(
+                        Content.id.notin_(list(pending_read_posts)))
             elif is_unread == "false":
-                posts = posts.filter(ViewPost.id != None)
+                if pending_read_posts:
+                    posts = posts.filter((ViewPost.id != None) | Content.id.in_(
+                        list(pending_read_posts)))
+                else:
+                    posts = posts.filter(ViewPost.id != None)
         user = AgentProfile.get(user_id)
         service = discussion.translation_service()
         if service.canTranslate is not None:
@@ -317,6 +337,8 @@ def get_posts(request):
     elif order == 'popularity':
         # assume reverse chronological otherwise
         posts = posts.order_by(Content.like_count.desc(), Content.creation_date.desc())
+    elif order == 'last_activity':
+        posts = posts.order_by(PostClass.last_activity.desc())
     else:
         posts = posts.order_by(Content.id)
     # print str(posts)
@@ -390,11 +412,7 @@ def get_posts(request):
             no_of_posts_viewed_by_user += 1
         elif user_id != Everyone and root_post is not None and root_post.id == post.id:
             # Mark post read, we requested it explicitely
-            viewed_post = ViewPost(
-                actor_id=user_id,
-                post=root_post
-                )
-            discussion.db.add(viewed_post)
+            mark_read(discussion.db, user_id, root_post, discussion.id)
             serializable_post['read'] = True
         else:
             serializable_post['read'] = False
@@ -468,8 +486,11 @@ def mark_post_read(request):
     read_data = json.loads(request.body)
     db = discussion.db
     change = False
+    receipts = get_read_receipt_buffer()
     with transaction.manager:
         if read_data.get('read', None) is False:
+            if receipts is not None and receipts.discard(user_id, post_id):
+                change = True
             view = db.query(ViewPost).filter_by(
                 post_id=post_id, actor_id=user_id,
                 tombstone_date=None).first()
@@ -477,16 +498,15 @@ def mark_post_read(request):
                 change = True
                 view.is_tombstone = True
         else:
-            count = db.query(ViewPost).filter_by(
-                post_id=post_id, actor_id=user_id,
-                tombstone_date=None).count()
-            if not count:
-                change = True
-                db.add(ViewPost(post=post, actor_id=user_id))
+            change = mark_read(db, user_id, post, discussion.id)
 
     new_counts = []
     if change:
         new_counts = Idea.idea_read_counts(discussion.id, post_id, user_id)
+        if receipts is not None and receipts.is_pending(user_id, post_id):
+            # the receipt is not written yet
+            new_counts = [(idea_id, read_posts + 1)
+                          for (idea_id, read_posts) in new_counts]
 
     return { "ok": True, "ideas": [
         {"@id": Idea.uri_generic(idea_id),
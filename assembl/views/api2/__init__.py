@@ -19,6 +19,12 @@ but there is a magic URL to obtain the list:
 Another special case is when the collection name is actually a singleton.
 In that case, one is allowed to use ``-`` instead of a database ID which one may not know.
 
+Class and collection listings accept ``order``, ``limit`` and ``offset``
+parameters, e.g. ``/data/Discussion/<N>/ideas?order=-creation_date&limit=20``.
+Permission conditions that can be expressed in SQL (publication states,
+local roles, ownership; cf. ``query_filter_with_permission``) are applied
+in the query, before paging.
+
 A final special case is the collection ``/data/Discussion/<N>/all_users``, which has a shortcut to the logged-in user,
 if any: ``/data/Discussion/<N>/all_users/current``
 
@@ -70,6 +76,50 @@ JSON_HEADER = "Content-Type:application/(.*\+)?json"
 MULTIPART_HEADER = "Content-Type:multipart/form-data"
 
 
+def paging_args(request, cls):
+    """The ``order``, ``limit`` and ``offset`` arguments of a listing.
+
+    ``order`` is a column name, prefixed with ``-`` for descending order.
+    Rows that are not shown are omitted from the page, see
+    :py:func:`paged_json`."""
+    args = {}
+    order = request.GET.get('order', None)
+    if order:
+        if order.lstrip('-') not in inspect(cls).columns:
+            raise HTTPBadRequest("Cannot order by " + order)
+        args['order'] = order
+    for name in ('limit', 'offset'):
+        value = request.GET.get(name, None)
+        if value is None:
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            value = -1
+        if value < 0:
+            raise HTTPBadRequest("Invalid %s: %s" % (name, request.GET[name]))
+        args[name] = value
+    return args
+
+
+def paged_json(request, paging, obs, view, user_id, permissions):
+    """Serialize the objects of a listing, without those that the user
+    cannot read or that the view does not show.
+
+    Those are omitted after paging in SQL, so a page may be shorter than
+    ``limit`` without being the last one. Paged listings give the number
+    of rows read in the ``X-Page-Rows`` header, and of rows omitted in
+    ``X-Page-Omitted``: the next page starts at ``offset`` + ``X-Page-Rows``,
+    and there is none if ``X-Page-Rows`` is less than ``limit``."""
+    res = [ob.generic_json(view, user_id, permissions) for ob in obs]
+    json = [x for x in res if x is not None]
+    if paging.get('limit', None) is not None or paging.get('offset', None):
+        headers = request.response.headers
+        headers['X-Page-Rows'] = str(len(res))
+        headers['X-Page-Omitted'] = str(len(res) - len(json))
+    return json
+
+
 def check_permissions(
         ctx, user_id, operation, cls=None):
     cls = cls or ctx.get_target_class()
@@ -99,12 +149,12 @@ def class_view(request):
     check = check_permissions(ctx, user_id, CrudPermissions.READ)
     view = request.GET.get('view', None) or ctx.get_default_view() or 'id_only'
     tombstones = asbool(request.GET.get('tombstones', False))
-    q = ctx.create_query(view == 'id_only', tombstones)
+    paging = paging_args(request, ctx._class)
+    q = ctx.create_query(view == 'id_only', tombstones, **paging)
     if view == 'id_only':
         return [ctx._class.uri_generic(x) for (x,) in q.all()]
     permissions = ctx.get_permissions()
-    r = [i.generic_json(view, user_id, permissions) for i in q.all()]
-    return [x for x in r if x is not None]
+    return paged_json(request, paging, q.all(), view, user_id, permissions)
 
 
 @view_config(context=InstanceContext, renderer='json',
@@ -131,11 +181,11 @@ def collection_view(request, default_view='default'):
     check = check_permissions(ctx, user_id, CrudPermissions.READ)
     view = request.GET.get('view', None) or ctx.get_default_view() or default_view
     tombstones = asbool(request.GET.get('tombstones', False))
-    q = ctx.create_query(view == 'id_only', tombstones)
+    paging = paging_args(request, ctx.collection_class)
+    q = ctx.create_query(view == 'id_only', tombstones, **paging)
     if view == 'id_only':
         return [ctx.collection_class.uri_generic(x) for (x,) in q.all()]
-    res = [i.generic_json(view, user_id, permissions) for i in q.all()]
-    return [x for x in res if x is not None]
+    return paged_json(request, paging, q.all(), view, user_id, permissions)
 
 
 @view_config(context=InstanceContext, request_method='POST')
@@ -6,11 +6,11 @@ import re
 import base64
 from io import StringIO, BytesIO, TextIOWrapper
 from os import urandom
-from os.path import join, dirname
 from collections import defaultdict
 from datetime import timedelta, datetime
 import isodate
-from assembl.semantic.obfuscation import AESObfuscator
+from assembl.semantic.obfuscation import (
+    AESObfuscator, Obfuscator, get_obfuscator)
 #import pprint
 
 from sqlalchemy import (
@@ -39,7 +39,6 @@ from pyramid.view import view_config
 from pyramid.httpexceptions import (
     HTTPOk, HTTPException, HTTPBadRequest, HTTPUnauthorized, HTTPNotAcceptable,
     HTTPFound, HTTPServerError, HTTPConflict)
-from pyramid_dogpile_cache import get_region
 from pyramid.security import authenticated_userid, Everyone
 from pyramid.renderers import JSONP_VALID_CALLBACK
 from pyramid.settings import asbool
@@ -52,6 +51,7 @@ from assembl.lib.config import get_config
 from assembl.lib.parsedatetime import parse_datetime
 from assembl.lib.sqla import ObjectNotUniqueError
 from assembl.lib.json import DateJSONEncoder
+from assembl.lib.jsonld_cache import get_dogpile_region, export_version
 from assembl.lib.utils import get_global_base_url
 from assembl.auth import (
     P_READ, P_READ_USER_INFO, P_ADMIN_DISC, P_DISC_STATS, P_SYSADMIN,
@@ -83,28 +83,35 @@ def discussion_settings_put(request):
     request.context._instance.settings_json = request.json_body
     return HTTPOk()
 
-dogpile_fname = join(
-    dirname(dirname(dirname(dirname(__file__)))),
-    get_config().get('dogpile_cache.arguments.filename'))
-
-discussion_jsonld_cache = get_region(
-    'discussion_jsonld', **{"arguments.filename": dogpile_fname})
-userprivate_jsonld_cache = get_region(
-    'userprivate_jsonld', **{"arguments.filename": dogpile_fname})
+discussion_jsonld_cache = get_dogpile_region('discussion_jsonld')
+userprivate_jsonld_cache = get_dogpile_region('userprivate_jsonld')
 
 
+# The version argument is only used as part of the cache key.
+# Cf. :py:func:`assembl.lib.jsonld_cache.export_version`
 @discussion_jsonld_cache.cache_on_arguments()
-def discussion_jsonld(discussion_id):
+def discussion_jsonld(discussion_id, version):
     d = Discussion.get(discussion_id)
     return json.dumps(d.get_public_graphs_cif())
 
 
 @userprivate_jsonld_cache.cache_on_arguments()
-def userprivate_jsonld(discussion_id):
+def userprivate_jsonld(discussion_id, version):
     d = Discussion.get(discussion_id)
     return json.dumps(d.get_private_graphs_cif())
 
 
+# The exports, split around agent ids, for obfuscation with any salt.
+@discussion_jsonld_cache.cache_on_arguments()
+def discussion_jsonld_parts(discussion_id, version):
+    return Obfuscator.split_ids(discussion_jsonld(discussion_id, version))
+
+
+@userprivate_jsonld_cache.cache_on_arguments()
+def userprivate_jsonld_parts(discussion_id, version):
+    return Obfuscator.split_ids(userprivate_jsonld(discussion_id, version))
+
+
 def read_user_token(request):
     salt = None
     ctx = request.context
@@ -196,9 +203,9 @@ def get_token(request):
         for permissions in permission_sets}
     user_ids = request.GET.getall("user_id")
     if user_ids:
+        # only used once here
         obfuscator = AESObfuscator(random_str)
-        user_ids = "\n".join(user_ids)
-        data["user_ids"] = obfuscator.obfuscate(user_ids).split("\n")
+        data["user_ids"] = [obfuscator.obfuscate_uri(u) for u in user_ids]
     return data
 
 
@@ -213,13 +220,19 @@ def discussion_instance_view_jsonld(request):
     user_id, permissions, salt = read_user_token(request)
     if P_READ not in permissions:
         raise HTTPUnauthorized()
-    if not salt and P_ADMIN_DISC not in permissions:
-        salt = base64.urlsafe_b64encode(urandom(12))
-
-    jdata = discussion_jsonld(discussion.id)
+    obfuscator = None
     if salt:
-        obfuscator = AESObfuscator(salt)
-        jdata = obfuscator.obfuscate(jdata)
+        obfuscator = get_obfuscator(salt)
+    elif P_ADMIN_DISC not in permissions:
+        # one-time salt: do not pollute the shared obfuscators
+        obfuscator = AESObfuscator(base64.urlsafe_b64encode(urandom(12)))
+
+    version = export_version(discussion.id)
+    if obfuscator:
+        jdata = obfuscator.obfuscate_parts(
+            discussion_jsonld_parts(discussion.id, version))
+    else:
+        jdata = discussion_jsonld(discussion.id, version)
     # TODO: Add age
     if "callback" in request.GET:
         jdata = handle_jsonp(request.GET['callback'], jdata)
@@ -240,13 +253,19 @@ def user_private_view_jsonld(request):
     user_id, permissions, salt = read_user_token(request)
     if P_READ_USER_INFO not in permissions:
         raise HTTPUnauthorized()
-    if not salt and P_ADMIN_DISC not in permissions:
-        salt = base64.urlsafe_b64encode(urandom(12))
-
-    jdata = userprivate_jsonld(discussion_id)
+    obfuscator = None
     if salt:
-        obfuscator = AESObfuscator(salt)
-        jdata = obfuscator.obfuscate(jdata)
+        obfuscator = get_obfuscator(salt)
+    elif P_ADMIN_DISC not in permissions:
+        # one-time salt: do not pollute the shared obfuscators
+        obfuscator = AESObfuscator(base64.urlsafe_b64encode(urandom(12)))
+
+    version = export_version(discussion_id)
+    if obfuscator:
+        jdata = obfuscator.obfuscate_parts(
+            userprivate_jsonld_parts(discussion_id, version))
+    else:
+        jdata = userprivate_jsonld(discussion_id, version)
     if "callback" in request.GET:
         jdata = handle_jsonp(request.GET['callback'], jdata)
         content_type = "application/javascript"
@@ -6,7 +6,7 @@ import csv
 
 from pyramid.view import view_config
 from pyramid.httpexceptions import (
-    HTTPBadRequest, HTTPUnauthorized, HTTPNotFound)
+    HTTPBadRequest, HTTPUnauthorized, HTTPNotFound, HTTPNotModified)
 from pyramid.security import authenticated_userid
 from pyramid.response import Response
 from pyramid.settings import asbool
@@ -117,12 +117,22 @@ def vote_results(request):
         if histogram > 25:
             raise HTTPBadRequest(
                 "Please select at most 25 bins in the histogram.")
-    widget = ctx._instance.widget
-    if widget.activity_state != "ended":
-        permissions = ctx.get_permissions()
+    spec = ctx._instance
+    permissions = ctx.get_permissions()
+    if spec.widget.activity_state != "ended":
+        if P_ADMIN_DISC not in permissions:
+            raise HTTPUnauthorized()
+    if asbool(request.GET.get('recompute', False)):
+        # Bypass the cache, as a consistency check
         if P_ADMIN_DISC not in permissions:
             raise HTTPUnauthorized()
-    return ctx._instance.voting_results(histogram)
+        return spec.voting_results(histogram)
+    etag = spec.voting_results_etag(histogram)
+    if etag:
+        if etag in request.if_none_match:
+            return HTTPNotModified(etag=etag)
+        request.response.etag = etag
+    return spec.cached_voting_results(histogram)
 
 @view_config(context=InstanceContext, request_method='GET',
              ctx_instance_class=AbstractVoteSpecification,
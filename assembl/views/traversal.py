@@ -330,6 +330,24 @@ def process_args(args, cls):
             continue
 
 
+def order_and_page_query(query, alias, order=None, limit=None, offset=None):
+    """Order a query on a class alias by a column (descending if the name is
+    prefixed with ``-``), and restrict it to a page.
+
+    Pages are ordered by id after the given column, so they are stable."""
+    if order:
+        column = getattr(alias, order.lstrip('-'))
+        query = query.order_by(
+            column.desc() if order.startswith('-') else column)
+    if order or limit is not None or offset is not None:
+        query = query.order_by(alias.id)
+    if limit is not None:
+        query = query.limit(limit)
+    if offset:
+        query = query.offset(offset)
+    return query
+
+
 class ClassContext(TraversalContext):
     """A context that represents a given model class (e.g. ``/data/Idea``)
 
@@ -357,7 +375,8 @@ class ClassContext(TraversalContext):
             return my_default
         return self.__parent__.get_default_view()
 
-    def create_query(self, id_only=True, tombstones=False):
+    def create_query(self, id_only=True, tombstones=False,
+                     order=None, limit=None, offset=None):
         from assembl.models import TombstonableMixin
         cls = self._class
         alias = self.class_alias
@@ -370,7 +389,7 @@ class ClassContext(TraversalContext):
             query = query.filter(and_(*cls.base_conditions(alias)))
         query = cls.query_filter_with_crud_op_req(
             self.get_request(), query=query, clsAlias=alias)
-        return query
+        return order_and_page_query(query, alias, order, limit, offset)
 
     def get_class(self, typename=None):
         """Returns the collection class, or subclass designated by typename"""
@@ -648,8 +667,21 @@ class CollectionContext(TraversalContext):
             return self.parent_instance
         return self.__parent__.get_instance_of_class(cls)
 
-    def create_query(self, id_only=True, tombstones=False):
+    def create_query(self, id_only=True, tombstones=False,
+                     order=None, limit=None, offset=None):
         alias = self.class_alias
+        if order or limit is not None or offset is not None:
+            # The decorated query may have duplicates, and distinct
+            # does not allow ordering on other columns: page over the ids.
+            ids = self.decorate_query(
+                self.parent_instance.db.query(alias.id), self, tombstones
+            ).distinct().subquery()
+            page_alias = aliased(self.collection_class)
+            query = self.parent_instance.db.query(
+                page_alias.id if id_only else page_alias
+            ).filter(page_alias.id.in_(ids))
+            return order_and_page_query(
+                query, page_alias, order, limit, offset)
         if id_only:
             query = self.parent_instance.db.query(alias.id)
             return self.decorate_query(query, self, tombstones).distinct()